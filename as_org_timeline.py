@@ -0,0 +1,205 @@
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from datetime import date
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+
+# Binary, memory mappable version of all_as_org_map.json.
+#
+# All integers are little endian uint32, so every section is 4 byte aligned:
+#
+#   header          magic, version and the number of items in every section
+#   string offsets  string_count + 1 offsets into the string blob
+#   asns            asn_count ASNs, sorted
+#   record offsets  asn_count + 1 indexes into the records, one range per ASN
+#   records         record_count records of RECORD_FIELDS string ids, sorted by
+#                   changed within every ASN
+#   string blob     utf-8 encoded strings, each one stored only once
+#
+# Opening a file only parses the header, everything else is read from the
+# mapping when a lookup needs it.
+
+MAGIC = b"ASOT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHIIII")
+RECORD_FIELDS = ["org_name", "country", "changed", "aut_name", "source"]
+RECORD_LEN = len(RECORD_FIELDS)
+CHANGED_IDX = RECORD_FIELDS.index("changed")
+
+
+def write_as_org_timeline(all_as_org_map: dict, output_path: Path):
+    strings = {}
+
+    def intern(s: str) -> int:
+        return strings.setdefault(s, len(strings))
+
+    asns = array("I")
+    record_offsets = array("I", [0])
+    records = array("I")
+    for asn in sorted(all_as_org_map):
+        asns.append(asn)
+        for vals in all_as_org_map[asn]:
+            records.extend(intern(v) for v in vals)
+        record_offsets.append(len(records) // RECORD_LEN)
+
+    string_offsets = array("I", [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode("utf-8")
+        string_offsets.append(len(blob))
+
+    sections = [string_offsets, asns, record_offsets, records]
+    if sys.byteorder != "little":
+        for section in sections:
+            section.byteswap()
+
+    tmp_path = output_path.with_suffix(".tmp")
+    with tmp_path.open("wb") as out_file:
+        out_file.write(
+            HEADER.pack(
+                MAGIC,
+                FORMAT_VERSION,
+                0,
+                len(strings),
+                len(asns),
+                len(records) // RECORD_LEN,
+                len(blob),
+            )
+        )
+        for section in sections:
+            section.tofile(out_file)
+        out_file.write(blob)
+    tmp_path.rename(output_path)
+
+
+class AsOrgTimeline:
+    def __init__(self, path: Path):
+        with open(path, "rb") as in_file:
+            self._mmap = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            _,
+            string_count,
+            asn_count,
+            record_count,
+            blob_size,
+        ) = HEADER.unpack_from(self._mmap)
+        assert magic == MAGIC, f"{path} is not an AS org timeline"
+        assert version == FORMAT_VERSION, f"unsupported version {version}"
+
+        self._buf = buf = memoryview(self._mmap)
+        offset = HEADER.size
+        self._string_offsets, offset = self._u32_section(buf, offset, string_count + 1)
+        self._asns, offset = self._u32_section(buf, offset, asn_count)
+        self._record_offsets, offset = self._u32_section(buf, offset, asn_count + 1)
+        self._records, offset = self._u32_section(
+            buf, offset, record_count * RECORD_LEN
+        )
+        self._blob = buf[offset : offset + blob_size]
+
+    @staticmethod
+    def _u32_section(buf: memoryview, offset: int, count: int):
+        end = offset + count * 4
+        if sys.byteorder == "little":
+            return buf[offset:end].cast("I"), end
+        section = array("I", buf[offset:end])
+        section.byteswap()
+        return section, end
+
+    def close(self):
+        for view in [
+            self._string_offsets,
+            self._asns,
+            self._record_offsets,
+            self._records,
+            self._blob,
+            self._buf,
+        ]:
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._asns)
+
+    def _string(self, idx: int) -> str:
+        start, end = self._string_offsets[idx], self._string_offsets[idx + 1]
+        return str(self._blob[start:end], "utf-8")
+
+    def _record_range(self, asn: int):
+        idx = bisect_left(self._asns, asn)
+        if idx == len(self._asns) or self._asns[idx] != asn:
+            return range(0)
+        return range(self._record_offsets[idx], self._record_offsets[idx + 1])
+
+    def history(self, asn: int) -> List[List[str]]:
+        history = []
+        for rec in self._record_range(asn):
+            base = rec * RECORD_LEN
+            history.append(
+                [self._string(self._records[base + i]) for i in range(RECORD_LEN)]
+            )
+        return history
+
+    def iter_histories(self) -> Iterator[Tuple[int, List[List[str]]]]:
+        for asn in self._asns:
+            yield asn, self.history(asn)
+
+    # Same semantics as getASMeta in enrich_country_db.go: returns the org
+    # name, org country and AS name that were valid on day.
+    def lookup(self, asn: int, day: Union[str, date]) -> Tuple[str, str, str]:
+        if isinstance(day, date):
+            day = day.strftime("%Y%m%d")
+
+        # See: https://datatracker.ietf.org/doc/html/rfc5398 & https://datatracker.ietf.org/doc/html/rfc6793
+        if (64496 <= asn <= 64511) or (65536 <= asn <= 65551):
+            return "Reserved for use in documentation and sample code", "ZZ", ""
+
+        # See: https://datatracker.ietf.org/doc/html/rfc1930 & https://datatracker.ietf.org/doc/html/rfc6996
+        if (64512 <= asn <= 65534) or (4200000000 <= asn <= 4294967294):
+            return "Reserved for private use", "ZZ", ""
+
+        # See: https://datatracker.ietf.org/doc/html/rfc7300
+        if asn == 65535 or (65552 <= asn <= 131071) or asn == 4294967295:
+            return "Reserved", "ZZ", ""
+
+        records = self._record_range(asn)
+        if len(records) == 0:
+            return "Unassigned", "ZZ", ""
+
+        # We take the last record that changed on or before day, falling back
+        # to the first one when they are all more recent.
+        meta = records[0] * RECORD_LEN
+        for rec in records:
+            base = rec * RECORD_LEN
+            if self._string(self._records[base + CHANGED_IDX]) > day:
+                break
+            meta = base
+        org_name, country, _, aut_name, _ = (
+            self._records[meta + i] for i in range(RECORD_LEN)
+        )
+        return self._string(org_name), self._string(country), self._string(aut_name)
+
+
+def main():
+    if len(sys.argv) != 4:
+        print("Usage: as_org_timeline.py all_as_org_map.bin ASN YYYYMMDD")
+        sys.exit(1)
+
+    with AsOrgTimeline(Path(sys.argv[1])) as timeline:
+        print("|".join(timeline.lookup(int(sys.argv[2]), sys.argv[3])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import sys
+import time
+import random
+
+from build_all_as_org_map import ASOrgMapMerger
+
+
+# The merge as it was originally implemented in build_all_as_org_map.main(),
+# kept around as a reference for both speed and output.
+def merge_as_org_map_legacy(all_as_org_map, as_org_map):
+    for asn, vals in as_org_map.items():
+        all_as_org_map[asn] = all_as_org_map.get(asn, [])
+        if vals not in all_as_org_map[asn]:
+            all_as_org_map[asn].append(vals)
+            all_as_org_map[asn] = sorted(all_as_org_map[asn], key=lambda x: x[2])
+
+            prev_item = all_as_org_map[asn][0]
+            dedupe_list = [prev_item]
+            for item in all_as_org_map[asn]:
+                if prev_item[:2] == item[:2]:
+                    continue
+                dedupe_list.append(item)
+                prev_item = item
+
+            all_as_org_map[asn] = dedupe_list
+
+
+# Generates monthly snapshots in the shape returned by build_asn_org_map. Most
+# ASNs keep their org, some change it over time and flip back and forth and a
+# few are re-registered with an older changed timestamp.
+def synthetic_snapshots(snapshot_count: int, asn_count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    state = {}
+    for asn in range(1, asn_count + 1):
+        state[asn] = [f"Org {asn}", "US", "20120101", f"AS-{asn}", "ARIN"]
+
+    snapshots = []
+    for idx in range(snapshot_count):
+        year, month = 2012 + idx // 12, idx % 12 + 1
+        day_str = f"{year}{month:02d}01"
+        for asn, vals in state.items():
+            r = rnd.random()
+            if r < 0.05:
+                org = f"Org {asn} {rnd.randint(0, 5)}"
+                state[asn] = [org, rnd.choice(["US", "IT", "DE"]), day_str] + vals[3:]
+            elif r < 0.06:
+                state[asn] = [f"Org {asn} old", "ZZ", "20110101"] + vals[3:]
+            elif r < 0.2:
+                state[asn] = vals[:2] + [day_str] + vals[3:]
+        snapshots.append({asn: list(vals) for asn, vals in state.items()})
+    return snapshots
+
+
+def main():
+    asn_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"[+] merging synthetic snapshots of {asn_count} ASNs")
+    print(f"{'snapshots':>10} {'legacy (s)':>12} {'merger (s)':>12} {'speedup':>8}")
+    for snapshot_count in [25, 50, 100, 150, 200]:
+        snapshots = synthetic_snapshots(snapshot_count, asn_count)
+
+        t0 = time.perf_counter()
+        legacy = {}
+        for as_org_map in snapshots:
+            merge_as_org_map_legacy(legacy, as_org_map)
+        legacy_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        merger = ASOrgMapMerger()
+        for as_org_map in snapshots:
+            merger.merge(as_org_map)
+        merger_time = time.perf_counter() - t0
+
+        merged = {
+            asn: [list(vals) for vals in history]
+            for asn, history in merger.as_org_map().items()
+        }
+        assert merged == legacy, "merger output differs from the legacy merge"
+        print(
+            f"{snapshot_count:>10} {legacy_time:>12.2f} {merger_time:>12.2f} {legacy_time / merger_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import sys
+import time
+import random
+import ipaddress
+from pathlib import Path
+
+from bulk_lookup import bulk_lookup
+from historical_geoip import HistoricalGeoIP, index_databases, to_geoip_result
+
+
+# Random (ip, date) rows in random date order, the way rows show up in the
+# measurements we annotate.
+def synthetic_rows(outputs_dir: Path, row_count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    databases = index_databases(outputs_dir)
+    assert databases, f"no databases found in {outputs_dir}"
+    ips, days = [], []
+    for _ in range(row_count):
+        if rnd.random() < 0.8:
+            ips.append(str(ipaddress.IPv4Address(rnd.randint(2**24, 2**32 - 1))))
+        else:
+            ips.append(str(ipaddress.IPv6Address(rnd.randint(2**125, 2**126))))
+        days.append(rnd.choice(databases).day.strftime("%Y%m%d"))
+    return ips, days
+
+
+def main():
+    outputs_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("outputs")
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    ips, days = synthetic_rows(outputs_dir, row_count)
+    print(f"[+] looking up {row_count} rows in {outputs_dir}")
+
+    t0 = time.perf_counter()
+    with HistoricalGeoIP(outputs_dir, max_open=2) as geoip:
+        naive = [to_geoip_result(geoip.lookup(ip, day)) for ip, day in zip(ips, days)]
+    naive_time = time.perf_counter() - t0
+    print(f"    naive loop: {row_count / naive_time:,.0f} rows/s")
+
+    for jobs in [1, 4]:
+        t0 = time.perf_counter()
+        results = bulk_lookup(ips, days, outputs_dir=outputs_dir, jobs=jobs)
+        bulk_time = time.perf_counter() - t0
+        assert results == naive, "bulk lookup results differ from the naive loop"
+        print(f"    bulk lookup, {jobs} jobs: {row_count / bulk_time:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import sys
+import gzip
+import time
+import tempfile
+import tracemalloc
+from array import array
+from pathlib import Path
+
+from build_all_as_org_map import (
+    build_asn_org_map,
+    iter_packed_snapshot,
+    parse_snapshot,
+)
+from synthetic_fixtures import write_as_org_snapshot
+
+
+# parse_snapshot as it was before the streaming parser: the text based
+# build_asn_org_map followed by packing its result.
+def parse_snapshot_legacy(fn: Path):
+    day_str = fn.name.split(".")[0]
+    with gzip.open(fn, "rt", encoding="utf-8") as in_file:
+        as_org_map = build_asn_org_map(in_file, day_str)
+
+    strings = {}
+    rows = array("I")
+    for asn, vals in as_org_map.items():
+        rows.append(asn)
+        for v in vals:
+            rows.append(strings.setdefault(v, len(strings)))
+    return list(strings), rows
+
+
+def measure(func, fn: Path):
+    t0 = time.perf_counter()
+    func(fn)
+    elapsed = time.perf_counter() - t0
+
+    tracemalloc.start()
+    result = func(fn)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    asn_count = int(sys.argv[1]) if len(sys.argv) > 1 else 120_000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fn = Path(tmp_dir) / "20230101.as-org2info.txt.gz"
+        write_as_org_snapshot(fn, "20230101", asn_count, org_count=asn_count)
+        print(f"[+] parsing a synthetic snapshot of {asn_count} ASNs")
+
+        legacy, legacy_time, legacy_peak = measure(parse_snapshot_legacy, fn)
+        streaming, streaming_time, streaming_peak = measure(parse_snapshot, fn)
+
+    assert list(iter_packed_snapshot(legacy)) == list(
+        iter_packed_snapshot(streaming)
+    ), "streaming parser output differs from build_asn_org_map"
+    print(f"{'':>10} {'time (s)':>10} {'peak (MiB)':>11}")
+    print(f"{'legacy':>10} {legacy_time:>10.2f} {legacy_peak / 2**20:>11.1f}")
+    print(f"{'streaming':>10} {streaming_time:>10.2f} {streaming_peak / 2**20:>11.1f}")
+    print(
+        f"    {legacy_time / streaming_time:.1f}x faster,"
+        f" {legacy_peak / streaming_peak:.1f}x less memory"
+    )
+
+
+if __name__ == "__main__":
+    main()
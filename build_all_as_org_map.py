@@ -1,12 +1,26 @@
+import argparse
 import gzip
+import hashlib
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from collections import namedtuple
 import json
 from pathlib import Path
 
+from as_org_timeline import write_as_org_timeline
+from download_assets import file_sha256_hexdigest
+from instrumentation import add_bytes, run_stage, span
 
 ASInfo = namedtuple("ASInfo", ["asn", "changed", "aut_name", "source", "org_id"])
 
+# Bump this whenever the layout of the state file or the way snapshots are
+# merged changes, so that stale state forces a full rebuild.
+STATE_VERSION = 1
 
+
+# Text based reference implementation, parse_snapshot uses the equivalent
+# pack_asn_org_map below.
 def build_asn_org_map(in_file, day_str):
     as_list = []
 
@@ -73,44 +87,282 @@ def build_asn_org_map(in_file, day_str):
     return asn_org_map
 
 
+# Streaming, bytes level version of build_asn_org_map which packs its result
+# into a string table and a flat array of ASNs and string indexes.
+#
+# The org section of a snapshot always comes before the aut one, so every AS
+# is resolved as soon as it's read rather than being buffered until the end.
+# Strings are interned as bytes and only decoded once, when the table is
+# returned, and org names are only added to it when an AS refers to them.
+def pack_asn_org_map(in_file, day_str: str):
+    strings = {}
+    values = []
+
+    def intern(b: bytes) -> int:
+        idx = strings.get(b)
+        if idx is None:
+            idx = strings[b] = len(values)
+            values.append(b)
+        return idx
+
+    org_id_to_name = {}
+    rows = array("I")
+    asn_rows = {}
+    default_changed = day_str.encode("ascii")
+
+    is_in_asn_section = False
+    for line in in_file:
+        line = line.strip()
+
+        if line.startswith(b"# format:aut"):
+            is_in_asn_section = True
+
+        if line.startswith(b"#") or line == b"":
+            continue
+
+        if not is_in_asn_section:
+            # Most of the memory goes to the orgs, so we keep each one as its
+            # line and only split it when an AS refers to it.
+            org_id = line[: line.index(b"|")]
+            assert org_id not in org_id_to_name
+            org_id_to_name[org_id] = line
+            continue
+
+        chunks = line.split(b"|")
+        asn = int(chunks[0])
+        changed = chunks[1] or default_changed
+        try:
+            org_chunks = org_id_to_name[chunks[3]].split(b"|")
+        except KeyError:
+            print(f"failed to lookup {line}")
+            raise
+        org_name, country = org_chunks[2], org_chunks[3]
+
+        row = [
+            asn,
+            intern(org_name),
+            intern(country),
+            intern(changed),
+            intern(chunks[2]),
+            intern(chunks[-1]),
+        ]
+        # An ASN can appear multiple times, if it's present in multiple RIRs
+        offset = asn_rows.get(asn)
+        if offset is None:
+            asn_rows[asn] = len(rows)
+            rows.extend(row)
+            continue
+
+        assert row[1] == rows[offset + 1]
+        # We keep the data from the registry that has the freshest data
+        if changed < values[rows[offset + 3]]:
+            continue
+        rows[offset : offset + len(row)] = array("I", row)
+
+    # Strings are decoded in place, after dropping everything else we built,
+    # so that the bytes and str versions of the table don't all coexist.
+    del strings, org_id_to_name, asn_rows
+    for idx, value in enumerate(values):
+        values[idx] = value.decode("utf-8")
+    return values, rows
+
+
+# Parses a single snapshot into the packed form above, which is also a lot
+# cheaper to send back from a worker process than a dict of lists of strings.
+def parse_snapshot(fn: Path):
+    day_str = fn.name.split(".")[0]
+    with gzip.open(fn, "rb") as in_file:
+        return pack_asn_org_map(in_file, day_str)
+
+
+def iter_packed_snapshot(packed):
+    strings, rows = packed
+    # Every row is the ASN followed by the indexes of org name, country,
+    # changed, AS name and source
+    row_len = 6
+    for idx in range(0, len(rows), row_len):
+        yield rows[idx], [strings[i] for i in rows[idx + 1 : idx + row_len]]
+
+
+# Yields the parsed snapshots in the same order as fns, so that the merged
+# output does not depend on the number of workers.
+def iter_parsed_snapshots(fns, jobs: int):
+    if jobs <= 1:
+        yield from map(parse_snapshot, fns)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(parse_snapshot, fns)
+
+
+class ASOrgMapMerger:
+    # Keeps the history of every ASN sorted by the changed timestamp, with
+    # consecutive entries that have the same org name and country collapsed
+    # into the first one.
+    #
+    # Collapsing drops entries, so the result depends on the order in which
+    # values are added and we can't just collect everything and sort it once.
+    # Instead we keep the invariant on every insertion: values almost always
+    # arrive in timestamp order and are appended in O(1), the rare older value
+    # is bisected into place and only its neighbours need to be looked at.
+    # A set per ASN replaces the linear membership scan.
+    def __init__(self):
+        self.histories = {}
+        self.seen = {}
+
+    @classmethod
+    def from_as_org_map(cls, all_as_org_map):
+        merger = cls()
+        for asn, history in all_as_org_map.items():
+            merger.histories[asn] = [tuple(vals) for vals in history]
+            merger.seen[asn] = set(merger.histories[asn])
+        return merger
+
+    def add(self, asn, vals):
+        vals = tuple(vals)
+        history = self.histories.get(asn)
+        if history is None:
+            self.histories[asn] = [vals]
+            self.seen[asn] = {vals}
+            return
+
+        seen = self.seen[asn]
+        if vals in seen:
+            return
+
+        changed = vals[2]
+        if changed >= history[-1][2]:
+            idx = len(history)
+        else:
+            # Equal timestamps keep their insertion order
+            idx = bisect_right(history, changed, key=lambda x: x[2])
+
+        if idx > 0 and history[idx - 1][:2] == vals[:2]:
+            return
+
+        history.insert(idx, vals)
+        seen.add(vals)
+        if idx + 1 < len(history) and history[idx + 1][:2] == vals[:2]:
+            seen.discard(history.pop(idx + 1))
+
+    def merge(self, as_org_map):
+        for asn, vals in as_org_map.items():
+            self.add(asn, vals)
+
+    def as_org_map(self):
+        return self.histories
+
+
+# Returns the previously built map together with the snapshots that have been
+# folded into it, or an empty merger when the previous build can't be safely
+# extended and we need to start from scratch.
+def load_previous_build(output_path: Path, state_path: Path, snapshot_digests: dict):
+    if not state_path.exists() or not output_path.exists():
+        return ASOrgMapMerger(), {}
+
+    with state_path.open() as in_file:
+        state = json.load(in_file)
+    if state.get("version") != STATE_VERSION:
+        print("    state version changed, doing a full rebuild")
+        return ASOrgMapMerger(), {}
+
+    if file_sha256_hexdigest(output_path) != state["output_sha256"]:
+        print(f"    {output_path} was modified, doing a full rebuild")
+        return ASOrgMapMerger(), {}
+
+    processed = state["snapshots"]
+    for name, digest in processed.items():
+        if snapshot_digests.get(name) != digest:
+            print(f"    snapshot {name} changed or went away, doing a full rebuild")
+            return ASOrgMapMerger(), {}
+
+    # Snapshots are folded in name (ie. date) order and the merge is not
+    # commutative, so we can only append snapshots that sort after the ones
+    # that have already been processed.
+    last_processed = max(processed, default="")
+    for name in snapshot_digests:
+        if name not in processed and name < last_processed:
+            print(
+                f"    snapshot {name} is older than {last_processed}, doing a full rebuild"
+            )
+            return ASOrgMapMerger(), {}
+
+    with output_path.open() as in_file:
+        all_as_org_map = {int(asn): vals for asn, vals in json.load(in_file).items()}
+    return ASOrgMapMerger.from_as_org_map(all_as_org_map), processed
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the previous build and reprocess every snapshot",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes used to parse snapshots",
+    )
+    args = parser.parse_args()
+
     input_dir = Path("cache_dir") / "as-organizations"
     output_dir = Path("outputs")
     output_dir.mkdir(parents=True, exist_ok=True)
 
     output_path = output_dir / "all_as_org_map.json"
+    state_path = output_dir / "all_as_org_map.state.json"
+    timeline_path = output_dir / "all_as_org_map.bin"
 
     print("[+] Building AS Organization map")
-    all_as_org_map = {}
-    for fn in sorted(input_dir.glob("*.txt.gz")):
-        day_str = fn.name.split(".")[0]
-
-        with gzip.open(fn, "rt", encoding="utf-8") as in_file:
-            as_org_map = build_asn_org_map(in_file, day_str)
-            for asn, vals in as_org_map.items():
-                all_as_org_map[asn] = all_as_org_map.get(asn, [])
-                if vals not in all_as_org_map[asn]:
-                    all_as_org_map[asn].append(vals)
-                    all_as_org_map[asn] = sorted(
-                        all_as_org_map[asn], key=lambda x: x[2]
-                    )
-
-                    # We remove duplicate items from the list, we only keep the
-                    # first identical value given a certain timestamp
-                    prev_item = all_as_org_map[asn][0]
-                    dedupe_list = [prev_item]
-                    for item in all_as_org_map[asn]:
-                        if prev_item[:2] == item[:2]:
-                            continue
-                        dedupe_list.append(item)
-                        prev_item = item
-
-                    all_as_org_map[asn] = dedupe_list
+    snapshots = sorted(input_dir.glob("*.txt.gz"))
+    snapshot_digests = {fn.name: file_sha256_hexdigest(fn) for fn in snapshots}
+
+    merger, processed = ASOrgMapMerger(), {}
+    if not args.full:
+        merger, processed = load_previous_build(
+            output_path, state_path, snapshot_digests
+        )
+
+    pending = [fn for fn in snapshots if fn.name not in processed]
+    print(f"    {len(processed)} snapshots already merged, {len(pending)} to merge")
+    if processed and not pending and timeline_path.exists():
+        return
+
+    with span("merge_snapshots", snapshots=len(pending)):
+        for fn, packed in zip(pending, iter_parsed_snapshots(pending, args.jobs)):
+            print(f"    merging {fn.name}")
+            add_bytes("read", fn.stat().st_size)
+            for asn, vals in iter_packed_snapshot(packed):
+                merger.add(asn, vals)
 
     print(f"writing {output_path}")
-    with output_path.open("w") as out_file:
-        json.dump(all_as_org_map, out_file, sort_keys=True)
+    output_bytes = json.dumps(merger.as_org_map(), sort_keys=True).encode("ascii")
+    tmp_path = output_path.with_suffix(".tmp")
+    with tmp_path.open("wb") as out_file:
+        out_file.write(output_bytes)
+    tmp_path.rename(output_path)
+    add_bytes("written", len(output_bytes))
+
+    with state_path.open("w") as out_file:
+        json.dump(
+            {
+                "version": STATE_VERSION,
+                "output_sha256": hashlib.sha256(output_bytes).hexdigest(),
+                "snapshots": snapshot_digests,
+            },
+            out_file,
+            sort_keys=True,
+            indent=2,
+        )
+
+    print(f"writing {timeline_path}")
+    with span("write_timeline"):
+        write_as_org_timeline(merger.as_org_map(), timeline_path)
+    add_bytes("written", timeline_path.stat().st_size)
 
 
 if __name__ == "__main__":
-    main()
+    with run_stage("build_all_as_org_map"):
+        main()
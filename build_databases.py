@@ -0,0 +1,369 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Set
+
+from compress import (
+    CODEC_SUFFIXES,
+    COMPRESS_WORKERS,
+    codec_available,
+    compress_file,
+)
+from decompress import decompress_all, record_decompressed
+from digest_manifest import default_manifest
+from instrumentation import add_bytes, record_span, run_stage, span
+from input_fingerprints import (
+    as_org_slice_digests,
+    enricher_digest,
+    input_fingerprint,
+    load_fingerprint,
+    write_fingerprint,
+)
+from mmdb_delta import create_delta, current_delta_header, delta_path, write_delta
+from mmdb_tree import MMDBTree
+from validate_database import validate_tree
+
+# Builds the enriched ip2country_as databases for every country database we
+# have, replacing the serial loop that used to live in
+# build_country_asn_databases.sh. The enricher is compiled once and every date
+# is built, validated and compressed as an independent job.
+
+ENRICHER_PATH = Path("build") / "enrich_country_db"
+OUTPUTS_DIR = Path("outputs")
+AS_ORG_TIMELINE_PATH = OUTPUTS_DIR / "all_as_org_map.bin"
+
+# fingerprint is written next to the output once it's built, see
+# input_fingerprints.py
+BuildJob = namedtuple(
+    "BuildJob", ["day_str", "db_path", "output_path", "fingerprint"], defaults=[None]
+)
+# compressed lists the compress.Compressed of every compressed copy of the output
+BuildResult = namedtuple(
+    "BuildResult", ["job", "ok", "attempts", "duration", "error", "compressed"]
+)
+
+
+def day_str_maxmind(filename: str) -> str:
+    # GeoLite2-Country_20180206.mmdb
+    return filename.split(".")[0].split("_")[1]
+
+
+def day_str_dbip(filename: str) -> str:
+    # dbip-country-lite-2020-02.mmdb
+    return "".join(filename.split(".")[0].split("-")[3:5]) + "01"
+
+
+def list_country_dbs() -> List[BuildJob]:
+    jobs = []
+    for db_dir, day_str_func in [
+        (Path("cache_dir") / "maxmind-geolite2-country", day_str_maxmind),
+        (Path("cache_dir") / "dbip-country-lite", day_str_dbip),
+    ]:
+        for fn in sorted(db_dir.glob("*mmdb.gz")):
+            db_path = fn.with_suffix("")
+            day_str = day_str_func(db_path.name)
+            output_path = OUTPUTS_DIR / f"{day_str}-ip2country_as.mmdb"
+            jobs.append(
+                BuildJob(day_str=day_str, db_path=db_path, output_path=output_path)
+            )
+    return jobs
+
+
+def compile_enricher():
+    print(f"[+] compiling {ENRICHER_PATH}")
+    ENRICHER_PATH.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        ["go", "build", "-o", str(ENRICHER_PATH), "enrich_country_db.go"], check=True
+    )
+
+
+def mem_available() -> int:
+    try:
+        with open("/proc/meminfo") as in_file:
+            for line in in_file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+# Every enricher process loads the AS org map and the country database in
+# memory, so we don't run more of them than fit in the available memory.
+def worker_count(job_memory: int) -> int:
+    by_memory = mem_available() // job_memory
+    return max(1, min(os.cpu_count() or 1, by_memory))
+
+
+def build_one(job: BuildJob, extra_codecs: List[str], compress_workers: int) -> list:
+    # The database is built under a temporary name, so that a failed build
+    # never leaves behind something that looks like a finished output.
+    tmp_path = job.output_path.with_name(job.output_path.name + ".tmp")
+    subprocess.run(
+        [
+            str(ENRICHER_PATH),
+            f"-dayStr={job.day_str}",
+            f"-dbFile={job.db_path}",
+            f"-outputFile={tmp_path}",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    with MMDBTree(tmp_path) as tree:
+        validate_tree(tree)
+    tmp_path.rename(job.output_path)
+    # The .gz is what we always publish, other codecs are optional extras
+    compressed = [
+        compress_file(job.output_path, codec, workers=compress_workers)
+        for codec in ["gzip"] + extra_codecs
+    ]
+    if job.fingerprint is not None:
+        write_fingerprint(job.output_path, job.fingerprint)
+    return compressed
+
+
+def run_job(
+    job: BuildJob, retries: int, extra_codecs: List[str], compress_workers: int
+) -> BuildResult:
+    t0 = time.monotonic()
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            compressed = build_one(job, extra_codecs, compress_workers)
+            return BuildResult(
+                job, True, attempt, time.monotonic() - t0, None, compressed
+            )
+        except subprocess.CalledProcessError as exc:
+            output = exc.stdout.decode("utf-8", "replace") if exc.stdout else ""
+            error = f"{exc}\n{output[-2000:]}"
+        except Exception as exc:
+            error = repr(exc)
+    return BuildResult(job, False, retries + 1, time.monotonic() - t0, error, [])
+
+
+def delta_is_current(base_path: Path, new_path: Path) -> bool:
+    header = current_delta_header(new_path)
+    return header is not None and header["base"]["filename"] == base_path.name
+
+
+# Deltas are written against the output of the previous date, see
+# mmdb_delta.py, for the latest output, which is the one latest.yml points
+# consumers to, and for the outputs built in this run. Each one takes a few
+# walks over both trees, so deltas for the rest of the history are left as
+# they are. Only the ones that are missing, or were made from databases that
+# have been rebuilt since, are written.
+def list_delta_jobs(jobs: List[BuildJob], built: Set[Path]) -> List[tuple]:
+    outputs = sorted(
+        (job.output_path for job in jobs if job.output_path.exists()),
+        key=lambda p: p.name,
+    )
+    return [
+        (base_path, new_path)
+        for base_path, new_path in zip(outputs, outputs[1:])
+        if (new_path == outputs[-1] or new_path in built)
+        and not delta_is_current(base_path, new_path)
+    ]
+
+
+def build_delta(base_path: Path, new_path: Path) -> float:
+    t0 = time.monotonic()
+    # The previous delta goes first, so that if writing this one fails we
+    # don't publish a delta to a database that no longer exists.
+    delta_path(new_path).unlink(missing_ok=True)
+    write_delta(create_delta(base_path, new_path), delta_path(new_path))
+    # This runs in a worker process, which doesn't flush at exit
+    default_manifest().flush()
+    return time.monotonic() - t0
+
+
+def write_deltas(jobs: List[BuildJob], built: Set[Path], workers: int):
+    delta_jobs = list_delta_jobs(jobs, built)
+    if not delta_jobs:
+        return
+    print(f"[+] writing {len(delta_jobs)} deltas with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(build_delta, base_path, new_path): new_path
+            for base_path, new_path in delta_jobs
+        }
+        for future in as_completed(futures):
+            new_path = futures[future]
+            # Deltas are only an optimization for consumers, so failing to
+            # write one doesn't fail the build.
+            try:
+                duration = future.result()
+            except Exception as exc:
+                print(f"    failed to write the delta of {new_path}: {exc!r}")
+                delta_path(new_path).unlink(missing_ok=True)
+                continue
+            record_span("delta", duration, output=new_path.name)
+            add_bytes("written", delta_path(new_path).stat().st_size)
+            print(f"    wrote {delta_path(new_path)} in {duration:.0f}s")
+
+
+def should_skip(job: BuildJob, mode: str) -> bool:
+    if not job.output_path.exists():
+        return False
+    if mode == "skip_existing":
+        return True
+    # Without a fingerprint on either side we can't tell whether the inputs
+    # changed, so the output is rebuilt
+    return (
+        mode == "skip_unchanged"
+        and job.fingerprint is not None
+        and load_fingerprint(job.output_path) == job.fingerprint
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds the ip2country_as databases for every country database"
+    )
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        default="",
+        help="skip_existing skips dates that already have an output, "
+        "skip_unchanged the ones whose inputs didn't change since they were built",
+    )
+    parser.add_argument("--jobs", type=int, help="defaults to what fits in memory")
+    parser.add_argument(
+        "--job-memory-gb",
+        type=float,
+        default=3.0,
+        help="memory needed by a single enricher process",
+    )
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument(
+        "--extra-codecs",
+        default="",
+        help="comma separated codecs to also compress the outputs with, besides"
+        f" gzip, out of {', '.join(c for c in CODEC_SUFFIXES if c != 'gzip')}",
+    )
+    parser.add_argument(
+        "--no-deltas",
+        action="store_true",
+        help="don't write the deltas between consecutive outputs",
+    )
+    args = parser.parse_args()
+    extra_codecs = [c for c in args.extra_codecs.split(",") if c]
+    for codec in extra_codecs:
+        assert codec in CODEC_SUFFIXES and codec != "gzip", f"unknown codec {codec}"
+        # Checked here rather than after every output was built
+        if not codec_available(codec):
+            print(f"[-] can't compress with {codec}, it needs the zstandard package")
+            sys.exit(1)
+
+    print("[+] Building GeoIP enriched databases")
+    OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
+    decompress_all(
+        list((Path("cache_dir") / "maxmind-geolite2-country").glob("*.mmdb.gz"))
+        + list((Path("cache_dir") / "dbip-country-lite").glob("*.mmdb.gz"))
+    )
+
+    all_jobs = list_country_dbs()
+    if all_jobs and AS_ORG_TIMELINE_PATH.exists():
+        slices = as_org_slice_digests(
+            AS_ORG_TIMELINE_PATH, [job.day_str for job in all_jobs]
+        )
+        enricher = enricher_digest()
+        all_jobs = [
+            job._replace(
+                fingerprint=input_fingerprint(
+                    job.day_str, job.db_path, slices[job.day_str], enricher
+                )
+            )
+            for job in all_jobs
+        ]
+
+    jobs = []
+    for job in all_jobs:
+        if should_skip(job, args.mode):
+            print(f"    skipping {job.output_path}")
+            continue
+        jobs.append(job)
+
+    failed = []
+    built = set()
+    # (.gz, .mmdb) of the outputs built in this run
+    compressed_outputs = []
+    if jobs:
+        with span("compile_enricher"):
+            compile_enricher()
+        workers = args.jobs or worker_count(int(args.job_memory_gb * 2**30))
+        print(f"[+] building {len(jobs)} databases with {workers} workers")
+        # Every worker compresses its own outputs, so the compression threads
+        # are shared between them rather than each one starting as many
+        # threads as there are cores.
+        compress_workers = max(1, COMPRESS_WORKERS // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    run_job, job, args.retries, extra_codecs, compress_workers
+                )
+                for job in jobs
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                record_span(
+                    "build",
+                    result.duration,
+                    day=result.job.day_str,
+                    ok=result.ok,
+                    attempts=result.attempts,
+                )
+                if result.ok:
+                    built.add(result.job.output_path)
+                    add_bytes("read", result.job.db_path.stat().st_size)
+                    add_bytes("written", result.job.output_path.stat().st_size)
+                for compressed in result.compressed:
+                    ratio = compressed.size / max(compressed.compressed_size, 1)
+                    record_span(
+                        "compress",
+                        compressed.duration,
+                        day=result.job.day_str,
+                        codec=compressed.codec,
+                        ratio=round(ratio, 3),
+                    )
+                    add_bytes("written", compressed.compressed_size)
+                    if compressed.codec == "gzip":
+                        compressed_outputs.append(
+                            (compressed.path, result.job.output_path)
+                        )
+                status = "built" if result.ok else "FAILED"
+                print(
+                    f"    {status} {result.job.output_path} in {result.duration:.0f}s"
+                    f" ({result.attempts} attempts)"
+                )
+                if not result.ok:
+                    print(result.error)
+                    failed.append(result.job)
+        # The next run doesn't need to inflate the .gz of these again
+        record_decompressed(compressed_outputs)
+
+    if not args.no_deltas:
+        write_deltas(all_jobs, built, args.jobs or os.cpu_count() or 1)
+
+    latest_date = all_jobs[-1].day_str if all_jobs else ""
+    github_env = os.environ.get("GITHUB_ENV")
+    if github_env:
+        with open(github_env, "a") as out_file:
+            out_file.write(f"LATEST_DATE={latest_date}\n")
+    print(f"[+] Latest dataset date: {latest_date}")
+
+    if failed:
+        print(f"[-] failed to build {len(failed)} databases")
+        for job in failed:
+            print(f"    {job.day_str}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    with run_stage("build_databases"):
+        main()
@@ -0,0 +1,201 @@
+import csv
+import sys
+import argparse
+import ipaddress
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+import maxminddb
+
+from historical_geoip import (
+    GeoIPResult,
+    HistoricalGeoIP,
+    Timestamp,
+    to_geoip_result,
+)
+
+# Number of rows read and planned at a time
+BATCH_SIZE = 500_000
+# Number of rows sent to a worker in one go
+CHUNK_SIZE = 50_000
+# Chunks submitted to every worker process and not yet collected
+MAX_IN_FLIGHT = 2
+# Readers kept open by every worker process
+WORKER_MAX_OPEN = 4
+
+_worker_readers = OrderedDict()
+
+
+def _worker_reader(path: str) -> maxminddb.Reader:
+    reader = _worker_readers.get(path)
+    if reader is not None:
+        _worker_readers.move_to_end(path)
+        return reader
+
+    while len(_worker_readers) >= WORKER_MAX_OPEN:
+        _worker_readers.popitem(last=False)[1].close()
+    reader = maxminddb.open_database(path, maxminddb.MODE_AUTO)
+    _worker_readers[path] = reader
+    return reader
+
+
+# A looked up row: result is None when the address isn't in the database and
+# error says why the row couldn't be looked up at all.
+LookupRow = namedtuple("LookupRow", ["ip", "day", "result", "error"])
+
+
+# Returns a (result, error) pair for every address, in the same order. The
+# addresses are looked up sorted, so that consecutive lookups walk the same
+# parts of the search tree.
+def lookup_chunk(path: Optional[str], ips: List[str]) -> List[tuple]:
+    if not ips:
+        return []
+    reader = _worker_reader(path)
+    results = [None] * len(ips)
+    order = []
+    for pos, ip in enumerate(ips):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            results[pos] = (None, f"invalid ip {ip!r}")
+            continue
+        order.append((addr.version, int(addr), pos))
+    order.sort()
+    for _, _, pos in order:
+        results[pos] = (to_geoip_result(reader.get(ips[pos])), None)
+    return results
+
+
+def iter_batches(rows: Iterable[tuple], batch_size: int) -> Iterator[List[tuple]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+# Splits a batch of (ip, day) rows into chunks that only touch a single
+# database. Rows with a date we can't parse are answered right away, every
+# other row is left to the worker that gets its chunk.
+def plan_batch(geoip: HistoricalGeoIP, batch: List[tuple]):
+    db_for_ts = {}
+    rows_by_db = defaultdict(lambda: ([], []))
+    for pos, (ip, ts) in enumerate(batch):
+        path = db_for_ts.get(ts)
+        if path is None:
+            try:
+                path = db_for_ts[ts] = str(geoip.database_for(ts).path)
+            except (ValueError, TypeError):
+                batch[pos] = LookupRow(ip, ts, None, f"invalid date {ts!r}")
+                continue
+        positions, ips = rows_by_db[path]
+        positions.append(pos)
+        ips.append(ip)
+
+    chunks = []
+    for path in sorted(rows_by_db):
+        positions, ips = rows_by_db[path]
+        for start in range(0, len(ips), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            chunks.append((path, positions[start:end], ips[start:end]))
+    return chunks
+
+
+# Yields (batch, positions, results, is_last) for every chunk, in the order
+# they were planned. Batches are read and planned as the workers need more
+# work, with at most MAX_IN_FLIGHT chunks per worker submitted at any time.
+def iter_chunk_results(geoip: HistoricalGeoIP, rows: Iterable[tuple], jobs: int):
+    def iter_tasks():
+        for batch in iter_batches(rows, BATCH_SIZE):
+            chunks = plan_batch(geoip, batch)
+            if not chunks:
+                yield batch, [], None, [], True
+            for idx, (path, positions, ips) in enumerate(chunks):
+                yield batch, positions, path, ips, idx == len(chunks) - 1
+
+    if jobs <= 1:
+        for batch, positions, path, ips, is_last in iter_tasks():
+            yield batch, positions, lookup_chunk(path, ips), is_last
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for batch, positions, path, ips, is_last in iter_tasks():
+            future = executor.submit(lookup_chunk, path, ips)
+            pending.append((batch, positions, future, is_last))
+            if len(pending) >= MAX_IN_FLIGHT * jobs:
+                batch, positions, future, is_last = pending.popleft()
+                yield batch, positions, future.result(), is_last
+        while pending:
+            batch, positions, future, is_last = pending.popleft()
+            yield batch, positions, future.result(), is_last
+
+
+# Looks up every (ip, day) row in the database in effect on that day and
+# yields a LookupRow for each of them, in the same order. Rows are consumed
+# lazily and results come out a batch at a time, so memory use doesn't depend
+# on the number of rows.
+def iter_bulk_lookup(
+    rows: Iterable[tuple], outputs_dir: Path = Path("outputs"), jobs: int = 1
+) -> Iterator[LookupRow]:
+    with HistoricalGeoIP(outputs_dir) as geoip:
+        for batch, positions, results, is_last in iter_chunk_results(geoip, rows, jobs):
+            for pos, (result, error) in zip(positions, results):
+                ip, ts = batch[pos]
+                batch[pos] = LookupRow(ip, ts, result, error)
+            if is_last:
+                yield from batch
+
+
+# Same as iter_bulk_lookup for the pairs (ips[i], days[i]), returning just the
+# results. The inputs can be any sequences, such as the columns of a
+# dataframe. Rows that can't be looked up get None, like missing addresses.
+def bulk_lookup(
+    ips: Sequence[str],
+    days: Sequence[Timestamp],
+    outputs_dir: Path = Path("outputs"),
+    jobs: int = 1,
+) -> List[Optional[GeoIPResult]]:
+    assert len(ips) == len(days), "ips and days must have the same length"
+    return [
+        row.result
+        for row in iter_bulk_lookup(zip(ips, days), outputs_dir=outputs_dir, jobs=jobs)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Annotates a CSV of ip,date rows with country and ASN"
+    )
+    parser.add_argument("input_csv", help="CSV file with ip and date columns")
+    parser.add_argument("output_csv")
+    parser.add_argument("--outputs-dir", type=Path, default=Path("outputs"))
+    parser.add_argument("--jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    row_count, invalid_count = 0, 0
+    with open(args.input_csv, newline="") as in_file, open(
+        args.output_csv, "w", newline=""
+    ) as out_file:
+        rows = ((row["ip"], row["date"]) for row in csv.DictReader(in_file))
+        writer = csv.writer(out_file)
+        writer.writerow(["ip", "date"] + list(GeoIPResult._fields) + ["error"])
+        for row in iter_bulk_lookup(rows, outputs_dir=args.outputs_dir, jobs=args.jobs):
+            result = row.result
+            if result is None:
+                result = [""] * len(GeoIPResult._fields)
+            writer.writerow([row.ip, row.day] + list(result) + [row.error or ""])
+            row_count += 1
+            if row.error is not None:
+                invalid_count += 1
+                print(f"    skipping row {row_count}: {row.error}", file=sys.stderr)
+
+    print(f"[+] looked up {row_count} rows, {invalid_count} invalid", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
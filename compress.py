@@ -0,0 +1,250 @@
+import os
+import gzip
+import lzma
+import time
+import zlib
+import shutil
+import struct
+import argparse
+from collections import deque, namedtuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compresses files in independent chunks on a pool of threads (zlib, lzma and
+# zstandard release the GIL while they work), so that a single large output
+# is compressed using every core:
+#
+#   gzip    a gzip member per chunk, which together are a valid .gz file that
+#           any gzip reader inflates as a whole
+#   xz      an xz stream per chunk, likewise valid as a whole
+#   zstd    a zstd frame per chunk, needs the optional zstandard package
+#
+# Every gzip member records its own size in an extra field of its header, so
+# that decompress_file can find the members without inflating them and inflate
+# them in parallel too. Other .gz files, eg. the ones we download, are
+# inflated as a single stream. xz and zstd files are always inflated as a
+# single stream.
+#
+# Members are written with a zero mtime, so compressing the same file twice
+# gives the same bytes and unchanged outputs keep their digest.
+
+CHUNK_SIZE = 8 * 2**20
+COMPRESS_WORKERS = int(os.environ.get("COMPRESS_WORKERS", os.cpu_count() or 1))
+CODEC_SUFFIXES = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+DEFAULT_LEVELS = {"gzip": 6, "xz": 6, "zstd": 12}
+
+# The gzip header of a member: magic, deflate, FEXTRA, zero mtime, no extra
+# flags, unknown OS, then the extra field with a single MEMBER_SIZE_SUBFIELD
+# holding the size of the whole member as a little endian uint64.
+MEMBER_SIZE_SUBFIELD = b"MS"
+GZIP_HEADER_PREFIX = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff"
+GZIP_EXTRA = struct.pack("<H", 12) + MEMBER_SIZE_SUBFIELD + struct.pack("<H", 8)
+GZIP_HEADER_SIZE = len(GZIP_HEADER_PREFIX) + len(GZIP_EXTRA) + 8
+GZIP_TRAILER_SIZE = 8
+
+Compressed = namedtuple(
+    "Compressed", ["path", "codec", "size", "compressed_size", "duration"]
+)
+
+
+def codec_for(path: Path) -> str:
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if path.suffix == suffix:
+            return codec
+    raise ValueError(f"unknown compression format for {path}")
+
+
+# Like executor.map, but with at most window items in flight, so memory use
+# doesn't grow with the size of the file.
+def _ordered_map(
+    executor: Executor, func: Callable, items: Iterable, window: int
+) -> Iterator:
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _read_chunks(path: Path, chunk_size: int) -> Iterator[bytes]:
+    with path.open("rb") as in_file:
+        chunk = in_file.read(chunk_size)
+        # Empty files still get a member, an empty .gz is not a valid one
+        yield chunk
+        while True:
+            chunk = in_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def gzip_member(chunk: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(chunk) + compressor.flush()
+    member_size = GZIP_HEADER_SIZE + len(body) + GZIP_TRAILER_SIZE
+    return b"".join(
+        [
+            GZIP_HEADER_PREFIX,
+            GZIP_EXTRA,
+            struct.pack("<Q", member_size),
+            body,
+            struct.pack("<II", zlib.crc32(chunk), len(chunk) & 0xFFFFFFFF),
+        ]
+    )
+
+
+# zstd needs the optional zstandard package, the others are always there
+def codec_available(codec: str) -> bool:
+    return codec in CODEC_SUFFIXES and (codec != "zstd" or zstandard is not None)
+
+
+def _chunk_compressor(codec: str, level: int) -> Callable[[bytes], bytes]:
+    if codec == "gzip":
+        return lambda chunk: gzip_member(chunk, level)
+    if codec == "xz":
+        return lambda chunk: lzma.compress(chunk, format=lzma.FORMAT_XZ, preset=level)
+    assert codec == "zstd", f"unknown codec {codec}"
+    assert zstandard is not None, "zstd compression needs the zstandard package"
+    return lambda chunk: zstandard.ZstdCompressor(level=level).compress(chunk)
+
+
+# Writes src_path with the suffix of the codec appended, eg. .mmdb.gz
+def compress_file(
+    src_path: Path,
+    codec: str = "gzip",
+    level: Optional[int] = None,
+    workers: int = COMPRESS_WORKERS,
+) -> Compressed:
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    compress_chunk = _chunk_compressor(codec, level)
+    dst_path = src_path.with_name(src_path.name + CODEC_SUFFIXES[codec])
+    tmp_path = dst_path.with_name(dst_path.name + ".tmp")
+
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with tmp_path.open("wb") as out_file:
+            for block in _ordered_map(
+                executor,
+                compress_chunk,
+                _read_chunks(src_path, CHUNK_SIZE),
+                2 * workers,
+            ):
+                out_file.write(block)
+    tmp_path.rename(dst_path)
+    return Compressed(
+        path=dst_path,
+        codec=codec,
+        size=src_path.stat().st_size,
+        compressed_size=dst_path.stat().st_size,
+        duration=time.monotonic() - t0,
+    )
+
+
+# Returns the (offset, size) of every member of a .gz file when all of them
+# were written by gzip_member, None otherwise.
+def gzip_members(path: Path) -> Optional[List[Tuple[int, int]]]:
+    members = []
+    file_size = path.stat().st_size
+    offset = 0
+    with path.open("rb") as in_file:
+        while offset < file_size:
+            in_file.seek(offset)
+            header = in_file.read(GZIP_HEADER_SIZE)
+            if (
+                len(header) != GZIP_HEADER_SIZE
+                or header[:4] != GZIP_HEADER_PREFIX[:4]
+                or header[10:16] != GZIP_EXTRA
+            ):
+                return None
+            (member_size,) = struct.unpack("<Q", header[16:])
+            if member_size < GZIP_HEADER_SIZE + GZIP_TRAILER_SIZE:
+                return None
+            members.append((offset, member_size))
+            offset += member_size
+    if offset != file_size:
+        return None
+    return members
+
+
+def _inflate_members(src_path: Path, members: list, out_file, workers: int):
+    fd = os.open(src_path, os.O_RDONLY)
+
+    def inflate(member: Tuple[int, int]) -> bytes:
+        offset, size = member
+        # Inflating in gzip mode also checks the CRC and length in the trailer
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(os.pread(fd, size, offset))
+        assert (
+            decompressor.eof and not decompressor.unused_data
+        ), f"{src_path} has a corrupt member at offset {offset}"
+        return data
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for data in _ordered_map(executor, inflate, members, 2 * workers):
+                out_file.write(data)
+    finally:
+        os.close(fd)
+
+
+# Returns whether the file could be inflated in parallel
+def decompress_file(
+    src_path: Path, dst_path: Path, workers: int = COMPRESS_WORKERS
+) -> bool:
+    codec = codec_for(src_path)
+    tmp_path = dst_path.with_name(dst_path.name + ".tmp")
+    members = gzip_members(src_path) if codec == "gzip" else None
+    with tmp_path.open("wb") as out_file:
+        if members is not None:
+            _inflate_members(src_path, members, out_file, workers)
+        elif codec == "gzip":
+            with gzip.open(src_path) as in_file:
+                shutil.copyfileobj(in_file, out_file, 2**20)
+        elif codec == "xz":
+            with lzma.open(src_path) as in_file:
+                shutil.copyfileobj(in_file, out_file, 2**20)
+        else:
+            assert zstandard is not None, "zstd decompression needs zstandard"
+            with src_path.open("rb") as raw_file:
+                reader = zstandard.ZstdDecompressor().stream_reader(
+                    raw_file, read_across_frames=True
+                )
+                shutil.copyfileobj(reader, out_file, 2**20)
+    tmp_path.rename(dst_path)
+    return members is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compresses files, or decompresses them with -d, in parallel"
+    )
+    parser.add_argument("files", nargs="+", type=Path)
+    parser.add_argument("-d", "--decompress", action="store_true")
+    parser.add_argument("--codec", choices=list(CODEC_SUFFIXES), default="gzip")
+    parser.add_argument("--level", type=int)
+    parser.add_argument("--workers", type=int, default=COMPRESS_WORKERS)
+    args = parser.parse_args()
+
+    for path in args.files:
+        if args.decompress:
+            decompress_file(path, path.with_suffix(""), args.workers)
+            print(f"    decompressed {path}")
+            continue
+        result = compress_file(path, args.codec, args.level, args.workers)
+        print(
+            f"    wrote {result.path} in {result.duration:.1f}s,"
+            f" ratio {result.size / max(result.compressed_size, 1):.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+from compress import decompress_file
+from digest_manifest import default_manifest
+from instrumentation import add_bytes, span
+
+# Every directory we decompress into keeps track of the digest of the .gz
+# each file was inflated from, so files that are already up to date are
+# skipped instead of being inflated again on every run.
+STATE_FILENAME = ".decompressed.json"
+
+
+def load_state(directory: Path) -> dict:
+    try:
+        with (directory / STATE_FILENAME).open() as in_file:
+            return json.load(in_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(directory: Path, state: dict):
+    tmp_path = directory / f"{STATE_FILENAME}.{os.getpid()}.tmp"
+    with tmp_path.open("w") as out_file:
+        json.dump(state, out_file, sort_keys=True, indent=2)
+    tmp_path.rename(directory / STATE_FILENAME)
+
+
+def is_up_to_date(dst_path: Path, entry: dict, source_sha256: str) -> bool:
+    if entry is None or entry["source_sha256"] != source_sha256:
+        return False
+    try:
+        st = dst_path.stat()
+    except FileNotFoundError:
+        return False
+    return st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]
+
+
+def state_entry(dst_path: Path, source_sha256: str) -> dict:
+    st = dst_path.stat()
+    return {
+        "source_sha256": source_sha256,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+
+
+# Records that every dst_path is up to date with its src_path, for files that
+# were compressed from dst_path rather than inflated into it, such as the
+# outputs we build, so that they aren't inflated again on the next run.
+def record_decompressed(pairs: List[Tuple[Path, Path]]):
+    states = {}
+    for src_path, dst_path in pairs:
+        state = states.setdefault(dst_path.parent, load_state(dst_path.parent))
+        source_sha256 = default_manifest().digests(src_path).sha256
+        state[dst_path.name] = state_entry(dst_path, source_sha256)
+    for directory, state in states.items():
+        save_state(directory, state)
+
+
+# Files we compressed ourselves are inflated by threads member by member, see
+# compress.py, so workers only matters for those.
+def gunzip_file(src_path: Path, dst_path: Path, workers: int = 1):
+    decompress_file(src_path, dst_path, workers)
+
+
+# Inflates every src_path into the same path without the .gz suffix, unless
+# the existing file was already inflated from the same source.
+def decompress_all(src_paths: List[Path], jobs: int = os.cpu_count()) -> int:
+    pending = []
+    states = {}
+    for src_path in sorted(src_paths):
+        dst_path = src_path.with_suffix("")
+        state = states.setdefault(src_path.parent, load_state(src_path.parent))
+        source_sha256 = default_manifest().digests(src_path).sha256
+        if is_up_to_date(dst_path, state.get(dst_path.name), source_sha256):
+            continue
+        pending.append((src_path, dst_path, source_sha256))
+
+    print(f"[+] decompressing {len(pending)} of {len(src_paths)} files")
+    if not pending:
+        return 0
+    processes = max(min(jobs, len(pending)), 1)
+    # The cores not used by a process per file inflate members in parallel
+    threads = max((os.cpu_count() or 1) // processes, 1)
+    executor = ProcessPoolExecutor(max_workers=processes)
+    with span("decompress", files=len(pending)), executor:
+        futures = [
+            (
+                executor.submit(gunzip_file, src_path, dst_path, threads),
+                src_path,
+                sha256,
+            )
+            for src_path, dst_path, sha256 in pending
+        ]
+        try:
+            for future, src_path, source_sha256 in futures:
+                future.result()
+                dst_path = src_path.with_suffix("")
+                print(f"    decompressed {dst_path}")
+                entry = state_entry(dst_path, source_sha256)
+                add_bytes("read", src_path.stat().st_size)
+                add_bytes("written", entry["size"])
+                states[dst_path.parent][dst_path.name] = entry
+        finally:
+            # What was decompressed so far is recorded even if a file failed
+            for directory, state in states.items():
+                save_state(directory, state)
+    return len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Decompresses the .mmdb.gz files in the given directories"
+    )
+    parser.add_argument("directories", nargs="+", type=Path)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    src_paths = []
+    for directory in args.directories:
+        src_paths += directory.glob("*.mmdb.gz")
+    decompress_all(src_paths, jobs=args.jobs)
+
+
+if __name__ == "__main__":
+    main()
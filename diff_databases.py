@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import argparse
+import ipaddress
+from collections import namedtuple
+from dataclasses import dataclass, asdict
+from functools import lru_cache
+from typing import Callable, Iterator
+
+from mmdb_tree import MMDBTree, is_ipv4
+
+# What we compare between two databases for every address
+IPInfo = namedtuple("IPInfo", ["country", "asn"])
+EMPTY_INFO = IPInfo(country=None, asn=None)
+
+ChangedRange = namedtuple("ChangedRange", ["family", "first", "last", "old", "new"])
+
+
+@dataclass
+class FamilyDiff:
+    total_addresses: int = 0
+    changed_addresses: int = 0
+    changed_ranges: int = 0
+    added: int = 0
+    removed: int = 0
+    country_changed: int = 0
+    asn_changed: int = 0
+
+    def churn(self) -> float:
+        if self.total_addresses == 0:
+            return 0.0
+        return self.changed_addresses / self.total_addresses
+
+
+def record_info(record) -> IPInfo:
+    if not isinstance(record, dict):
+        return EMPTY_INFO
+    return IPInfo(
+        country=record.get("country", {}).get("iso_code"),
+        asn=record.get("autonomous_system_number"),
+    )
+
+
+def tree_info_cache(tree: MMDBTree):
+    @lru_cache(maxsize=2**16)
+    def info(record: int) -> IPInfo:
+        if tree.is_empty(record):
+            return EMPTY_INFO
+        return record_info(tree.decode(record))
+
+    return info
+
+
+# Walks the search trees of both databases in lockstep and yields, in address
+# order, (ip_acc, prefix_len, old_info, new_info) for every network on which
+# they differ. When one of the trees has a leaf where the other one has a
+# subtree, the leaf is compared against every leaf of the subtree, and so is
+# the IPv4 subtree when only one of them has an IPv4 alias. Memory is bounded
+# by the depth of the trees.
+#
+# info_cache returns, for a tree, the function mapping its records to what is
+# compared, by default the IPInfo of the record.
+def iter_changed_leaves(
+    old: MMDBTree, new: MMDBTree, info_cache: Callable = tree_info_cache
+) -> Iterator:
+    assert old.ip_version == new.ip_version, "databases have different ip versions"
+    old_info, new_info = info_cache(old), info_cache(new)
+
+    # Returns the (record, ip_acc) of both halves of a network. IPv4 aliases
+    # are included: their record is the IPv4 subtree they point to.
+    def expand(tree, record, depth, ip_acc):
+        half = 1 << (tree.bit_count - depth - 1)
+        if tree.is_node(record):
+            return [
+                (tree.read_node(record, 0), ip_acc),
+                (tree.read_node(record, 1), ip_acc | half),
+            ]
+        # A leaf covers both halves of its network
+        return [(record, ip_acc), (record, ip_acc | half)]
+
+    stack = [(0, 0, 0, 0)]
+    while stack:
+        rec_old, rec_new, depth, ip_acc = stack.pop()
+        if not old.is_node(rec_old) and not new.is_node(rec_new):
+            a, b = old_info(rec_old), new_info(rec_new)
+            if a != b:
+                yield ip_acc, depth, a, b
+            continue
+
+        children = zip(
+            expand(old, rec_old, depth, ip_acc), expand(new, rec_new, depth, ip_acc)
+        )
+        for (old_child, acc), (new_child, _) in reversed(list(children)):
+            # Networks that are IPv4 aliases in both databases are compared
+            # through ::/96. When only one of them has an alias, what it
+            # points to is compared with the network of the other one.
+            if old.is_ipv4_alias(old_child, acc) and new.is_ipv4_alias(new_child, acc):
+                continue
+            stack.append((old_child, new_child, depth + 1, acc))
+
+
+def leaf_sizes(tree: MMDBTree) -> dict:
+    sizes = {"ipv4": 0, "ipv6": 0}
+    for ip_acc, prefix_len, _ in tree.iter_leaves():
+        family = "ipv4" if is_ipv4(ip_acc, prefix_len, tree.bit_count) else "ipv6"
+        sizes[family] += 2 ** (tree.bit_count - prefix_len)
+    return sizes
+
+
+def to_address(ip_acc: int, family: str):
+    if family == "ipv4":
+        return ipaddress.IPv4Address(ip_acc)
+    return ipaddress.IPv6Address(ip_acc)
+
+
+# Merges adjacent changed networks with the same old and new values into a
+# single range and updates the per family summary.
+def iter_changed_ranges(old: MMDBTree, new: MMDBTree, summary: dict):
+    bit_count = old.bit_count
+    current = None
+    for ip_acc, prefix_len, a, b in iter_changed_leaves(old, new):
+        family = "ipv4" if is_ipv4(ip_acc, prefix_len, bit_count) else "ipv6"
+        size = 2 ** (bit_count - prefix_len)
+        diff = summary[family]
+        diff.changed_addresses += size
+        if a == EMPTY_INFO:
+            diff.added += size
+        elif b == EMPTY_INFO:
+            diff.removed += size
+        else:
+            diff.country_changed += size * (a.country != b.country)
+            diff.asn_changed += size * (a.asn != b.asn)
+
+        if (
+            current is not None
+            and current[0] == family
+            and current[2] + 1 == ip_acc
+            and current[3:] == (a, b)
+        ):
+            current[2] = ip_acc + size - 1
+            continue
+        if current is not None:
+            yield current
+        current = [family, ip_acc, ip_acc + size - 1, a, b]
+
+    if current is not None:
+        yield current
+
+
+def diff_databases(old: MMDBTree, new: MMDBTree, summary: dict):
+    for family, first, last, a, b in iter_changed_ranges(old, new, summary):
+        summary[family].changed_ranges += 1
+        yield ChangedRange(
+            family=family,
+            first=to_address(first, family),
+            last=to_address(last, family),
+            old=a,
+            new=b,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lists the ranges that changed between two ip2country_as databases"
+    )
+    parser.add_argument("old_db")
+    parser.add_argument("new_db")
+    parser.add_argument(
+        "--output", help="write the changed ranges as JSON lines to this file"
+    )
+    parser.add_argument(
+        "--max-churn",
+        type=float,
+        help="exit with an error if the fraction of changed addresses of any"
+        " family is larger than this",
+    )
+    args = parser.parse_args()
+
+    summary = {"ipv4": FamilyDiff(), "ipv6": FamilyDiff()}
+    output = args.output or os.devnull
+    with MMDBTree(args.old_db) as old, MMDBTree(args.new_db) as new:
+        for family, size in leaf_sizes(old).items():
+            summary[family].total_addresses = size
+
+        with open(output, "w") as out_file:
+            for changed in diff_databases(old, new, summary):
+                row = {
+                    "family": changed.family,
+                    "first": str(changed.first),
+                    "last": str(changed.last),
+                    "old": changed.old._asdict(),
+                    "new": changed.new._asdict(),
+                }
+                out_file.write(json.dumps(row) + "\n")
+
+    report = {
+        family: {**asdict(diff), "churn": diff.churn()}
+        for family, diff in summary.items()
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.max_churn is not None:
+        for family, diff in summary.items():
+            if diff.churn() > args.max_churn:
+                print(
+                    f"[-] {family} churn {diff.churn():.4f} is above {args.max_churn}"
+                )
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
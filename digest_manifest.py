@@ -0,0 +1,118 @@
+import os
+import json
+import fcntl
+import atexit
+import hashlib
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+FileDigests = namedtuple("FileDigests", ["sha1", "md5", "sha256"])
+
+DEFAULT_MANIFEST_PATH = Path("cache_dir") / "digest_manifest.json"
+# New digests are written out in batches, and when the process exits
+FLUSH_EVERY = 256
+
+
+def compute_file_digests(filepath: Path) -> FileDigests:
+    sha1, md5, sha256 = hashlib.sha1(), hashlib.md5(), hashlib.sha256()
+    with filepath.open("rb") as in_file:
+        while True:
+            b = in_file.read(2**20)
+            if not b:
+                break
+            sha1.update(b)
+            md5.update(b)
+            sha256.update(b)
+    return FileDigests(
+        sha1=sha1.hexdigest(), md5=md5.hexdigest(), sha256=sha256.hexdigest()
+    )
+
+
+# Remembers the digests of files across runs, keyed by their path, size and
+# modification time, so that files that didn't change don't need to be read
+# again to learn their digest.
+#
+# Several processes can use the same manifest, each one merges its new
+# entries into the file under an exclusive lock. atexit handlers don't run in
+# the workers of a ProcessPoolExecutor, so they call flush themselves.
+class DigestManifest:
+    def __init__(self, path: Path, flush_every: int = FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        self.updated = {}
+        atexit.register(self.flush)
+
+    def _load(self) -> dict:
+        try:
+            with self.path.open() as in_file:
+                return json.load(in_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _key(filepath: Path) -> str:
+        return os.path.abspath(filepath)
+
+    def get(self, filepath: Path):
+        st = filepath.stat()
+        with self.lock:
+            entry = self.entries.get(self._key(filepath))
+        if (
+            entry is None
+            or entry["size"] != st.st_size
+            or entry["mtime_ns"] != st.st_mtime_ns
+        ):
+            return None
+        return FileDigests(sha1=entry["sha1"], md5=entry["md5"], sha256=entry["sha256"])
+
+    def record(self, filepath: Path, digests: FileDigests):
+        st = filepath.stat()
+        entry = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            **digests._asdict(),
+        }
+        with self.lock:
+            self.entries[self._key(filepath)] = entry
+            self.updated[self._key(filepath)] = entry
+            pending = len(self.updated)
+        if pending >= self.flush_every:
+            self.flush()
+
+    def digests(self, filepath: Path) -> FileDigests:
+        digests = self.get(filepath)
+        if digests is None:
+            digests = compute_file_digests(filepath)
+            self.record(filepath, digests)
+        return digests
+
+    def flush(self):
+        with self.lock:
+            if not self.updated:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            lock_path = self.path.with_name(self.path.name + ".lock")
+            with lock_path.open("a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Other processes might have updated the manifest in the
+                # meantime, so we only write our own changes on top of what is
+                # on disk.
+                entries = self._load()
+                entries.update(self.updated)
+                entries = {k: v for k, v in entries.items() if os.path.exists(k)}
+
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                with tmp_path.open("w") as out_file:
+                    json.dump(entries, out_file, sort_keys=True)
+                tmp_path.rename(self.path)
+            self.entries = entries
+            self.updated = {}
+
+
+@lru_cache(maxsize=None)
+def default_manifest() -> DigestManifest:
+    return DigestManifest(DEFAULT_MANIFEST_PATH)
@@ -1,12 +1,14 @@
 import os
-import gzip
-import shutil
+import json
+import time
 import hashlib
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from datetime import datetime, date, timezone
-from typing import Generator, List
-import xml.etree.ElementTree as ET
+from datetime import datetime, date, timedelta, timezone
+from typing import Generator, List, Optional
+from urllib.parse import urlparse
 
 from functools import lru_cache
 
@@ -15,104 +17,378 @@ from requests.adapters import HTTPAdapter, Retry
 
 from lxml import html
 
+from decompress import decompress_all
+from digest_manifest import FileDigests, default_manifest
+from http_cache import cached_get
+from ia_metadata import IAItem, IAMetadataClient
+from instrumentation import add_bytes, run_stage, span
+
+# How many files we download at the same time, overall and from a single host
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_WORKERS_PER_HOST = int(os.getenv("DOWNLOAD_WORKERS_PER_HOST", "4"))
+
 retry_strategy = Retry(total=4, backoff_factor=0.1)
 
 req_session = requests.Session()
-req_session.mount("http://", HTTPAdapter(max_retries=retry_strategy))
-req_session.mount("https://", HTTPAdapter(max_retries=retry_strategy))
+req_session.mount(
+    "http://", HTTPAdapter(max_retries=retry_strategy, pool_maxsize=DOWNLOAD_WORKERS)
+)
+req_session.mount(
+    "https://", HTTPAdapter(max_retries=retry_strategy, pool_maxsize=DOWNLOAD_WORKERS)
+)
 
 
+# The digests are looked up in the shared digest manifest, so that a file is
+# only read once to compute all of them and not again until it changes.
 def file_sha1_hexdigest(filepath: Path):
-    h = hashlib.sha1()
-    with filepath.open("rb") as in_file:
-        while True:
-            b = in_file.read(2**16)
-            if not b:
-                break
-            h.update(b)
-    return h.hexdigest()
+    return default_manifest().digests(filepath).sha1
 
 
 def file_md5_hexdigest(filepath: Path):
-    h = hashlib.md5()
-    with filepath.open("rb") as in_file:
-        while True:
-            b = in_file.read(2**16)
-            if not b:
-                break
-            h.update(b)
-    return h.hexdigest()
+    return default_manifest().digests(filepath).md5
 
 
 def file_sha256_hexdigest(filepath: Path):
-    h = hashlib.sha256()
-    with filepath.open("rb") as in_file:
-        while True:
-            b = in_file.read(2**16)
-            if not b:
-                break
+    return default_manifest().digests(filepath).sha256
+
+
+# sha1 is the expected digest of the file, when the source publishes one
+DownloadJob = namedtuple("DownloadJob", ["url", "dst_path", "sha1"], defaults=[None])
+
+
+class DownloadProgress:
+    def __init__(self, total_files: int):
+        self.total_files = total_files
+        self.done_files = 0
+        self.total_bytes = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def log(self, msg: str):
+        with self.lock:
+            print(msg)
+
+    def add_bytes(self, count: int):
+        with self.lock:
+            self.total_bytes += count
+
+    def file_done(self, job: DownloadJob):
+        with self.lock:
+            self.done_files += 1
+            print(
+                f"    [{self.done_files}/{self.total_files}] {job.dst_path.name}"
+                f" ({self.total_bytes / 2**20:.1f} MiB, {self.throughput() / 2**20:.2f} MiB/s)"
+            )
+
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self.start_time
+        if elapsed == 0:
+            return 0.0
+        return self.total_bytes / elapsed
+
+
+# Transfers that break halfway through are resumed with a Range request rather
+# than started over, both within a run and in the next one. The partial file is
+# kept next to its destination as .tmp, together with a small state record of
+# the response it came from. The server has to accept byte ranges and give us
+# a validator for the file (a strong ETag or Last-Modified), which we send in
+# If-Range: when the file changed on the server in the meantime, or when it
+# ignores the range, we get the whole file back and start over.
+PARTIAL_STATE_VERSION = 1
+
+
+class ResumeFailed(Exception):
+    pass
+
+
+def partial_paths(dst_path: Path):
+    tmp_path = dst_path.with_name(dst_path.name + ".tmp")
+    return tmp_path, tmp_path.with_name(tmp_path.name + ".json")
+
+
+# Returns the state record for a full response, None when the download can't
+# be resumed if it breaks.
+def resume_state(url: str, resp: requests.Response) -> Optional[dict]:
+    if resp.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    # Ranges are offsets in the encoded body, while requests hands us the
+    # decoded one
+    if resp.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    length = resp.headers.get("Content-Length")
+    etag = resp.headers.get("ETag")
+    # Weak ETags can't be used in If-Range
+    if etag and not etag.startswith("W/"):
+        validator = etag
+    else:
+        validator = resp.headers.get("Last-Modified")
+    if length is None or validator is None:
+        return None
+    return {
+        "version": PARTIAL_STATE_VERSION,
+        "url": url,
+        "validator": validator,
+        "length": int(length),
+    }
+
+
+class PartialDownload:
+    def __init__(self, job: DownloadJob):
+        self.url = job.url
+        self.tmp_path, self.state_path = partial_paths(job.dst_path)
+        self.state = None
+        self.reset()
+
+    def reset(self):
+        # We hash the file as it's being written, so the digests are ready by
+        # the time it's renamed without reading it back from disk.
+        self.hashers = [hashlib.sha1(), hashlib.md5(), hashlib.sha256()]
+        self.size = 0
+
+    def discard(self):
+        self.reset()
+        self.state = None
+        self.state_path.unlink(missing_ok=True)
+        self.tmp_path.unlink(missing_ok=True)
+
+    # Picks up the partial file left behind by a previous run, if it came from
+    # the same url and can be resumed. The bytes we already have are hashed
+    # again, since the digests cover the whole file.
+    def load(self):
+        if not self.tmp_path.exists() or not self.state_path.exists():
+            self.discard()
+            return
+        with self.state_path.open() as in_file:
+            state = json.load(in_file)
+        size = self.tmp_path.stat().st_size
+        if (
+            state.get("version") != PARTIAL_STATE_VERSION
+            or state["url"] != self.url
+            or size > state["length"]
+        ):
+            self.discard()
+            return
+        self.state = state
+        with self.tmp_path.open("rb") as in_file:
+            while True:
+                b = in_file.read(2**20)
+                if not b:
+                    break
+                for h in self.hashers:
+                    h.update(b)
+        self.size = size
+
+    def request_headers(self) -> dict:
+        if self.state is None or self.size == 0:
+            return {}
+        return {
+            "Range": f"bytes={self.size}-",
+            "If-Range": self.state["validator"],
+        }
+
+    def _matches_range(self, content_range: str) -> bool:
+        # eg. "bytes 1000-1999/2000"
+        try:
+            unit, spec = content_range.split(" ", 1)
+            first_last, total = spec.split("/")
+            first = int(first_last.split("-")[0])
+        except ValueError:
+            return False
+        return (
+            unit == "bytes"
+            and first == self.size
+            and total == str(self.state["length"])
+        )
+
+    # Opens the partial file for writing the body of resp, either appending
+    # to what we have or from scratch.
+    def open(self, resp: requests.Response):
+        if resp.status_code == 206 and self.state is not None:
+            if not self._matches_range(resp.headers.get("Content-Range", "")):
+                self.discard()
+                raise ResumeFailed(
+                    f"unexpected range {resp.headers.get('Content-Range')}"
+                )
+            out_file = self.tmp_path.open("r+b")
+            # Drop anything written after the last byte we hashed
+            out_file.truncate(self.size)
+            out_file.seek(self.size)
+            return out_file
+        if resp.status_code == 416:
+            self.discard()
+            raise ResumeFailed("range not satisfiable")
+
+        resp.raise_for_status()
+        if self.size > 0:
+            print(f"    can't resume {self.url}, starting over")
+        self.reset()
+        self.state = resume_state(self.url, resp)
+        if self.state is None:
+            self.state_path.unlink(missing_ok=True)
+        else:
+            tmp_state_path = self.state_path.with_name(self.state_path.name + ".tmp")
+            with tmp_state_path.open("w") as out_file:
+                json.dump(self.state, out_file)
+            tmp_state_path.rename(self.state_path)
+        return self.tmp_path.open("wb")
+
+    def write(self, out_file, b: bytes):
+        out_file.write(b)
+        for h in self.hashers:
             h.update(b)
-    return h.hexdigest()
+        self.size += len(b)
+
+    def is_complete(self) -> bool:
+        return self.state is None or self.size == self.state["length"]
+
+    # A previous run can leave the whole file behind, eg. when it stopped
+    # before renaming it, in which case asking for the rest of it gets a 416
+    # naming the length we already have.
+    def is_satisfied_by(self, resp: requests.Response) -> bool:
+        return (
+            resp.status_code == 416
+            and self.state is not None
+            and self.size == self.state["length"]
+            and resp.headers.get("Content-Range") == f"bytes */{self.size}"
+        )
 
+    def digests(self) -> FileDigests:
+        return FileDigests(*(h.hexdigest() for h in self.hashers))
 
-IAItem = namedtuple("IAItem", ["identifier", "filename", "sha1"])
+    def finish(self, dst_path: Path):
+        self.tmp_path.rename(dst_path)
+        self.state_path.unlink(missing_ok=True)
 
 
-def list_all_ia_items(identifier: str) -> List[IAItem]:
-    ia_items = []
-    resp = req_session.get(
-        f"https://archive.org/download/{identifier}/{identifier}_files.xml"
+def download_file(job: DownloadJob, progress: DownloadProgress):
+    partial = PartialDownload(job)
+    partial.load()
+    if partial.size > 0:
+        progress.log(f"    resuming {job.url} at {partial.size / 2**20:.1f} MiB")
+
+    # The adapter retries failed connections, here we also retry transfers
+    # that break halfway through, using the same backoff. Attempts that moved
+    # the download forward don't count towards the retries.
+    failures = 0
+    while True:
+        size_before = partial.size
+        try:
+            with req_session.get(
+                job.url, stream=True, headers=partial.request_headers()
+            ) as resp:
+                if partial.is_satisfied_by(resp):
+                    break
+                with partial.open(resp) as out_file:
+                    for b in resp.iter_content(chunk_size=2**16):
+                        partial.write(out_file, b)
+                        progress.add_bytes(len(b))
+                        add_bytes("downloaded", len(b))
+            if not partial.is_complete():
+                raise ResumeFailed(f"got {partial.size} bytes of {job.url}")
+            break
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ResumeFailed,
+        ):
+            if partial.state is None:
+                # Not resumable, the next attempt starts over
+                partial.reset()
+            if partial.size > size_before:
+                failures = 0
+            if failures == retry_strategy.total:
+                raise
+            time.sleep(retry_strategy.backoff_factor * 2**failures)
+            failures += 1
+
+    digests = partial.digests()
+    if job.sha1 is not None and digests.sha1 != job.sha1:
+        partial.discard()
+        raise ValueError(f"{job.url} sha1 mismatch: {digests.sha1} != {job.sha1}")
+
+    partial.finish(job.dst_path)
+    default_manifest().record(job.dst_path, digests)
+
+
+def download_many(jobs: List[DownloadJob]):
+    if not jobs:
+        return
+
+    progress = DownloadProgress(len(jobs))
+    host_limits = {}
+    for job in jobs:
+        host = urlparse(job.url).netloc
+        if host not in host_limits:
+            host_limits[host] = threading.BoundedSemaphore(DOWNLOAD_WORKERS_PER_HOST)
+
+    def run(job: DownloadJob):
+        with host_limits[urlparse(job.url).netloc]:
+            progress.log(f"    downloading {job.url}")
+            with span("download", file=job.dst_path.name):
+                download_file(job, progress)
+        progress.file_done(job)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {executor.submit(run, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                progress.log(f"    failed to download {futures[future].url}: {exc}")
+                failed.append(futures[future])
+
+    print(
+        f"    downloaded {progress.done_files} files,"
+        f" {progress.total_bytes / 2**20:.1f} MiB at {progress.throughput() / 2**20:.2f} MiB/s"
     )
-    if resp.status_code == 404:
-        return []
-
-    resp.raise_for_status()
-    tree = ET.fromstring(resp.text)
-    for f in tree:
-        fname = f.get("name")
-        if not fname:
-            continue
+    assert not failed, f"failed to download {len(failed)} files"
 
-        sha1 = f.find("sha1")
-        if sha1 is not None:
-            sha1 = sha1.text
-        ia_items.append(IAItem(identifier=identifier, filename=fname, sha1=sha1))
 
-    return ia_items
+IA_METADATA_CACHE_DIR = Path("cache_dir") / "ia_metadata"
 
 
-def maybe_download_ia_file(output_dir: Path, ia_item: IAItem):
+@lru_cache(maxsize=None)
+def default_ia_metadata() -> IAMetadataClient:
+    return IAMetadataClient(req_session, IA_METADATA_CACHE_DIR)
+
+
+def list_all_ia_items(identifier: str) -> List[IAItem]:
+    return list(default_ia_metadata().iter_files(identifier))
+
+
+def ia_download_job(output_dir: Path, ia_item: IAItem):
     output_path = output_dir / ia_item.filename
     if output_path.exists() and file_sha1_hexdigest(output_path) == ia_item.sha1:
-        return
+        return None
 
     url = f"https://archive.org/download/{ia_item.identifier}/{ia_item.filename}"
-    print(f"    downloading {url}")
-    with req_session.get(url, stream=True) as resp:
-        resp.raise_for_status()
-        with output_path.with_suffix(".tmp").open("wb") as out_file:
-            for b in resp.iter_content(chunk_size=2**16):
-                out_file.write(b)
+    return DownloadJob(url=url, dst_path=output_path, sha1=ia_item.sha1)
+
 
-    output_path.with_suffix(".tmp").rename(output_path)
-    file_sha1 = file_sha1_hexdigest(output_path)
-    assert file_sha1 == ia_item.sha1, f"{file_sha1} != {ia_item.sha1}"
+def maybe_download_ia_file(output_dir: Path, ia_item: IAItem):
+    job = ia_download_job(output_dir, ia_item)
+    if job is not None:
+        download_many([job])
 
 
 def download_all_ia_files(
     output_dir: Path, identifier: str, extension: str, download_latest: bool
 ):
-    ia_items = list_all_ia_items(identifier=identifier)
-    matching_items = sorted(
-        [item for item in ia_items if item.filename.endswith(extension)],
-        key=lambda x: x.filename,
-        reverse=True,
-    )
+    # If we only want the latest, we only look at the most recent file
+    if download_latest:
+        latest = default_ia_metadata().latest(identifier, extension)
+        matching_items = [latest] if latest is not None else []
+    else:
+        matching_items = default_ia_metadata().files_matching(identifier, extension)
+
+    jobs = []
     for item in matching_items:
-        maybe_download_ia_file(output_dir, item)
-        # If we only want the latest, return immediately after the first successful download
-        if download_latest:
-            return
+        job = ia_download_job(output_dir, item)
+        if job is not None:
+            jobs.append(job)
+    download_many(jobs)
 
 
 def download_ia_assets(cache_dir: Path, download_latest: bool):
@@ -127,14 +403,45 @@ def download_ia_assets(cache_dir: Path, download_latest: bool):
         )
 
 
+LISTINGS_CACHE_DIR = Path("cache_dir") / "listings"
+
+
+# Monthly folders (eg. routeviews-prefix2as/2019/05/) never change once the
+# month is over and the files for its last days have been published, which can
+# take a day or two. A listing fetched later than that is final.
+LISTING_GRACE_PERIOD = timedelta(days=7)
+
+
+def is_final_month_listing(url: str, meta: dict) -> bool:
+    try:
+        month = datetime.strptime("/".join(url.split("/")[-3:-1]), "%Y/%m")
+    except ValueError:
+        return False
+    month_end = (month.replace(day=28) + timedelta(days=4)).replace(
+        day=1, tzinfo=timezone.utc
+    )
+    fetched_at = datetime.fromisoformat(meta["fetched_at"])
+    return fetched_at >= month_end + LISTING_GRACE_PERIOD
+
+
 @lru_cache(maxsize=None)
 def links_in_folder(url: str):
     assert url.endswith("/")
-    resp = req_session.get(url)
-    tree = html.fromstring(resp.text)
+    body = cached_get(
+        req_session,
+        url,
+        LISTINGS_CACHE_DIR,
+        is_immutable=lambda meta: is_final_month_listing(url, meta),
+    )
+    tree = html.fromstring(body)
     return [f"{url}{href}" for href in tree.xpath("//a[@href]/text()")[5:]]
 
 
+def prefetch_listings(urls: List[str]):
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS_PER_HOST) as executor:
+        list(executor.map(links_in_folder, set(urls)))
+
+
 def iter_as_org_urls(since, until) -> Generator[str, None, None]:
     base_url = f"https://publicdata.caida.org/datasets/as-organizations/"
 
@@ -159,24 +466,25 @@ def download_as_organizations(cache_dir: Path, download_latest: bool):
         # Start from the 1st of the current month
         since_date = until_date.replace(day=1)
 
+    jobs = []
     for url in iter_as_org_urls(since_date, until_date):
         dst_filename = os.path.basename(url)
         dst_path = output_dir / dst_filename
 
         if not dst_path.exists():
-            print(f"    downloading {url}")
-            with req_session.get(url, stream=True) as resp:
-                resp.raise_for_status()
-                with dst_path.with_suffix(".tmp").open("wb") as out_file:
-                    for chunk in resp.iter_content(chunk_size=2**16):
-                        out_file.write(chunk)
-                dst_path.with_suffix(".tmp").rename(dst_path)
+            jobs.append(DownloadJob(url=url, dst_path=dst_path))
+    download_many(jobs)
 
 
-def download_routeviews_prefix2as(output_dir: Path, day: date, folders: list):
+def routeviews_folder_url(folder: str, day: date) -> str:
     ts = day.strftime("%Y/%m")
+    return f"https://publicdata.caida.org/datasets/routing/{folder}/{ts}/"
+
+
+def routeviews_prefix2as_jobs(output_dir: Path, day: date, folders: list):
+    jobs = []
     for folder in folders:
-        dir_url = f"https://publicdata.caida.org/datasets/routing/{folder}/{ts}/"
+        dir_url = routeviews_folder_url(folder, day)
         prfx2as_url = list(
             filter(
                 lambda url: day.strftime("-%Y%m%d-") in url, links_in_folder(dir_url)
@@ -190,19 +498,15 @@ def download_routeviews_prefix2as(output_dir: Path, day: date, folders: list):
         if dst_filepath.exists():
             continue
 
-        with req_session.get(prfx2as_url, stream=True) as resp:
-            print(f"    downloading {prfx2as_url}")
-            resp.raise_for_status()
-            with dst_filepath.with_suffix(".tmp").open("wb") as out_file:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    out_file.write(chunk)
-            dst_filepath.with_suffix(".tmp").rename(dst_filepath)
+        jobs.append(DownloadJob(url=prfx2as_url, dst_path=dst_filepath))
+    return jobs
 
 
 def download_prefix2as(cache_dir: Path, days: List[date]):
     output_dir = cache_dir / "routeviews-prefix2as"
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    missing = []
     for day in sorted(days):
         v4_prefix_files = list(
             output_dir.glob(f"routeviews-rv2-{day.strftime('%Y%m%d')}*.pfx2as.gz")
@@ -216,8 +520,23 @@ def download_prefix2as(cache_dir: Path, days: List[date]):
         if len(v6_prefix_files):
             folders.remove("routeviews6-prefix2as")
         if len(folders) > 0:
-            print(f"[+] downloading {len(folders)} folders")
-            download_routeviews_prefix2as(output_dir, day, folders)
+            missing.append((day, folders))
+
+    # All the listings we need are fetched at once, rather than one month at a
+    # time while building the jobs
+    prefetch_listings(
+        [
+            routeviews_folder_url(folder, day)
+            for day, folders in missing
+            for folder in folders
+        ]
+    )
+    jobs = []
+    for day, folders in missing:
+        jobs += routeviews_prefix2as_jobs(output_dir, day, folders)
+
+    print(f"[+] downloading {len(jobs)} prefix2as files")
+    download_many(jobs)
 
 
 def main():
@@ -225,9 +544,11 @@ def main():
     download_latest = env_value in ['true', '1', 't']
     cache_dir = Path("cache_dir")
     print("[+] downloading GeoIP assets")
-    download_ia_assets(cache_dir=cache_dir, download_latest=download_latest)
+    with span("geoip_assets"):
+        download_ia_assets(cache_dir=cache_dir, download_latest=download_latest)
     print("[+] downloading AS Organizations assets")
-    download_as_organizations(cache_dir=cache_dir, download_latest=False)
+    with span("as_organizations"):
+        download_as_organizations(cache_dir=cache_dir, download_latest=False)
 
     days = []
     for path in (cache_dir / "dbip-country-lite").glob("*.mmdb.gz"):
@@ -243,19 +564,17 @@ def main():
             )
         )
     print("[+] downloading prefix2as assets")
-    download_prefix2as(cache_dir, days)
+    with span("prefix2as"):
+        download_prefix2as(cache_dir, days)
 
     print("[+] downloading pre-built ip2country-as dbs")
     output_dir = Path("outputs")
     output_dir.mkdir(parents=True, exist_ok=True)
-    download_all_ia_files(output_dir, "ip2country-as", ".mmdb.gz", download_latest=download_latest)
-    for fn in output_dir.glob("*.mmdb.gz"):
-        output_path = fn.with_suffix(".tmp")
-        with gzip.open(fn) as in_file:
-            with output_path.open("wb") as out_file:
-                shutil.copyfileobj(in_file, out_file)
-        output_path.rename(output_path.with_suffix(""))
+    with span("ip2country_as"):
+        download_all_ia_files(output_dir, "ip2country-as", ".mmdb.gz", download_latest=download_latest)
+    decompress_all(list(output_dir.glob("*.mmdb.gz")))
 
 
 if __name__ == "__main__":
-    main()
+    with run_stage("download_assets"):
+        main()
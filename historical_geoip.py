@@ -0,0 +1,143 @@
+import sys
+import json
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime
+from pathlib import Path
+from typing import List, Optional, Union
+
+import maxminddb
+
+# mtime_ns tells apart a database from the one it replaced at the same path
+DatedDB = namedtuple("DatedDB", ["day", "path", "mtime_ns"])
+
+# The subset of a database record we hand out to the pipeline
+GeoIPResult = namedtuple(
+    "GeoIPResult", ["country", "asn", "as_org_name", "as_country", "as_name"]
+)
+
+Timestamp = Union[date, datetime, str]
+
+
+def to_geoip_result(record: Optional[dict]) -> Optional[GeoIPResult]:
+    if not record:
+        return None
+    return GeoIPResult(
+        country=record.get("country", {}).get("iso_code"),
+        asn=record.get("autonomous_system_number"),
+        as_org_name=record.get("autonomous_system_organization"),
+        as_country=record.get("autonomous_system_country"),
+        as_name=record.get("autonomous_system_name"),
+    )
+
+
+def parse_day(ts: Timestamp) -> date:
+    if isinstance(ts, datetime):
+        return ts.date()
+    if isinstance(ts, date):
+        return ts
+    for fmt in ("%Y%m%d", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(ts[:10], fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"invalid timestamp {ts}")
+
+
+# Returns the databases in outputs_dir sorted by date. Outputs are named after
+# the day of the country database they were built from, which is a day for the
+# maxmind databases and the first of the month for the dbip ones.
+def index_databases(outputs_dir: Path) -> List[DatedDB]:
+    databases = []
+    for path in outputs_dir.glob("*-ip2country_as.mmdb"):
+        try:
+            day = datetime.strptime(path.name.split("-")[0], "%Y%m%d").date()
+        except ValueError:
+            continue
+        databases.append(DatedDB(day=day, path=path, mtime_ns=path.stat().st_mtime_ns))
+    return sorted(databases)
+
+
+class HistoricalGeoIP:
+    def __init__(self, outputs_dir: Path = Path("outputs"), max_open: int = 8):
+        self.outputs_dir = outputs_dir
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._readers = OrderedDict()
+        self.reindex()
+
+    def reindex(self):
+        self.set_databases(index_databases(self.outputs_dir))
+
+    # Swaps in the result of index_databases, which callers can run elsewhere,
+    # eg. on a worker thread
+    def set_databases(self, databases: List[DatedDB]):
+        with self._lock:
+            self.databases = databases
+            self._days = [db.day for db in databases]
+            # Readers for files that were replaced or went away are dropped
+            current = set(databases)
+            for db in list(self._readers):
+                if db not in current:
+                    self._readers.pop(db).close()
+
+    # The database in effect on ts is the most recent one built for a day
+    # before or on ts. Timestamps older than the first database use the first
+    # one, since that is the closest thing we have.
+    def database_for(self, ts: Timestamp) -> DatedDB:
+        day = parse_day(ts)
+        with self._lock:
+            if not self.databases:
+                raise LookupError(f"no databases found in {self.outputs_dir}")
+            idx = bisect_right(self._days, day) - 1
+            return self.databases[max(idx, 0)]
+
+    def _reader(self, db: DatedDB) -> maxminddb.Reader:
+        reader = self._readers.get(db)
+        if reader is not None:
+            self._readers.move_to_end(db)
+            return reader
+
+        while len(self._readers) >= self.max_open:
+            _, evicted = self._readers.popitem(last=False)
+            evicted.close()
+        # MODE_AUTO memory maps the file, using the C extension when available
+        reader = maxminddb.open_database(str(db.path), maxminddb.MODE_AUTO)
+        self._readers[db] = reader
+        return reader
+
+    def lookup_in(self, db: DatedDB, ip: str) -> Optional[dict]:
+        # Lookups happen with the lock held, so that a reader can't be closed
+        # by another thread while it's being used.
+        with self._lock:
+            return self._reader(db).get(ip)
+
+    def lookup(self, ip: str, ts: Timestamp) -> Optional[dict]:
+        return self.lookup_in(self.database_for(ts), ip)
+
+    def close(self):
+        with self._lock:
+            while self._readers:
+                self._readers.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: historical_geoip.py IP YYYYMMDD")
+        sys.exit(1)
+
+    with HistoricalGeoIP() as geoip:
+        db = geoip.database_for(sys.argv[2])
+        print(f"[+] using {db.path}")
+        print(json.dumps(geoip.lookup_in(db, sys.argv[1]), indent=2))
+
+
+if __name__ == "__main__":
+    main()
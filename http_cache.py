@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+import requests
+
+# On disk cache for small documents (directory listings, item metadata) that
+# are fetched on every run but rarely change. Cached copies are revalidated
+# with If-None-Match / If-Modified-Since, so an unchanged document costs a
+# 304 instead of a full download.
+
+
+def _cache_paths(cache_dir: Path, url: str):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return cache_dir / f"{key}.body", cache_dir / f"{key}.json"
+
+
+def _write_atomic(path: Path, data: bytes):
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with tmp_path.open("wb") as out_file:
+        out_file.write(data)
+    tmp_path.rename(path)
+
+
+def load_cache_meta(cache_dir: Path, url: str) -> Optional[dict]:
+    body_path, meta_path = _cache_paths(cache_dir, url)
+    if not body_path.exists() or not meta_path.exists():
+        return None
+    with meta_path.open() as in_file:
+        return json.load(in_file)
+
+
+# Returns the path to an up to date copy of url in cache_dir.
+#
+# is_immutable is called with the metadata of the cached copy, which includes
+# the time at which it was fetched, and can tell us that the cached copy can be
+# used as is without revalidating it.
+def cached_fetch(
+    session: requests.Session,
+    url: str,
+    cache_dir: Path,
+    is_immutable: Optional[Callable[[dict], bool]] = None,
+) -> Path:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    body_path, meta_path = _cache_paths(cache_dir, url)
+
+    meta = load_cache_meta(cache_dir, url)
+    headers = {}
+    if meta is not None:
+        if is_immutable is not None and is_immutable(meta):
+            return body_path
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with session.get(url, headers=headers, stream=True) as resp:
+        if resp.status_code == 304 and meta is not None:
+            meta["fetched_at"] = datetime.now(timezone.utc).isoformat()
+            _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+            return body_path
+
+        resp.raise_for_status()
+        tmp_path = body_path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("wb") as out_file:
+            for b in resp.iter_content(chunk_size=2**16):
+                out_file.write(b)
+        tmp_path.rename(body_path)
+
+        meta = {
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fetched_at": datetime.now(timezone.utc).isoformat(),
+        }
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    return body_path
+
+
+def cached_get(
+    session: requests.Session,
+    url: str,
+    cache_dir: Path,
+    is_immutable: Optional[Callable[[dict], bool]] = None,
+) -> bytes:
+    with cached_fetch(session, url, cache_dir, is_immutable).open("rb") as in_file:
+        return in_file.read()
@@ -0,0 +1,93 @@
+import threading
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import requests
+
+from http_cache import cached_fetch
+
+# Client for the {identifier}_files.xml listing of Internet Archive items.
+#
+# The listing of an item grows with every file we upload to it, so rather than
+# downloading and parsing the whole document every time we need it, we keep
+# a copy on disk that is revalidated at most once per process, and parse it
+# incrementally so that queries don't have to hold every file in memory.
+
+IAItem = namedtuple("IAItem", ["identifier", "filename", "sha1"])
+
+
+class IAMetadataClient:
+    def __init__(self, session: requests.Session, cache_dir: Path):
+        self.session = session
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._listings = {}
+
+    def files_xml_url(self, identifier: str) -> str:
+        return f"https://archive.org/download/{identifier}/{identifier}_files.xml"
+
+    # Returns the path to an up to date copy of the listing, or None when the
+    # item doesn't exist.
+    def _listing_path(self, identifier: str) -> Optional[Path]:
+        with self._lock:
+            if identifier not in self._listings:
+                try:
+                    path = cached_fetch(
+                        self.session, self.files_xml_url(identifier), self.cache_dir
+                    )
+                except requests.HTTPError as exc:
+                    if exc.response is None or exc.response.status_code != 404:
+                        raise
+                    path = None
+                self._listings[identifier] = path
+            return self._listings[identifier]
+
+    # Makes the next query revalidate the listing, eg. after uploading to it
+    def invalidate(self, identifier: str):
+        with self._lock:
+            self._listings.pop(identifier, None)
+
+    def iter_files(self, identifier: str) -> Iterator[IAItem]:
+        path = self._listing_path(identifier)
+        if path is None:
+            return
+
+        root = None
+        for event, elem in ET.iterparse(path, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end" or elem.tag != "file":
+                continue
+
+            fname = elem.get("name")
+            if fname:
+                yield IAItem(
+                    identifier=identifier, filename=fname, sha1=elem.findtext("sha1")
+                )
+            # Drop what we parsed so far, so memory use doesn't grow with the
+            # size of the listing.
+            root.clear()
+
+    def files_matching(self, identifier: str, suffix: str) -> List[IAItem]:
+        return sorted(
+            (
+                itm
+                for itm in self.iter_files(identifier)
+                if itm.filename.endswith(suffix)
+            ),
+            key=lambda x: x.filename,
+            reverse=True,
+        )
+
+    # The files we store in items are named after their date, so the latest is
+    # the one with the greatest filename.
+    def latest(self, identifier: str, suffix: str) -> Optional[IAItem]:
+        latest = None
+        for itm in self.iter_files(identifier):
+            if itm.filename.endswith(suffix) and (
+                latest is None or itm.filename > latest.filename
+            ):
+                latest = itm
+        return latest
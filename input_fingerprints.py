@@ -0,0 +1,176 @@
+import gzip
+import json
+import hashlib
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from as_org_timeline import AsOrgTimeline
+from digest_manifest import default_manifest
+
+# Every output database has a sidecar recording the digests of everything it
+# was built from, so that we rebuild exactly the dates whose inputs changed
+# instead of only checking whether an output exists.
+#
+#   country_db       the .mmdb.gz the output was enriched from
+#   prefix2as_rv2    the routeviews prefix2as files for the day
+#   prefix2as_rv6
+#   as_org_slice     the AS org records in effect on the day for the ASNs
+#                    routed on the day, see below
+#   enricher         the source of the enricher
+
+FINGERPRINT_VERSION = 2
+PREFIX2AS_DIR = Path("cache_dir") / "routeviews-prefix2as"
+ROUTED_ASNS_CACHE_DIR = Path("cache_dir") / "routed-asns"
+ENRICHER_SOURCES = [Path("enrich_country_db.go"), Path("go.mod"), Path("go.sum")]
+
+
+def fingerprint_path(output_path: Path) -> Path:
+    return output_path.with_name(output_path.name + ".inputs.json")
+
+
+def file_digest(path: Path) -> Optional[str]:
+    if not path.exists():
+        return None
+    return default_manifest().digests(path).sha256
+
+
+def prefix2as_path(ip_class: str, day_str: str) -> Path:
+    return PREFIX2AS_DIR / f"routeviews-{ip_class}-{day_str}.pfx2as.gz"
+
+
+def enricher_digest() -> str:
+    h = hashlib.sha256()
+    for path in ENRICHER_SOURCES:
+        h.update(f"{path.name}:{file_digest(path)}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+# Returns the sorted origin ASNs of a prefix2as file. Like the enricher, we
+# only keep the first AS of multi origin (1_2) and AS set (1,2) prefixes.
+def read_origin_asns(path: Path) -> List[int]:
+    as_fields = set()
+    with gzip.open(path, "rb") as in_file:
+        for line in in_file:
+            as_fields.add(line.rstrip(b"\n").rsplit(b"\t", 1)[1])
+    return sorted({int(f.split(b"_")[0].split(b",")[0]) for f in as_fields})
+
+
+# Reading a prefix2as file takes a few seconds, so the ASNs of every file are
+# cached together with the digest of the file they were read from.
+def origin_asns(path: Path, cache_dir: Path = ROUTED_ASNS_CACHE_DIR) -> List[int]:
+    source_sha256 = file_digest(path)
+    if source_sha256 is None:
+        return []
+    cache_path = cache_dir / path.name.replace(".pfx2as.gz", ".json")
+    try:
+        with cache_path.open() as in_file:
+            cached = json.load(in_file)
+        if cached["sha256"] == source_sha256:
+            return cached["asns"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    asns = read_origin_asns(path)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    with tmp_path.open("w") as out_file:
+        json.dump({"sha256": source_sha256, "asns": asns}, out_file)
+    tmp_path.rename(cache_path)
+    return asns
+
+
+# The ASNs the enricher looks up when building the output of day_str
+def routed_asns(day_str: str) -> List[int]:
+    return sorted(
+        set(origin_asns(prefix2as_path("rv2", day_str)))
+        | set(origin_asns(prefix2as_path("rv6", day_str)))
+    )
+
+
+def record_digest(asn: int, record: list) -> int:
+    # Only the fields the enricher writes to the database are part of it
+    org_name, country, _, aut_name, _ = record
+    h = hashlib.sha256(f"{asn}|{org_name}|{country}|{aut_name}".encode("utf-8"))
+    return int.from_bytes(h.digest()[:8], "big")
+
+
+# Returns, for every day_str, a digest of the record that getASMeta in
+# enrich_country_db.go picks on that day for every ASN routed on that day,
+# according to asns_for. Records of ASNs that aren't routed on a day, and
+# records that only come into effect after it, don't change its digest, so
+# adding a new snapshot to all_as_org_map only invalidates the outputs it
+# actually affects.
+#
+# We walk the days in order and apply the records as they come into effect:
+# every ASN starts from its first record, which getASMeta also uses for days
+# before it, and moves to a later one once the day reaches its changed date.
+# The digest of a day is the sum, modulo 2**64, of the digests of the records
+# in effect for its ASNs. ASNs missing from the timeline don't add anything,
+# they are looked up as "Unassigned" until they appear in it.
+def as_org_slice_digests(
+    timeline_path: Path,
+    day_strs: Iterable[str],
+    asns_for: Callable[[str], List[int]] = routed_asns,
+) -> Dict[str, str]:
+    all_asns = []
+    current = []
+    events = []
+    with AsOrgTimeline(timeline_path) as timeline:
+        for asn, history in timeline.iter_histories():
+            slot = len(all_asns)
+            all_asns.append(asn)
+            current.append(record_digest(asn, history[0]))
+            for vals in history[1:]:
+                events.append((vals[2], slot, record_digest(asn, vals)))
+    events.sort(key=lambda e: e[0])
+    all_asns = np.array(all_asns, dtype=np.int64)
+    order = np.argsort(all_asns, kind="stable")
+    sorted_asns = all_asns[order]
+    current = np.array(current, dtype=np.uint64)
+
+    digests = {}
+    event_idx = 0
+    for day_str in sorted(set(day_strs)):
+        while event_idx < len(events) and events[event_idx][0] <= day_str:
+            _, slot, digest = events[event_idx]
+            current[slot] = digest
+            event_idx += 1
+        asns = np.unique(np.array(asns_for(day_str), dtype=np.int64))
+        total = 0
+        if len(sorted_asns):
+            pos = np.minimum(np.searchsorted(sorted_asns, asns), len(sorted_asns) - 1)
+            slots = order[pos[sorted_asns[pos] == asns]]
+            total = int(current[slots].sum())
+        digests[day_str] = format(total, "016x")
+    return digests
+
+
+def input_fingerprint(
+    day_str: str, db_path: Path, as_org_slice: str, enricher: str
+) -> dict:
+    return {
+        "version": FINGERPRINT_VERSION,
+        "country_db": file_digest(db_path.with_name(db_path.name + ".gz")),
+        "prefix2as_rv2": file_digest(prefix2as_path("rv2", day_str)),
+        "prefix2as_rv6": file_digest(prefix2as_path("rv6", day_str)),
+        "as_org_slice": as_org_slice,
+        "enricher": enricher,
+    }
+
+
+def load_fingerprint(output_path: Path) -> Optional[dict]:
+    try:
+        with fingerprint_path(output_path).open() as in_file:
+            return json.load(in_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_fingerprint(output_path: Path, fingerprint: dict):
+    path = fingerprint_path(output_path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as out_file:
+        json.dump(fingerprint, out_file, sort_keys=True, indent=2)
+    tmp_path.rename(path)
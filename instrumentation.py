@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Lightweight instrumentation shared by the pipeline stages.
+#
+# Every stage (sync_db_ip, download_assets, build_all_as_org_map,
+# build_databases, upload_outputs) runs in its own process wrapped in
+# run_stage(), which times the stage and the spans opened inside it, counts
+# the bytes they read, write, download and upload, and records the peak RSS.
+# When the stage ends it writes to METRICS_DIR:
+#
+#   <stage>.json    the run report of the stage
+#   <stage>.prom    the same metrics for the node exporter textfile collector
+#   <stage>.prof    a cProfile dump, when the stage is listed in PROFILE_STAGES
+#
+# `instrumentation.py summarize` merges the reports of a run in
+# run_report.json and prints which stage took how long.
+#
+# Outside of run_stage() spans and counters are no-ops, so the instrumented
+# functions can still be used as a library.
+
+METRICS_DIR = Path(os.environ.get("METRICS_DIR", "metrics"))
+# Comma separated list of stages to profile, or "all"
+PROFILE_STAGES = os.environ.get("PROFILE_STAGES", "")
+BYTE_KINDS = ["read", "written", "downloaded", "uploaded"]
+RUN_REPORT_FILENAME = "run_report.json"
+
+
+@dataclass
+class Span:
+    name: str
+    parent: Optional[str]
+    started_at: float
+    duration: float = 0.0
+    attrs: dict = field(default_factory=dict)
+    bytes: Dict[str, int] = field(default_factory=dict)
+
+
+class StageRecorder:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started_at = time.time()
+        self.t0 = time.monotonic()
+        self.spans: List[Span] = []
+        self.bytes = defaultdict(int)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        stack = self._stack()
+        s = Span(
+            name=name,
+            parent=stack[-1].name if stack else None,
+            started_at=time.time(),
+            attrs=attrs,
+        )
+        stack.append(s)
+        t0 = time.monotonic()
+        try:
+            yield s
+        finally:
+            s.duration = time.monotonic() - t0
+            stack.pop()
+            with self.lock:
+                self.spans.append(s)
+
+    def record_span(self, name: str, duration: float, **attrs):
+        stack = self._stack()
+        s = Span(
+            name=name,
+            parent=stack[-1].name if stack else None,
+            started_at=time.time() - duration,
+            duration=duration,
+            attrs=attrs,
+        )
+        with self.lock:
+            self.spans.append(s)
+
+    # Bytes are counted towards the stage and every span open in the calling
+    # thread, so a span includes what was transferred by the ones nested in it.
+    def add_bytes(self, kind: str, count: int):
+        assert kind in BYTE_KINDS, f"unknown byte counter {kind}"
+        for s in self._stack():
+            s.bytes[kind] = s.bytes.get(kind, 0) + count
+        with self.lock:
+            self.bytes[kind] += count
+
+    def report(self, status: str, profile_path: Optional[Path]) -> dict:
+        duration = time.monotonic() - self.t0
+        # ru_maxrss is in kilobytes on linux and in bytes on macOS
+        rss_unit = 1 if sys.platform == "darwin" else 1024
+        return {
+            "stage": self.stage,
+            "status": status,
+            "started_at": datetime.fromtimestamp(
+                self.started_at, timezone.utc
+            ).isoformat(),
+            "duration": duration,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            * rss_unit,
+            "children_peak_rss_bytes": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss
+            * rss_unit,
+            "bytes": {kind: self.bytes[kind] for kind in BYTE_KINDS},
+            "throughput": {
+                kind: self.bytes[kind] / duration if duration else 0.0
+                for kind in BYTE_KINDS
+            },
+            "spans": [
+                asdict(s) for s in sorted(self.spans, key=lambda s: s.started_at)
+            ],
+            "profile": str(profile_path) if profile_path else None,
+        }
+
+
+_current: Optional[StageRecorder] = None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    if _current is None:
+        yield None
+        return
+    with _current.span(name, **attrs) as s:
+        yield s
+
+
+# For work timed somewhere else, eg. by a worker process
+def record_span(name: str, duration: float, **attrs):
+    if _current is not None:
+        _current.record_span(name, duration, **attrs)
+
+
+def add_bytes(kind: str, count: int):
+    if _current is not None:
+        _current.add_bytes(kind, count)
+
+
+def should_profile(stage: str) -> bool:
+    stages = [s.strip() for s in PROFILE_STAGES.split(",")]
+    return "all" in stages or stage in stages
+
+
+def _write_atomic(path: Path, data: str):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with tmp_path.open("w") as out_file:
+        out_file.write(data)
+    tmp_path.rename(path)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(report: dict) -> str:
+    stage = f'stage="{_label(report["stage"])}"'
+    lines = [
+        "# TYPE geoip_pipeline_stage_duration_seconds gauge",
+        f"geoip_pipeline_stage_duration_seconds{{{stage}}} {report['duration']}",
+        "# TYPE geoip_pipeline_stage_success gauge",
+        f"geoip_pipeline_stage_success{{{stage}}} {int(report['status'] == 'ok')}",
+        "# TYPE geoip_pipeline_stage_last_run_timestamp_seconds gauge",
+        f"geoip_pipeline_stage_last_run_timestamp_seconds{{{stage}}}"
+        f" {datetime.fromisoformat(report['started_at']).timestamp()}",
+        "# TYPE geoip_pipeline_stage_peak_rss_bytes gauge",
+        f"geoip_pipeline_stage_peak_rss_bytes{{{stage}}} {report['peak_rss_bytes']}",
+        f'geoip_pipeline_stage_peak_rss_bytes{{{stage},process="children"}}'
+        f" {report['children_peak_rss_bytes']}",
+        "# TYPE geoip_pipeline_stage_bytes gauge",
+    ]
+    for kind, count in report["bytes"].items():
+        lines.append(f'geoip_pipeline_stage_bytes{{{stage},kind="{kind}"}} {count}')
+
+    # Spans are aggregated by name, per file spans would make for too many
+    # series.
+    totals = defaultdict(lambda: [0, 0.0])
+    for s in report["spans"]:
+        totals[s["name"]][0] += 1
+        totals[s["name"]][1] += s["duration"]
+    lines.append("# TYPE geoip_pipeline_span_duration_seconds summary")
+    for name, (count, total) in sorted(totals.items()):
+        labels = f'{stage},span="{_label(name)}"'
+        lines.append(f"geoip_pipeline_span_duration_seconds_sum{{{labels}}} {total}")
+        lines.append(f"geoip_pipeline_span_duration_seconds_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def run_stage(stage: str):
+    global _current
+    assert _current is None, f"stage {_current.stage} is already running"
+    _current = StageRecorder(stage)
+    profiler = cProfile.Profile() if should_profile(stage) else None
+    profile_path = None
+    status = "failed"
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with _current.span(stage):
+            yield _current
+        status = "ok"
+    finally:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        if profiler is not None:
+            profiler.disable()
+            profile_path = METRICS_DIR / f"{stage}.prof"
+            profiler.dump_stats(profile_path)
+        report = _current.report(status, profile_path)
+        _write_atomic(METRICS_DIR / f"{stage}.json", json.dumps(report, indent=2))
+        _write_atomic(METRICS_DIR / f"{stage}.prom", render_prometheus(report))
+        _current = None
+
+
+def load_stage_reports(metrics_dir: Path) -> List[dict]:
+    reports = []
+    for path in metrics_dir.glob("*.json"):
+        if path.name == RUN_REPORT_FILENAME:
+            continue
+        with path.open() as in_file:
+            reports.append(json.load(in_file))
+    return sorted(reports, key=lambda r: r["started_at"])
+
+
+def summarize(metrics_dir: Path):
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    reports = load_stage_reports(metrics_dir)
+    _write_atomic(
+        metrics_dir / RUN_REPORT_FILENAME, json.dumps({"stages": reports}, indent=2)
+    )
+    print(f"[+] pipeline run report ({metrics_dir / RUN_REPORT_FILENAME})")
+    print(
+        f"    {'stage':<24}{'status':>8}{'duration':>11}{'peak rss':>11}"
+        f"{'read':>11}{'written':>11}{'down':>11}{'up':>11}"
+    )
+    for r in reports:
+        mib = {kind: f"{count / 2**20:.1f}M" for kind, count in r["bytes"].items()}
+        peak_rss = max(r["peak_rss_bytes"], r["children_peak_rss_bytes"])
+        print(
+            f"    {r['stage']:<24}{r['status']:>8}{r['duration']:>10.1f}s"
+            f"{peak_rss / 2**20:>10.0f}M{mib['read']:>11}{mib['written']:>11}"
+            f"{mib['downloaded']:>11}{mib['uploaded']:>11}"
+        )
+
+
+# Removes the reports left by a previous run
+def reset(metrics_dir: Path):
+    for pattern in ["*.json", "*.prom", "*.prof"]:
+        for path in metrics_dir.glob(pattern):
+            path.unlink()
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ("summarize", "reset"):
+        print("Usage: instrumentation.py summarize|reset")
+        sys.exit(1)
+
+    if sys.argv[1] == "reset":
+        reset(METRICS_DIR)
+    else:
+        summarize(METRICS_DIR)
+
+
+if __name__ == "__main__":
+    main()
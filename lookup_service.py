@@ -0,0 +1,302 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import OrderedDict
+from http import HTTPStatus
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+import maxminddb
+
+from historical_geoip import HistoricalGeoIP, index_databases, to_geoip_result
+
+# Small HTTP service answering lookups against the local outputs directory:
+#
+#   GET  /lookup?ip=1.2.3.4&date=20230101
+#   POST /lookup        [{"ip": "1.2.3.4", "date": "20230101"}, ...]
+#   GET  /metrics       latency histograms in the prometheus text format
+#
+# Identical lookups that are in flight at the same time share the same
+# result, recent answers are kept in an LRU and the databases are reloaded
+# whenever latest.yml is rewritten by upload_outputs.generate_latest_yaml.
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0]
+MAX_BODY_SIZE = 16 * 2**20
+
+
+# The label latencies are recorded under. It's one of a fixed set, so that
+# requests for arbitrary paths don't each get a series of their own.
+def endpoint_label(method: str, target: str) -> str:
+    path = urlsplit(target).path
+    if path == "/lookup":
+        return "bulk" if method == "POST" else "lookup"
+    if path == "/metrics":
+        return "metrics"
+    return "other"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for idx, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> str:
+        lines = []
+        cumulative = 0
+        for upper, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{upper}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.total}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return "\n".join(lines)
+
+
+class LookupService:
+    def __init__(self, outputs_dir: Path, cache_size: int = 100_000, max_open: int = 8):
+        self.outputs_dir = outputs_dir
+        self.geoip = HistoricalGeoIP(outputs_dir, max_open=max_open)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.latency = {}
+        self.counters = {"cache_hits": 0, "coalesced": 0, "lookups": 0, "reloads": 0}
+        # Bumped on every reload
+        self.generation = 0
+        self.latest_yml_mtime = self._latest_yml_mtime()
+
+    def _latest_yml_mtime(self) -> Optional[int]:
+        try:
+            return (self.outputs_dir / "latest.yml").stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Only listing the outputs runs on a worker thread, the databases, the
+    # cache and the counters are swapped and updated on the event loop, which
+    # is the only thread that touches them.
+    async def reload(self):
+        loop = asyncio.get_running_loop()
+        databases = await loop.run_in_executor(None, index_databases, self.outputs_dir)
+        self.geoip.set_databases(databases)
+        self.generation += 1
+        self.cache.clear()
+        self.counters["reloads"] += 1
+        print(f"[+] reloaded {len(databases)} databases")
+
+    async def watch_latest_yml(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._latest_yml_mtime()
+            if mtime != self.latest_yml_mtime:
+                self.latest_yml_mtime = mtime
+                await self.reload()
+
+    async def _fetch(self, db, ip: str):
+        loop = asyncio.get_running_loop()
+        record = await loop.run_in_executor(None, self.geoip.lookup_in, db, ip)
+        return to_geoip_result(record)
+
+    async def lookup(self, ip: str, date: str) -> dict:
+        db = self.geoip.database_for(date)
+        key = (ip, db)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.counters["cache_hits"] += 1
+            result = self.cache[key]
+        elif key in self.in_flight:
+            self.counters["coalesced"] += 1
+            result = await asyncio.shield(self.in_flight[key])
+        else:
+            self.counters["lookups"] += 1
+            generation = self.generation
+            task = asyncio.ensure_future(self._fetch(db, ip))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            result = await asyncio.shield(task)
+            # Results of lookups that started before a reload aren't cached
+            if generation != self.generation:
+                return self._response(ip, date, db, result)
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return self._response(ip, date, db, result)
+
+    def _response(self, ip: str, date: str, db, result) -> dict:
+        return {
+            "ip": ip,
+            "date": date,
+            "database": db.path.name,
+            "result": result._asdict() if result else None,
+        }
+
+    def observe(self, endpoint: str, elapsed: float):
+        self.latency.setdefault(endpoint, Histogram()).observe(elapsed)
+
+    def render_metrics(self) -> str:
+        lines = [
+            "# TYPE geoip_lookup_latency_seconds histogram",
+        ]
+        for endpoint, histogram in sorted(self.latency.items()):
+            lines.append(
+                histogram.render(
+                    "geoip_lookup_latency_seconds", f'endpoint="{endpoint}"'
+                )
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE geoip_{name}_total counter")
+            lines.append(f"geoip_{name}_total {value}")
+        lines.append("# TYPE geoip_cache_entries gauge")
+        lines.append(f"geoip_cache_entries {len(self.cache)}")
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        if url.path == "/metrics" and method == "GET":
+            return HTTPStatus.OK, "text/plain; version=0.0.4", self.render_metrics()
+
+        if url.path != "/lookup":
+            return HTTPStatus.NOT_FOUND, "application/json", {"error": "not found"}
+
+        if method == "GET":
+            query = parse_qs(url.query)
+            if "ip" not in query or "date" not in query:
+                return (
+                    HTTPStatus.BAD_REQUEST,
+                    "application/json",
+                    {"error": "ip and date are required"},
+                )
+            resp = await self.lookup(query["ip"][0], query["date"][0])
+            return HTTPStatus.OK, "application/json", resp
+
+        if method == "POST":
+            queries = json.loads(body)
+            resp = await asyncio.gather(
+                *(self.lookup(q["ip"], q["date"]) for q in queries)
+            )
+            return HTTPStatus.OK, "application/json", resp
+
+        return (
+            HTTPStatus.METHOD_NOT_ALLOWED,
+            "application/json",
+            {"error": "method not allowed"},
+        )
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                content_length = int(headers.get("content-length", "0"))
+                if content_length > MAX_BODY_SIZE:
+                    break
+                body = await reader.readexactly(content_length)
+
+                t0 = time.perf_counter()
+                try:
+                    status, content_type, resp = await self.handle_request(
+                        method, target, body
+                    )
+                except (ValueError, KeyError, TypeError, LookupError) as exc:
+                    status, content_type, resp = (
+                        HTTPStatus.BAD_REQUEST,
+                        "application/json",
+                        {"error": str(exc)},
+                    )
+                except (OSError, maxminddb.InvalidDatabaseError) as exc:
+                    # A database that was removed or replaced since the last
+                    # reload, the next one picks up what is there now
+                    status, content_type, resp = (
+                        HTTPStatus.SERVICE_UNAVAILABLE,
+                        "application/json",
+                        {"error": str(exc)},
+                    )
+                self.observe(endpoint_label(method, target), time.perf_counter() - t0)
+
+                if not isinstance(resp, str):
+                    resp = json.dumps(resp)
+                payload = resp.encode("utf-8")
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    service = LookupService(
+        args.outputs_dir, cache_size=args.cache_size, max_open=args.max_open
+    )
+    server = await asyncio.start_server(
+        service.handle_connection, host=args.host, port=args.port
+    )
+    print(
+        f"[+] serving {len(service.geoip.databases)} databases on {args.host}:{args.port}"
+    )
+    watcher = asyncio.create_task(service.watch_latest_yml(args.reload_interval))
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            watcher.cancel()
+            service.geoip.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves ip2country_as lookups")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--outputs-dir", type=Path, default=Path("outputs"))
+    parser.add_argument("--cache-size", type=int, default=100_000)
+    parser.add_argument("--max-open", type=int, default=8)
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=10.0,
+        help="how often, in seconds, latest.yml is checked for changes",
+    )
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
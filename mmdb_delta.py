@@ -0,0 +1,410 @@
+import sys
+import gzip
+import json
+import struct
+import hashlib
+import argparse
+import ipaddress
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import maxminddb
+
+from diff_databases import iter_changed_leaves
+from digest_manifest import default_manifest
+from mmdb_tree import MMDBTree
+from mmdb_writer import MMDBWriter
+
+# Deltas between consecutive ip2country_as outputs, so that whoever has the
+# previous database can update to the next one without downloading it in full.
+#
+# A delta lists the ranges of addresses whose record changed together with
+# their new record, and names the database it applies to along with its
+# digests. It's a gzip compressed file made of:
+#
+#   DELTA_MAGIC
+#   the length of the header as a big endian uint32
+#   the header, as JSON, see create_delta
+#   range_count ranges, each the first and last address of the range, in the
+#   address space of the search tree (16 bytes for IPv6 databases, 4 for IPv4
+#   ones), and the index of its record in the header, or NO_RECORD when the
+#   range was removed, as a big endian uint32
+#
+# The enricher's writer lays out the search tree and data section in ways we
+# can't reproduce, so a database rebuilt from a delta has the same networks
+# and records as the original but not the same bytes. Both are checked against
+# a content digest instead, computed over every range of addresses and its
+# record, which latest.yml also publishes as content_sha256.
+
+DELTA_VERSION = 1
+DELTA_MAGIC = b"MMDBDELTA\x00"
+NO_RECORD = 2**32 - 1
+# Metadata of the new database that is carried over by the delta
+DELTA_METADATA_FIELDS = ["database_type", "description", "languages", "build_epoch"]
+# Networks that the writers of IPv6 databases point back to the IPv4 subtree,
+# the IPv4 address being the 32 bits that follow the prefix
+IPV4_ALIAS_NETWORKS = [
+    ipaddress.IPv6Network("::ffff:0:0/96"),
+    ipaddress.IPv6Network("2001::/32"),
+    ipaddress.IPv6Network("2002::/16"),
+]
+
+
+@dataclass
+class Delta:
+    header: dict
+    # (first, last, record index)
+    ranges: List[Tuple[int, int, int]]
+
+    def record(self, idx: int) -> Optional[dict]:
+        if idx == NO_RECORD:
+            return None
+        return self.header["records"][idx]
+
+
+def delta_path(output_path: Path) -> Path:
+    return output_path.with_name(output_path.name + ".delta.gz")
+
+
+def file_sha256(path: Path) -> str:
+    return default_manifest().digests(path).sha256
+
+
+def canonical_record(record) -> str:
+    return json.dumps(record, sort_keys=True, separators=(",", ":"))
+
+
+def tree_record_cache(tree: MMDBTree):
+    @lru_cache(maxsize=2**16)
+    def canonical(record: int) -> Optional[str]:
+        if tree.is_empty(record):
+            return None
+        return canonical_record(tree.decode(record))
+
+    return canonical
+
+
+# Yields (first, last, canonical record) for every range of addresses with the
+# same record, regardless of how the search tree splits it in networks.
+def iter_content_ranges(tree: MMDBTree) -> Iterator[Tuple[int, int, str]]:
+    canonical = tree_record_cache(tree)
+    current = None
+    for ip_acc, prefix_len, record in tree.iter_leaves():
+        last = ip_acc + 2 ** (tree.bit_count - prefix_len) - 1
+        value = canonical(record)
+        if current is not None and current[1] + 1 == ip_acc and current[2] == value:
+            current[1] = last
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [ip_acc, last, value]
+    if current is not None:
+        yield tuple(current)
+
+
+def content_digest(tree: MMDBTree) -> str:
+    h = hashlib.sha256()
+    for first, last, value in iter_content_ranges(tree):
+        h.update(f"{first}-{last}:{value}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def find_ipv4_aliases(tree: MMDBTree) -> List[List[int]]:
+    aliases = []
+    if tree.ip_version != 6:
+        return aliases
+    for network in IPV4_ALIAS_NETWORKS:
+        ip_acc = int(network.network_address)
+        record = 0
+        for depth in range(network.prefixlen):
+            if not tree.is_node(record):
+                break
+            record = tree.read_node(record, (ip_acc >> (127 - depth)) & 1)
+        if tree.is_ipv4_alias(record, ip_acc):
+            aliases.append([ip_acc, network.prefixlen])
+    return aliases
+
+
+def create_delta(base_path: Path, new_path: Path) -> Delta:
+    with MMDBTree(base_path) as base, MMDBTree(new_path) as new:
+        records, record_ids = [], {}
+        ranges = []
+        for ip_acc, prefix_len, _, value in iter_changed_leaves(
+            base, new, tree_record_cache
+        ):
+            last = ip_acc + 2 ** (new.bit_count - prefix_len) - 1
+            idx = NO_RECORD
+            if value is not None:
+                idx = record_ids.get(value)
+                if idx is None:
+                    idx = record_ids[value] = len(records)
+                    records.append(json.loads(value))
+            if ranges and ranges[-1][1] + 1 == ip_acc and ranges[-1][2] == idx:
+                ranges[-1][1] = last
+            else:
+                ranges.append([ip_acc, last, idx])
+
+        header = {
+            "version": DELTA_VERSION,
+            "ip_version": new.ip_version,
+            "base": {
+                "filename": base_path.name,
+                "sha256": file_sha256(base_path),
+                "content_sha256": content_digest(base),
+            },
+            "new": {
+                "filename": new_path.name,
+                "sha256": file_sha256(new_path),
+                "content_sha256": content_digest(new),
+            },
+            "metadata": {
+                k: new.metadata[k] for k in DELTA_METADATA_FIELDS if k in new.metadata
+            },
+            "ipv4_aliases": find_ipv4_aliases(new),
+            "records": records,
+            "range_count": len(ranges),
+        }
+    return Delta(header=header, ranges=[tuple(r) for r in ranges])
+
+
+def _address_size(header: dict) -> int:
+    return 16 if header["ip_version"] == 6 else 4
+
+
+def write_delta(delta: Delta, path: Path):
+    header = json.dumps(delta.header, sort_keys=True).encode("utf-8")
+    addr_size = _address_size(delta.header)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp_path, "wb", compresslevel=9) as out_file:
+        out_file.write(DELTA_MAGIC)
+        out_file.write(struct.pack(">I", len(header)))
+        out_file.write(header)
+        for first, last, idx in delta.ranges:
+            out_file.write(
+                first.to_bytes(addr_size, "big")
+                + last.to_bytes(addr_size, "big")
+                + idx.to_bytes(4, "big")
+            )
+    tmp_path.rename(path)
+
+
+def _read_header(in_file) -> dict:
+    magic = in_file.read(len(DELTA_MAGIC))
+    assert magic == DELTA_MAGIC, "not a delta file"
+    (header_len,) = struct.unpack(">I", in_file.read(4))
+    header = json.loads(in_file.read(header_len))
+    assert (
+        header["version"] == DELTA_VERSION
+    ), f"unsupported delta version {header['version']}"
+    return header
+
+
+def read_delta_header(path: Path) -> dict:
+    with gzip.open(path, "rb") as in_file:
+        return _read_header(in_file)
+
+
+# Returns the header of the delta of new_path when it was made from new_path
+# and its base as they are now, None otherwise. A delta can outlive the
+# database it was made for, eg. when writing it failed after the database was
+# rebuilt.
+def current_delta_header(new_path: Path) -> Optional[dict]:
+    path = delta_path(new_path)
+    if not path.exists() or not new_path.exists():
+        return None
+    try:
+        header = read_delta_header(path)
+    except (OSError, ValueError, AssertionError):
+        return None
+    base_path = new_path.with_name(header["base"]["filename"])
+    if not base_path.exists():
+        return None
+    if header["new"]["sha256"] != file_sha256(new_path):
+        return None
+    if header["base"]["sha256"] != file_sha256(base_path):
+        return None
+    return header
+
+
+def read_delta(path: Path) -> Delta:
+    with gzip.open(path, "rb") as in_file:
+        header = _read_header(in_file)
+        addr_size = _address_size(header)
+        row_size = 2 * addr_size + 4
+        data = in_file.read()
+    assert len(data) == header["range_count"] * row_size, f"{path} is truncated"
+
+    ranges = []
+    for offset in range(0, len(data), row_size):
+        row = data[offset : offset + row_size]
+        ranges.append(
+            (
+                int.from_bytes(row[:addr_size], "big"),
+                int.from_bytes(row[addr_size : 2 * addr_size], "big"),
+                int.from_bytes(row[2 * addr_size :], "big"),
+            )
+        )
+    return Delta(header=header, ranges=ranges)
+
+
+# The base database either is the very file the delta was made against or,
+# eg. when it was itself rebuilt from a delta, has the same content.
+def check_base(base_path: Path, delta: Delta):
+    base = delta.header["base"]
+    if file_sha256(base_path) == base["sha256"]:
+        return
+    with MMDBTree(base_path) as tree:
+        assert (
+            content_digest(tree) == base["content_sha256"]
+        ), f"{base_path} is not {base['filename']}, the base of this delta"
+
+
+def apply_delta(base_path: Path, delta: Delta, output_path: Path):
+    check_base(base_path, delta)
+    with MMDBTree(base_path) as tree:
+        writer = MMDBWriter.from_tree(tree)
+    for first, last, idx in delta.ranges:
+        writer.insert_range(first, last, delta.record(idx))
+    for key, value in delta.header["metadata"].items():
+        setattr(writer, key, value)
+    writer.ipv4_aliases = [tuple(alias) for alias in delta.header["ipv4_aliases"]]
+
+    tmp_path = output_path.with_name(output_path.name + ".unverified")
+    writer.write(tmp_path)
+    with MMDBTree(tmp_path) as tree:
+        digest = content_digest(tree)
+    if digest != delta.header["new"]["content_sha256"]:
+        tmp_path.unlink()
+        raise AssertionError(
+            f"{output_path} doesn't match the content of {delta.header['new']['filename']}"
+        )
+    tmp_path.rename(output_path)
+
+
+# Answers lookups for the new database from the base one and the delta,
+# without writing the new database out.
+class DeltaOverlay:
+    def __init__(self, base_path: Path, delta: Delta):
+        check_base(base_path, delta)
+        self.delta = delta
+        self.reader = maxminddb.open_database(str(base_path))
+        self.firsts = [first for first, _, _ in delta.ranges]
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, ip: str):
+        addr = ipaddress.ip_address(ip)
+        # IPv4 addresses live in ::/96 of IPv6 databases, so their place in the
+        # address space of the tree is the same for both
+        ip_acc = int(addr)
+        if addr.version == 6:
+            for alias_acc, prefix_len in self.delta.header["ipv4_aliases"]:
+                if ip_acc >> (128 - prefix_len) == alias_acc >> (128 - prefix_len):
+                    ip_acc = (ip_acc >> (96 - prefix_len)) & 0xFFFFFFFF
+                    break
+        if addr.version == 4 or self.delta.header["ip_version"] == 6:
+            idx = bisect_right(self.firsts, ip_acc) - 1
+            if idx >= 0 and ip_acc <= self.delta.ranges[idx][1]:
+                return self.delta.record(self.delta.ranges[idx][2])
+        return self.reader.get(ip)
+
+
+def read_latest_yaml(path: Path) -> dict:
+    latest = {}
+    with path.open() as in_file:
+        for line in in_file:
+            key, _, value = line.partition(":")
+            if value:
+                latest[key.strip()] = value.strip()
+    return latest
+
+
+# Checks that delta is the one latest.yml points to and that it produces the
+# database latest.yml describes.
+def check_latest(latest_path: Path, delta_file: Path, delta: Delta):
+    latest = read_latest_yaml(latest_path)
+    new_name = delta.header["new"]["filename"]
+    assert (
+        latest.get("filename") == f"{new_name}.gz"
+    ), f"{latest_path} is about {latest.get('filename')}, not {new_name}"
+    assert (
+        latest.get("content_sha256") == delta.header["new"]["content_sha256"]
+    ), f"{delta_file} doesn't produce the database in {latest_path}"
+    if latest.get("delta_filename") == delta_file.name:
+        assert latest.get("delta_sha256") == file_sha256(
+            delta_file
+        ), f"{delta_file} doesn't match the digest in {latest_path}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Creates and applies deltas between ip2country_as databases"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create")
+    create_parser.add_argument("base_db", type=Path)
+    create_parser.add_argument("new_db", type=Path)
+    create_parser.add_argument(
+        "--output", type=Path, help="defaults to the new database with .delta.gz"
+    )
+
+    apply_parser = subparsers.add_parser(
+        "apply", help="rebuild the new database from the base one and the delta"
+    )
+    apply_parser.add_argument("base_db", type=Path)
+    apply_parser.add_argument("delta", type=Path)
+    apply_parser.add_argument("output", type=Path)
+    apply_parser.add_argument(
+        "--latest-yml", type=Path, help="also check the result against latest.yml"
+    )
+
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="look up addresses in the new database without rebuilding it"
+    )
+    lookup_parser.add_argument("base_db", type=Path)
+    lookup_parser.add_argument("delta", type=Path)
+    lookup_parser.add_argument("ips", nargs="+")
+    lookup_parser.add_argument("--latest-yml", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "create":
+        output = args.output or delta_path(args.new_db)
+        delta = create_delta(args.base_db, args.new_db)
+        write_delta(delta, output)
+        print(
+            f"[+] wrote {output}: {len(delta.ranges)} changed ranges,"
+            f" {len(delta.header['records'])} records,"
+            f" {output.stat().st_size} bytes"
+        )
+        return
+
+    delta = read_delta(args.delta)
+    try:
+        if args.latest_yml:
+            check_latest(args.latest_yml, args.delta, delta)
+        if args.command == "apply":
+            apply_delta(args.base_db, delta, args.output)
+            print(f"[+] wrote {args.output}")
+            return
+
+        with DeltaOverlay(args.base_db, delta) as overlay:
+            for ip in args.ips:
+                print(f"{ip}\t{json.dumps(overlay.get(ip), sort_keys=True)}")
+    except AssertionError as exc:
+        print(f"[-] {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import mmap
+import ipaddress
+from pathlib import Path
+from typing import Iterator, Tuple
+
+from maxminddb.decoder import Decoder
+
+# Direct access to the search tree of an mmdb file, for the tools that need
+# to look at every network in a database rather than at single addresses.
+#
+# See: https://maxmind.github.io/MaxMind-DB/
+
+METADATA_START_MARKER = b"\xab\xcd\xefMaxMind.com"
+DATA_SECTION_SEPARATOR_SIZE = 16
+IPV4_MAX_NUM = 2**32 - 1
+
+
+class MMDBTree:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as in_file:
+            self.buffer = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        metadata_start = self.buffer.rfind(
+            METADATA_START_MARKER, max(0, len(self.buffer) - 128 * 1024)
+        )
+        assert metadata_start != -1, f"{path} is not a valid mmdb file"
+        metadata_start += len(METADATA_START_MARKER)
+        self.metadata, _ = Decoder(self.buffer, metadata_start).decode(metadata_start)
+
+        self.node_count = self.metadata["node_count"]
+        self.record_size = self.metadata["record_size"]
+        self.ip_version = self.metadata["ip_version"]
+        self.bit_count = 128 if self.ip_version == 6 else 32
+        self.node_byte_size = self.record_size // 4
+        self.search_tree_size = self.node_count * self.node_byte_size
+        self.decoder = Decoder(
+            self.buffer, self.search_tree_size + DATA_SECTION_SEPARATOR_SIZE
+        )
+        assert self.record_size in (24, 28, 32), f"bad record size {self.record_size}"
+
+        self.ipv4_start = 0
+        if self.ip_version == 6:
+            node = 0
+            for _ in range(96):
+                if node >= self.node_count:
+                    break
+                node = self.read_node(node, 0)
+            self.ipv4_start = node
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_node(self, node: int, index: int) -> int:
+        base_offset = node * self.node_byte_size
+        buf = self.buffer
+        if self.record_size == 24:
+            offset = base_offset + index * 3
+            return int.from_bytes(buf[offset : offset + 3], "big")
+        if self.record_size == 28:
+            if index:
+                return (
+                    int.from_bytes(buf[base_offset + 3 : base_offset + 7], "big")
+                    & 0x0FFFFFFF
+                )
+            return ((buf[base_offset + 3] & 0xF0) << 20) | int.from_bytes(
+                buf[base_offset : base_offset + 3], "big"
+            )
+        offset = base_offset + index * 4
+        return int.from_bytes(buf[offset : offset + 4], "big")
+
+    def is_node(self, record: int) -> bool:
+        return record < self.node_count
+
+    def is_empty(self, record: int) -> bool:
+        return record == self.node_count
+
+    # Aliased subtrees, such as ::ffff:0:0/96 and 2002::/16, point back to the
+    # IPv4 subtree. We only walk it once, from ::/96.
+    def is_ipv4_alias(self, record: int, ip_acc: int) -> bool:
+        return (
+            self.ip_version == 6
+            and ip_acc != 0
+            and record == self.ipv4_start
+            and self.is_node(record)
+        )
+
+    def decode(self, record: int):
+        resolved = record - self.node_count + self.search_tree_size
+        assert resolved < len(self.buffer), f"{self.path} search tree is corrupt"
+        data, _ = self.decoder.decode(resolved)
+        return data
+
+    def children(self, record: int, depth: int, ip_acc: int):
+        for index in (0, 1):
+            child_acc = ip_acc | (index << (self.bit_count - depth - 1))
+            child = self.read_node(record, index)
+            if not self.is_ipv4_alias(child, child_acc):
+                yield child, depth + 1, child_acc
+
+    # Yields (ip_acc, prefix_len, record) for every leaf of the tree in address
+    # order, where ip_acc is the first address of the network in the address
+    # space of the tree. Empty leaves are included when include_empty is set.
+    #
+    # The walk is depth first with an explicit stack, so memory is bounded by
+    # the depth of the tree.
+    def iter_leaves(
+        self, include_empty: bool = False
+    ) -> Iterator[Tuple[int, int, int]]:
+        stack = [(0, 0, 0)]
+        while stack:
+            record, depth, ip_acc = stack.pop()
+            if self.is_node(record):
+                stack.extend(reversed(list(self.children(record, depth, ip_acc))))
+            elif include_empty or not self.is_empty(record):
+                yield ip_acc, depth, record
+
+    def iter_networks(self, include_empty: bool = False):
+        for ip_acc, prefix_len, record in self.iter_leaves(include_empty):
+            yield to_network(ip_acc, prefix_len, self.bit_count), record
+
+
+def is_ipv4(ip_acc: int, prefix_len: int, bit_count: int) -> bool:
+    if bit_count == 32:
+        return True
+    return prefix_len >= 96 and ip_acc <= IPV4_MAX_NUM
+
+
+def to_network(ip_acc: int, prefix_len: int, bit_count: int):
+    if is_ipv4(ip_acc, prefix_len, bit_count):
+        return ipaddress.IPv4Network((ip_acc, prefix_len - (bit_count - 32)))
+    return ipaddress.IPv6Network((ip_acc, prefix_len))
@@ -0,0 +1,271 @@
+import time
+import struct
+import ipaddress
+from pathlib import Path
+from typing import List, Optional
+
+from mmdb_tree import DATA_SECTION_SEPARATOR_SIZE, METADATA_START_MARKER, MMDBTree
+
+# Minimal writer for the MaxMind DB format, used to generate synthetic
+# databases and to rebuild outputs from a base database and a delta, see
+# mmdb_delta.py.
+#
+# See: https://maxmind.github.io/MaxMind-DB/
+
+
+class MMDBWriter:
+    def __init__(
+        self,
+        ip_version: int = 6,
+        database_type: str = "GeoLite2-Country",
+        description: Optional[dict] = None,
+        languages: Optional[List[str]] = None,
+        build_epoch: Optional[int] = None,
+    ):
+        assert ip_version in (4, 6)
+        self.ip_version = ip_version
+        self.bit_count = 128 if ip_version == 6 else 32
+        self.database_type = database_type
+        self.description = description if description is not None else {}
+        self.languages = languages if languages is not None else ["en"]
+        # Defaults to the time the database is written
+        self.build_epoch = build_epoch
+        # Every node is a [left, right] list, where each side is another node,
+        # None when empty or ("data", idx) for a record
+        self.root = [None, None]
+        self.records = []
+        self.record_index = {}
+        # (ip_acc, prefix_len) of the networks that point back to the IPv4
+        # subtree, such as ::ffff:0:0/96
+        self.ipv4_aliases = []
+
+    # Copies the search tree and the records of an existing database, so that
+    # networks inserted afterwards change it rather than starting from scratch.
+    @classmethod
+    def from_tree(cls, tree: MMDBTree):
+        metadata = tree.metadata
+        writer = cls(
+            ip_version=tree.ip_version,
+            database_type=metadata["database_type"],
+            description=metadata.get("description"),
+            languages=metadata.get("languages"),
+            build_epoch=metadata.get("build_epoch"),
+        )
+        refs = {}
+
+        def ref(record: int):
+            if tree.is_empty(record):
+                return None
+            if record not in refs:
+                refs[record] = writer._record_ref(tree.decode(record))
+            return refs[record]
+
+        stack = [(0, writer.root, 0, 0)]
+        while stack:
+            node, out, depth, ip_acc = stack.pop()
+            for index in (0, 1):
+                child_acc = ip_acc | (index << (tree.bit_count - depth - 1))
+                child = tree.read_node(node, index)
+                if tree.is_ipv4_alias(child, child_acc):
+                    writer.ipv4_aliases.append((child_acc, depth + 1))
+                elif tree.is_node(child):
+                    out[index] = [None, None]
+                    stack.append((child, out[index], depth + 1, child_acc))
+                else:
+                    out[index] = ref(child)
+        return writer
+
+    def _record_ref(self, record: Optional[dict]):
+        if record is None:
+            return None
+        key = repr(sorted(record.items()))
+        if key not in self.record_index:
+            self.record_index[key] = len(self.records)
+            self.records.append(record)
+        return ("data", self.record_index[key])
+
+    # ip_acc is the first address of the network in the address space of the
+    # tree and ref what _record_ref returned for its record.
+    def _insert(self, ip_acc: int, prefix_len: int, ref):
+        node = self.root
+        for depth in range(prefix_len - 1):
+            bit = (ip_acc >> (self.bit_count - 1 - depth)) & 1
+            child = node[bit]
+            if not isinstance(child, list):
+                # Split the record that covers this address into both halves
+                child = node[bit] = [child, child]
+            node = child
+        node[(ip_acc >> (self.bit_count - prefix_len)) & 1] = ref
+
+    # Networks are inserted in order, a network replaces whatever the ones
+    # inserted before it assigned to the same addresses. A None record removes
+    # the network from the database.
+    def insert(self, network: str, record: Optional[dict]):
+        net = ipaddress.ip_network(network, strict=False)
+        addr, prefix_len = int(net.network_address), net.prefixlen
+        if net.version == 4 and self.ip_version == 6:
+            # IPv4 addresses live in ::/96 of IPv6 databases
+            prefix_len += 96
+        else:
+            assert net.version == self.ip_version, f"can't insert {network}"
+        self._insert(addr, prefix_len, self._record_ref(record))
+
+    # Same as insert, for the range of addresses [first, last] of the address
+    # space of the tree.
+    def insert_range(self, first: int, last: int, record: Optional[dict]):
+        address = (
+            ipaddress.IPv6Address if self.ip_version == 6 else ipaddress.IPv4Address
+        )
+        ref = self._record_ref(record)
+        for net in ipaddress.summarize_address_range(address(first), address(last)):
+            self._insert(int(net.network_address), net.prefixlen, ref)
+
+    def _link_ipv4_aliases(self):
+        if not self.ipv4_aliases:
+            return
+        ipv4_node = self.root
+        for _ in range(96):
+            if not isinstance(ipv4_node, list):
+                break
+            ipv4_node = ipv4_node[0]
+        for ip_acc, prefix_len in self.ipv4_aliases:
+            node = self.root
+            for depth in range(prefix_len - 1):
+                bit = (ip_acc >> (self.bit_count - 1 - depth)) & 1
+                if not isinstance(node[bit], list):
+                    node[bit] = [node[bit], node[bit]]
+                node = node[bit]
+            node[(ip_acc >> (self.bit_count - prefix_len)) & 1] = ipv4_node
+
+    def _number_nodes(self) -> List[list]:
+        # Aliases make the IPv4 subtree reachable from more than one place,
+        # it's only numbered once.
+        nodes = []
+        seen = set()
+        queue = [self.root]
+        while queue:
+            node = queue.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            nodes.append(node)
+            for child in reversed(node):
+                if isinstance(child, list):
+                    queue.append(child)
+        return nodes
+
+    def write(self, path: Path):
+        data = bytearray()
+        offsets = []
+        for record in self.records:
+            offsets.append(len(data))
+            data += encode_value(record)
+
+        self._link_ipv4_aliases()
+        nodes = self._number_nodes()
+        node_ids = {id(node): idx for idx, node in enumerate(nodes)}
+        node_count = len(nodes)
+        max_value = node_count + DATA_SECTION_SEPARATOR_SIZE + len(data)
+        record_size = 24 if max_value < 2**24 else 28 if max_value < 2**28 else 32
+
+        def value(child) -> int:
+            if child is None:
+                return node_count
+            if isinstance(child, list):
+                return node_ids[id(child)]
+            return node_count + DATA_SECTION_SEPARATOR_SIZE + offsets[child[1]]
+
+        tree = bytearray()
+        for node in nodes:
+            left, right = value(node[0]), value(node[1])
+            if record_size == 24:
+                tree += left.to_bytes(3, "big") + right.to_bytes(3, "big")
+            elif record_size == 28:
+                tree += (left & 0xFFFFFF).to_bytes(3, "big")
+                tree.append(((left >> 20) & 0xF0) | (right >> 24))
+                tree += (right & 0xFFFFFF).to_bytes(3, "big")
+            else:
+                tree += left.to_bytes(4, "big") + right.to_bytes(4, "big")
+
+        build_epoch = self.build_epoch
+        if build_epoch is None:
+            build_epoch = int(time.time())
+        metadata = {
+            "binary_format_major_version": Uint(2, 16),
+            "binary_format_minor_version": Uint(0, 16),
+            "build_epoch": Uint(build_epoch, 64),
+            "database_type": self.database_type,
+            "description": self.description,
+            "ip_version": Uint(self.ip_version, 16),
+            "languages": self.languages,
+            "node_count": Uint(node_count, 32),
+            "record_size": Uint(record_size, 16),
+        }
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as out_file:
+            out_file.write(tree)
+            out_file.write(b"\x00" * DATA_SECTION_SEPARATOR_SIZE)
+            out_file.write(data)
+            out_file.write(METADATA_START_MARKER)
+            out_file.write(encode_value(metadata))
+        tmp_path.rename(path)
+
+
+# Unsigned integers have different types depending on their width, plain ints
+# are written with the narrowest of uint32, uint64 and uint128 that fits them
+# and negative ones as int32.
+class Uint:
+    def __init__(self, value: int, bits: int):
+        self.value = value
+        self.bits = bits
+
+
+UINT_TYPES = {16: 5, 32: 6, 64: 9, 128: 10}
+
+
+def _control(type_num: int, size: int) -> bytes:
+    if size < 29:
+        size_bits, extra = size, b""
+    elif size < 285:
+        size_bits, extra = 29, bytes([size - 29])
+    elif size < 65821:
+        size_bits, extra = 30, (size - 285).to_bytes(2, "big")
+    else:
+        size_bits, extra = 31, (size - 65821).to_bytes(3, "big")
+
+    if type_num <= 7:
+        return bytes([(type_num << 5) | size_bits]) + extra
+    # Extended types have type 0 in the control byte and type - 7 after it
+    return bytes([size_bits, type_num - 7]) + extra
+
+
+def encode_value(value) -> bytes:
+    if isinstance(value, bool):
+        return _control(14, int(value))
+    if isinstance(value, int) and value < 0:
+        return _control(8, 4) + value.to_bytes(4, "big", signed=True)
+    if isinstance(value, int):
+        bits = 32 if value < 2**32 else 64 if value < 2**64 else 128
+        value = Uint(value, bits)
+    if isinstance(value, Uint):
+        payload = value.value.to_bytes((value.value.bit_length() + 7) // 8, "big")
+        return _control(UINT_TYPES[value.bits], len(payload)) + payload
+    if isinstance(value, float):
+        return _control(3, 8) + struct.pack(">d", value)
+    if isinstance(value, str):
+        payload = value.encode("utf-8")
+        return _control(2, len(payload)) + payload
+    if isinstance(value, bytes):
+        return _control(4, len(value)) + value
+    if isinstance(value, dict):
+        out = bytearray(_control(7, len(value)))
+        for k, v in value.items():
+            out += encode_value(k)
+            out += encode_value(v)
+        return bytes(out)
+    if isinstance(value, list):
+        out = bytearray(_control(11, len(value)))
+        for v in value:
+            out += encode_value(v)
+        return bytes(out)
+    raise TypeError(f"can't encode {value!r}")
@@ -0,0 +1,386 @@
+import os
+import sys
+import gzip
+import json
+import socket
+import shutil
+import argparse
+import ipaddress
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import maxminddb
+import numpy as np
+
+from input_fingerprints import PREFIX2AS_DIR, file_digest, prefix2as_path
+
+# Interval index over the routeviews prefix2as files, for annotating addresses
+# with ASNs in python without going through the enriched databases, eg. for
+# dates they don't cover, and for checking what the enricher wrote.
+#
+# The prefixes of a file are flattened into sorted, non overlapping
+# [start, end] intervals, each with the ASN of the most specific prefix that
+# covers it, so that a lookup is a single searchsorted over the starts. IPv6
+# addresses don't fit in a numpy integer, so they are split in two uint64
+# halves.
+#
+# Building the index takes a few seconds, so the arrays are cached as .npy
+# files in INDEX_CACHE_DIR and memory mapped on later loads.
+#
+#   index = Prefix2AS.for_day("20230101")
+#   asns = index.lookup(["8.8.8.8", "2001:4860:4860::8888"])
+
+INDEX_VERSION = 1
+INDEX_CACHE_DIR = Path("cache_dir") / "prefix2as-index"
+
+# Set in the flags of an interval whose prefix has more than one origin (1_2)
+# or is announced with an AS set (1,2). Like the enricher we keep the first AS.
+MULTI_ORIGIN = 1
+AS_SET = 2
+
+
+def parse_origin(as_field: bytes) -> Tuple[int, int]:
+    flags = 0
+    if b"_" in as_field:
+        flags |= MULTI_ORIGIN
+    if b"," in as_field:
+        flags |= AS_SET
+    try:
+        return int(as_field.split(b"_")[0].split(b",")[0]), flags
+    except ValueError:
+        print(f"Invalid ASN {as_field}")
+        raise
+
+
+# Returns (start, end, asn, flags) for every line of a prefix2as file, sorted
+# by start with the less specific prefixes first.
+def read_prefixes(path: Path, ip_version: int) -> List[tuple]:
+    family = socket.AF_INET if ip_version == 4 else socket.AF_INET6
+    bits = 32 if ip_version == 4 else 128
+    prefixes = []
+    with gzip.open(path, "rb") as in_file:
+        for line in in_file:
+            addr, prefix_len, as_field = line.rstrip(b"\n").split(b"\t")
+            start = int.from_bytes(
+                socket.inet_pton(family, addr.decode("ascii")), "big"
+            )
+            size = 1 << (bits - int(prefix_len))
+            # Same as net.ParseCIDR, host bits are dropped
+            start &= ~(size - 1)
+            asn, flags = parse_origin(as_field)
+            prefixes.append((start, start + size - 1, asn, flags))
+    # The sort is stable, so when a prefix is listed twice the last one wins
+    prefixes.sort(key=lambda p: (p[0], -p[1]))
+    return prefixes
+
+
+# Prefixes are either nested or disjoint, so we sweep them in order keeping the
+# prefixes that enclose the current one on a stack, and emit the parts of every
+# prefix that are not covered by a more specific one. Adjacent intervals with
+# the same origin are merged.
+#
+# The prefix2as files are sorted by address and prefix length, so this is also
+# what the enricher ends up with by inserting them in order.
+def flatten_prefixes(prefixes: List[tuple]) -> List[list]:
+    intervals = []
+
+    def emit(start, end, asn, flags):
+        if intervals:
+            last = intervals[-1]
+            if last[1] + 1 == start and last[2] == asn and last[3] == flags:
+                last[1] = end
+                return
+        intervals.append([start, end, asn, flags])
+
+    stack = []
+    cursor = 0
+    for prefix in prefixes:
+        start = prefix[0]
+        while stack and stack[-1][1] < start:
+            top = stack.pop()
+            if cursor <= top[1]:
+                emit(cursor, *top[1:])
+                cursor = top[1] + 1
+        if stack and cursor < start:
+            emit(cursor, start - 1, *stack[-1][2:])
+        stack.append(prefix)
+        cursor = start
+
+    while stack:
+        top = stack.pop()
+        if cursor <= top[1]:
+            emit(cursor, *top[1:])
+            cursor = top[1] + 1
+    return intervals
+
+
+def _split_u128(values: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    mask = 2**64 - 1
+    hi = np.fromiter((v >> 64 for v in values), dtype=np.uint64, count=len(values))
+    lo = np.fromiter((v & mask for v in values), dtype=np.uint64, count=len(values))
+    return hi, lo
+
+
+def pack_ipv4(ips: Sequence[str]) -> np.ndarray:
+    packed = b"".join(socket.inet_pton(socket.AF_INET, ip) for ip in ips)
+    return np.frombuffer(packed, dtype=">u4").astype(np.uint32)
+
+
+def pack_ipv6(ips: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    packed = b"".join(socket.inet_pton(socket.AF_INET6, ip) for ip in ips)
+    halves = np.frombuffer(packed, dtype=">u8").reshape(-1, 2)
+    return halves[:, 0].astype(np.uint64), halves[:, 1].astype(np.uint64)
+
+
+def _u128_keys(hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    keys = np.empty(len(hi), dtype=[("hi", ">u8"), ("lo", ">u8")])
+    keys["hi"] = hi
+    keys["lo"] = lo
+    return keys.view("S16")
+
+
+class IntervalIndex:
+    # columns holds start and end for IPv4 and start_hi, start_lo, end_hi and
+    # end_lo for IPv6, along with the asn and flags of every interval.
+    def __init__(self, ip_version: int, columns: Dict[str, np.ndarray]):
+        assert ip_version in (4, 6)
+        self.ip_version = ip_version
+        self.columns = columns
+        self.asn = columns["asn"]
+        self.flags = columns["flags"]
+        self._start_keys = None
+
+    @classmethod
+    def column_names(cls, ip_version: int) -> List[str]:
+        if ip_version == 4:
+            names = ["start", "end"]
+        else:
+            names = ["start_hi", "start_lo", "end_hi", "end_lo"]
+        return names + ["asn", "flags"]
+
+    @classmethod
+    def from_intervals(cls, ip_version: int, intervals: List[list]):
+        count = len(intervals)
+        columns = {
+            "asn": np.fromiter((i[2] for i in intervals), dtype=np.uint32, count=count),
+            "flags": np.fromiter(
+                (i[3] for i in intervals), dtype=np.uint8, count=count
+            ),
+        }
+        if ip_version == 4:
+            for name, col in [("start", 0), ("end", 1)]:
+                columns[name] = np.fromiter(
+                    (i[col] for i in intervals), dtype=np.uint32, count=count
+                )
+        else:
+            for name, col in [("start", 0), ("end", 1)]:
+                hi, lo = _split_u128([i[col] for i in intervals])
+                columns[f"{name}_hi"], columns[f"{name}_lo"] = hi, lo
+        return cls(ip_version, columns)
+
+    @classmethod
+    def from_prefix2as(cls, path: Path, ip_version: int):
+        return cls.from_intervals(
+            ip_version, flatten_prefixes(read_prefixes(path, ip_version))
+        )
+
+    def __len__(self):
+        return len(self.asn)
+
+    def save(self, index_dir: Path, source_sha256: str):
+        tmp_dir = index_dir.with_name(f"{index_dir.name}.{os.getpid()}.tmp")
+        tmp_dir.mkdir(parents=True)
+        for name in self.column_names(self.ip_version):
+            np.save(tmp_dir / f"{name}.npy", self.columns[name])
+        with (tmp_dir / "source.json").open("w") as out_file:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "ip_version": self.ip_version,
+                    "source_sha256": source_sha256,
+                },
+                out_file,
+            )
+        if index_dir.exists():
+            shutil.rmtree(index_dir)
+        tmp_dir.rename(index_dir)
+
+    # Returns None when there is no cached index or it was built from a
+    # different file or by a different version of this code.
+    @classmethod
+    def load(cls, index_dir: Path, source_sha256: str):
+        try:
+            with (index_dir / "source.json").open() as in_file:
+                source = json.load(in_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if (
+            source.get("version") != INDEX_VERSION
+            or source.get("source_sha256") != source_sha256
+        ):
+            return None
+        ip_version = source["ip_version"]
+        columns = {
+            name: np.load(index_dir / f"{name}.npy", mmap_mode="r")
+            for name in cls.column_names(ip_version)
+        }
+        return cls(ip_version, columns)
+
+    @classmethod
+    def for_file(cls, path: Path, ip_version: int, cache_dir: Path = INDEX_CACHE_DIR):
+        source_sha256 = file_digest(path)
+        assert source_sha256 is not None, f"missing {path}"
+        index_dir = cache_dir / path.name.replace(".pfx2as.gz", "")
+        index = cls.load(index_dir, source_sha256)
+        if index is None:
+            print(f"[+] indexing {path}")
+            index = cls.from_prefix2as(path, ip_version)
+            index.save(index_dir, source_sha256)
+        return index
+
+    # Returns the position of the interval containing every address, or -1.
+    # IPv4 addresses are passed as a uint32 array, IPv6 ones as the arrays of
+    # their high and low halves.
+    def find(self, *addrs: np.ndarray) -> np.ndarray:
+        if self.ip_version == 4:
+            (addr,) = addrs
+            idx = np.searchsorted(self.columns["start"], addr, side="right") - 1
+            safe = np.maximum(idx, 0)
+            found = (idx >= 0) & (self.columns["end"][safe] >= addr)
+            return np.where(found, idx, -1)
+
+        hi, lo = addrs
+        idx = self._find_start_u128(hi, lo)
+        safe = np.maximum(idx, 0)
+        end_hi = self.columns["end_hi"][safe]
+        end_lo = self.columns["end_lo"][safe]
+        found = (idx >= 0) & ((end_hi > hi) | ((end_hi == hi) & (end_lo >= lo)))
+        return np.where(found, idx, -1)
+
+    # searchsorted(side="right") - 1 over 128 bit starts. The halves of every
+    # address are packed into 16 big endian bytes, which compare like the
+    # addresses themselves, so a single searchsorted over the packed starts,
+    # which are sorted already and only packed once, does it.
+    def _find_start_u128(self, hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+        if self._start_keys is None:
+            self._start_keys = _u128_keys(
+                self.columns["start_hi"], self.columns["start_lo"]
+            )
+        keys = _u128_keys(hi, lo)
+        return np.searchsorted(self._start_keys, keys, side="right") - 1
+
+    # Returns the ASN of every address, 0 when it's not routed
+    def lookup(self, *addrs: np.ndarray) -> np.ndarray:
+        idx = self.find(*addrs)
+        return np.where(idx >= 0, self.asn[np.maximum(idx, 0)], 0).astype(np.uint32)
+
+    def start_addresses(self, idx: np.ndarray) -> List[str]:
+        if self.ip_version == 4:
+            return [
+                str(ipaddress.IPv4Address(int(v))) for v in self.columns["start"][idx]
+            ]
+        return [
+            str(ipaddress.IPv6Address((int(hi) << 64) | int(lo)))
+            for hi, lo in zip(
+                self.columns["start_hi"][idx], self.columns["start_lo"][idx]
+            )
+        ]
+
+
+class Prefix2AS:
+    def __init__(self, ipv4: IntervalIndex, ipv6: IntervalIndex):
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+
+    @classmethod
+    def for_day(cls, day_str: str, cache_dir: Path = INDEX_CACHE_DIR):
+        return cls(
+            IntervalIndex.for_file(prefix2as_path("rv2", day_str), 4, cache_dir),
+            IntervalIndex.for_file(prefix2as_path("rv6", day_str), 6, cache_dir),
+        )
+
+    # Returns the ASN of every address, 0 when it's not routed
+    def lookup(self, ips: Sequence[str]) -> np.ndarray:
+        is_v6 = np.fromiter((":" in ip for ip in ips), dtype=bool, count=len(ips))
+        v4_pos, v6_pos = np.flatnonzero(~is_v6), np.flatnonzero(is_v6)
+        asns = np.zeros(len(ips), dtype=np.uint32)
+        if len(v4_pos):
+            asns[v4_pos] = self.ipv4.lookup(pack_ipv4([ips[i] for i in v4_pos]))
+        if len(v6_pos):
+            asns[v6_pos] = self.ipv6.lookup(*pack_ipv6([ips[i] for i in v6_pos]))
+        return asns
+
+
+# Compares the ASN of a sample of intervals with the one the enricher wrote to
+# an ip2country_as database of the same day, split by the flags of the
+# interval so that multi origin and AS set prefixes can be told apart.
+def cross_check(index: Prefix2AS, mmdb_path: Path, sample: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    with maxminddb.open_database(str(mmdb_path)) as reader:
+        for family in [index.ipv4, index.ipv6]:
+            count = min(sample, len(family))
+            idx = np.sort(rng.choice(len(family), size=count, replace=False))
+            checked, failed = {}, {}
+            for i, ip in zip(idx, family.start_addresses(idx)):
+                flags = int(family.flags[i])
+                record = reader.get(ip) or {}
+                checked[flags] = checked.get(flags, 0) + 1
+                if record.get("autonomous_system_number") != int(family.asn[i]):
+                    failed[flags] = failed.get(flags, 0) + 1
+                    if mismatches < 10:
+                        print(
+                            f"    {ip}: prefix2as AS{family.asn[i]},"
+                            f" database {record.get('autonomous_system_number')}"
+                        )
+                    mismatches += 1
+
+            print(f"[+] IPv{family.ip_version}: checked {count} intervals")
+            for flags, name in [
+                (0, "single origin"),
+                (MULTI_ORIGIN, "multi origin"),
+                (AS_SET, "AS set"),
+                (MULTI_ORIGIN | AS_SET, "multi origin AS set"),
+            ]:
+                if checked.get(flags):
+                    print(
+                        f"    {name:<20}{checked[flags]:>10} checked"
+                        f"{failed.get(flags, 0):>10} mismatched"
+                    )
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Looks up ASNs in the routeviews prefix2as files of a day"
+    )
+    parser.add_argument("--cache-dir", type=Path, default=INDEX_CACHE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    lookup_parser = subparsers.add_parser("lookup")
+    lookup_parser.add_argument("day", help="YYYYMMDD")
+    lookup_parser.add_argument("ips", nargs="+")
+
+    check_parser = subparsers.add_parser(
+        "check", help="compare the ASNs with an ip2country_as database"
+    )
+    check_parser.add_argument("day", help="YYYYMMDD")
+    check_parser.add_argument("mmdb", type=Path)
+    check_parser.add_argument("--sample", type=int, default=10_000)
+    args = parser.parse_args()
+
+    assert (
+        PREFIX2AS_DIR / f"routeviews-rv2-{args.day}.pfx2as.gz"
+    ).exists(), f"no prefix2as files for {args.day} in {PREFIX2AS_DIR}"
+    index = Prefix2AS.for_day(args.day, args.cache_dir)
+    if args.command == "lookup":
+        for ip, asn in zip(args.ips, index.lookup(args.ips)):
+            print(f"{ip}\t{asn}")
+        return
+
+    if cross_check(index, args.mmdb, args.sample) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import ipaddress
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Callable, Dict
+
+from synthetic_fixtures import (
+    write_as_org_snapshots,
+    write_mmdb,
+    write_pfx2as,
+)
+
+# Times the hot paths of the pipeline against synthetic fixtures and compares
+# the results with a baseline file, so that performance changes can be
+# measured offline:
+#
+#   python run_benchmarks.py --update-baseline    record the current numbers
+#   python run_benchmarks.py                      compare against them
+#
+# Baselines only make sense on the machine they were recorded on.
+
+SCALES = {
+    # snapshots, ASNs, prefixes, networks, rows
+    "small": (6, 20_000, 50_000, 10_000, 50_000),
+    "medium": (24, 60_000, 200_000, 40_000, 200_000),
+    "large": (48, 120_000, 800_000, 150_000, 1_000_000),
+}
+DEFAULT_BASELINE_PATH = Path("bench_baseline.json")
+
+
+def ensure_fixtures(fixtures_dir: Path, scale: str) -> Path:
+    snapshots, asns, prefixes, networks, _ = SCALES[scale]
+    root = fixtures_dir / scale
+    done_marker = root / ".done"
+    if done_marker.exists():
+        return root
+
+    print(f"[+] generating {scale} fixtures in {root}")
+    root.mkdir(parents=True, exist_ok=True)
+    write_as_org_snapshots(
+        root / "as-organizations", snapshots, asns, org_count=asns // 2
+    )
+    write_pfx2as(root / "routeviews-rv2-20200101.pfx2as.gz", 4, prefixes)
+    write_pfx2as(root / "routeviews-rv6-20200101.pfx2as.gz", 6, prefixes // 10)
+    outputs_dir = root / "outputs"
+    outputs_dir.mkdir(exist_ok=True)
+    write_mmdb(outputs_dir / "20200101-ip2country_as.mmdb", networks, with_asn=True)
+    # Same networks with different records, so that the diff has work to do
+    write_mmdb(
+        outputs_dir / "20200201-ip2country_as.mmdb", networks, seed=43, with_asn=True
+    )
+    done_marker.touch()
+    return root
+
+
+def bench_parse_snapshot(root: Path, scale: str) -> Callable:
+    from build_all_as_org_map import parse_snapshot
+
+    fn = sorted((root / "as-organizations").glob("*.txt.gz"))[-1]
+    return lambda: parse_snapshot(fn)
+
+
+def bench_merge_snapshots(root: Path, scale: str) -> Callable:
+    from build_all_as_org_map import (
+        ASOrgMapMerger,
+        iter_packed_snapshot,
+        parse_snapshot,
+    )
+
+    parsed = [
+        parse_snapshot(fn) for fn in sorted((root / "as-organizations").glob("*.gz"))
+    ]
+
+    def run():
+        merger = ASOrgMapMerger()
+        for packed in parsed:
+            for asn, vals in iter_packed_snapshot(packed):
+                merger.add(asn, vals)
+        return merger
+
+    return run
+
+
+def bench_as_org_slice_digests(root: Path, scale: str) -> Callable:
+    from as_org_timeline import AsOrgTimeline, write_as_org_timeline
+    from build_all_as_org_map import (
+        ASOrgMapMerger,
+        iter_packed_snapshot,
+        parse_snapshot,
+    )
+    from input_fingerprints import as_org_slice_digests
+
+    timeline_path = root / "all_as_org_map.bin"
+    if not timeline_path.exists():
+        merger = ASOrgMapMerger()
+        for fn in sorted((root / "as-organizations").glob("*.gz")):
+            for asn, vals in iter_packed_snapshot(parse_snapshot(fn)):
+                merger.add(asn, vals)
+        write_as_org_timeline(merger.as_org_map(), timeline_path)
+    days = [f"{2012 + idx // 12}{idx % 12 + 1:02d}01" for idx in range(120)]
+    with AsOrgTimeline(timeline_path) as timeline:
+        # Every other ASN is routed on every day
+        routed = [asn for asn, _ in timeline.iter_histories()][::2]
+    return lambda: as_org_slice_digests(timeline_path, days, lambda _: routed)
+
+
+def bench_file_digests(root: Path, scale: str) -> Callable:
+    from digest_manifest import compute_file_digests
+
+    path = root / "outputs" / "20200101-ip2country_as.mmdb"
+    return lambda: compute_file_digests(path)
+
+
+def bench_gunzip(root: Path, scale: str) -> Callable:
+    from decompress import gunzip_file
+
+    src_path = root / "routeviews-rv2-20200101.pfx2as.gz"
+    return lambda: gunzip_file(src_path, root / "routeviews-rv2-20200101.pfx2as")
+
+
+def bench_compress(root: Path, scale: str) -> Callable:
+    from compress import compress_file
+
+    return lambda: compress_file(root / "outputs" / "20200101-ip2country_as.mmdb")
+
+
+# Inflates a .gz written by compress_file, whose members are inflated in
+# parallel, unlike the single stream prefix2as files of bench_gunzip.
+def bench_gunzip_members(root: Path, scale: str) -> Callable:
+    from compress import compress_file
+    from decompress import gunzip_file
+
+    src_path = compress_file(root / "outputs" / "20200201-ip2country_as.mmdb").path
+    dst_path = root / "20200201-ip2country_as.mmdb"
+    return lambda: gunzip_file(src_path, dst_path, os.cpu_count() or 1)
+
+
+def bench_validate_tree(root: Path, scale: str) -> Callable:
+    from mmdb_tree import MMDBTree
+    from validate_database import validate_tree
+
+    def run():
+        with MMDBTree(root / "outputs" / "20200101-ip2country_as.mmdb") as tree:
+            validate_tree(tree)
+
+    return run
+
+
+def bench_diff_databases(root: Path, scale: str) -> Callable:
+    from diff_databases import FamilyDiff, diff_databases
+    from mmdb_tree import MMDBTree
+
+    def run():
+        summary = {"ipv4": FamilyDiff(), "ipv6": FamilyDiff()}
+        with MMDBTree(root / "outputs" / "20200101-ip2country_as.mmdb") as old:
+            with MMDBTree(root / "outputs" / "20200201-ip2country_as.mmdb") as new:
+                return sum(1 for _ in diff_databases(old, new, summary))
+
+    return run
+
+
+def bench_create_delta(root: Path, scale: str) -> Callable:
+    from mmdb_delta import create_delta
+
+    return lambda: create_delta(
+        root / "outputs" / "20200101-ip2country_as.mmdb",
+        root / "outputs" / "20200201-ip2country_as.mmdb",
+    )
+
+
+def bench_bulk_lookup(root: Path, scale: str) -> Callable:
+    from bulk_lookup import bulk_lookup
+
+    rnd = random.Random(42)
+    rows = SCALES[scale][4]
+    ips = [str(ipaddress.IPv4Address(rnd.getrandbits(32))) for _ in range(rows)]
+    days = [rnd.choice(["20200115", "20200215"]) for _ in range(rows)]
+    return lambda: bulk_lookup(ips, days, outputs_dir=root / "outputs")
+
+
+def bench_upload_sync(root: Path, scale: str) -> Callable:
+    from upload_outputs import sync_files
+
+    paths = sorted((root / "outputs").glob("*.mmdb")) + sorted(
+        (root / "as-organizations").glob("*.gz")
+    )
+
+    # Stands in for the upload by reading the file the way the uploaders do
+    def upload(fp: Path):
+        with fp.open("rb") as in_file:
+            while in_file.read(8 * 2**20):
+                pass
+
+    return lambda: sync_files("benchmark", paths, lambda fp: False, upload)
+
+
+def bench_prefix2as_index(root: Path, scale: str) -> Callable:
+    from prefix2as_index import IntervalIndex
+
+    return lambda: IntervalIndex.from_prefix2as(
+        root / "routeviews-rv2-20200101.pfx2as.gz", 4
+    )
+
+
+def bench_prefix2as_lookup(root: Path, scale: str) -> Callable:
+    import numpy as np
+
+    from prefix2as_index import IntervalIndex
+
+    index = IntervalIndex.from_prefix2as(root / "routeviews-rv6-20200101.pfx2as.gz", 6)
+    rng = np.random.default_rng(42)
+    rows = SCALES[scale][4]
+    # Addresses in 2000::/3, where the fixtures are
+    hi = rng.integers(2**61, 2**62, size=rows, dtype=np.uint64)
+    lo = rng.integers(0, 2**64, size=rows, dtype=np.uint64)
+    return lambda: index.lookup(hi, lo)
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    "parse_snapshot": bench_parse_snapshot,
+    "merge_snapshots": bench_merge_snapshots,
+    "as_org_slice_digests": bench_as_org_slice_digests,
+    "file_digests": bench_file_digests,
+    "gunzip": bench_gunzip,
+    "compress": bench_compress,
+    "gunzip_members": bench_gunzip_members,
+    "validate_tree": bench_validate_tree,
+    "diff_databases": bench_diff_databases,
+    "create_delta": bench_create_delta,
+    "bulk_lookup": bench_bulk_lookup,
+    "prefix2as_index": bench_prefix2as_index,
+    "prefix2as_lookup": bench_prefix2as_lookup,
+    "upload_sync": bench_upload_sync,
+}
+
+
+# Runs func repeat times and returns the best time, then once more under
+# tracemalloc for the peak of the memory allocated by python. What the
+# benchmarked code prints is discarded.
+def measure(func: Callable, repeat: int) -> dict:
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - t0)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {"seconds": min(timings), "peak_bytes": peak}
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for key in ["seconds", "peak_bytes"]:
+        if baseline.get(key) and result[key] > baseline[key] * (1 + threshold):
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the hot paths of the pipeline on synthetic data"
+    )
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument(
+        "--fixtures-dir",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "historical-geoip-fixtures",
+    )
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown, or memory growth, over the baseline that counts as a regression",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("only", nargs="*", help="benchmarks to run, defaults to all")
+    args = parser.parse_args()
+
+    for name in args.only:
+        assert name in BENCHMARKS, f"unknown benchmark {name}"
+    names = args.only or list(BENCHMARKS)
+
+    baselines = {}
+    if args.baseline.exists():
+        with args.baseline.open() as in_file:
+            baselines = json.load(in_file)
+    baseline = baselines.get(args.scale, {})
+
+    root = ensure_fixtures(args.fixtures_dir, args.scale)
+    results = {}
+    regressed = []
+    print(
+        f"{'benchmark':<24}{'seconds':>10}{'baseline':>10}{'change':>9}"
+        f"{'peak MiB':>10}{'baseline':>10}"
+    )
+    for name in names:
+        func = BENCHMARKS[name](root, args.scale)
+        result = results[name] = measure(func, args.repeat)
+
+        base = baseline.get(name, {})
+        change, base_seconds, base_peak = "", "", ""
+        if base:
+            change = f"{100 * (result['seconds'] / base['seconds'] - 1):+.1f}%"
+            base_seconds = f"{base['seconds']:.3f}"
+            base_peak = f"{base['peak_bytes'] / 2**20:.1f}"
+        regressions = compare(result, base, args.threshold)
+        if regressions:
+            regressed.append((name, regressions))
+        print(
+            f"{name:<24}{result['seconds']:>10.3f}{base_seconds:>10}{change:>9}"
+            f"{result['peak_bytes'] / 2**20:>10.1f}{base_peak:>10}"
+            + ("  REGRESSED" if regressions else "")
+        )
+
+    if args.update_baseline:
+        baselines[args.scale] = dict(baseline, **results)
+        with args.baseline.open("w") as out_file:
+            json.dump(baselines, out_file, sort_keys=True, indent=2)
+        print(f"[+] wrote {args.baseline}")
+        return
+
+    if regressed:
+        print(
+            f"[-] {len(regressed)} benchmarks regressed by more than {args.threshold:.0%}"
+        )
+        for name, regressions in regressed:
+            print(f"    {name}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
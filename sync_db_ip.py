@@ -2,23 +2,17 @@ import os
 import sys
 from pathlib import Path
 from datetime import datetime, timezone
-from download_assets import list_all_ia_items
+from download_assets import DownloadJob, default_ia_metadata, download_many
+from instrumentation import run_stage
 
 import boto3
-import requests
 import internetarchive as ia
 
 
 def get_latest_timestamp():
-    dbfiles_ts = map(
-        lambda x: "".join(x.filename.split(".")[0].split("-")[-2:]),
-        filter(
-            lambda x: x.filename.endswith("mmdb.gz"),
-            list_all_ia_items("dbip-country-lite"),
-        ),
-    )
-
-    return max(dbfiles_ts)
+    latest = default_ia_metadata().latest("dbip-country-lite", "mmdb.gz")
+    assert latest is not None, "no db IP files found"
+    return "".join(latest.filename.split(".")[0].split("-")[-2:])
 
 
 def download_dbip(cache_dir: Path, ts: str) -> Path:
@@ -29,14 +23,10 @@ def download_dbip(cache_dir: Path, ts: str) -> Path:
     output_dir.mkdir(parents=True, exist_ok=True)
     output_path = output_dir / filename
     print(f"   downloading latest db IP file to {output_path}")
-    with requests.get(
-        f"https://download.db-ip.com/free/{filename}", stream=True
-    ) as resp:
-        resp.raise_for_status()
-        with output_path.with_suffix(".tmp").open("wb") as out_file:
-            for b in resp.iter_content(chunk_size=2**16):
-                out_file.write(b)
-    output_path.with_suffix(".tmp").rename(output_path)
+    # DB-IP doesn't publish digests, download_many records the ones computed
+    # during the download in the digest manifest for the later stages.
+    url = f"https://download.db-ip.com/free/{filename}"
+    download_many([DownloadJob(url=url, dst_path=output_path)])
     return output_path
 
 
@@ -118,4 +108,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with run_stage("sync_db_ip"):
+        main()
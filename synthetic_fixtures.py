@@ -0,0 +1,230 @@
+import gzip
+import random
+import argparse
+import ipaddress
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+from mmdb_writer import MMDBWriter
+
+# Generators for synthetic versions of the inputs and outputs of the pipeline,
+# so that the hot paths can be measured without downloading anything:
+#
+#   CAIDA as-organizations snapshots    YYYYMMDD.as-org2info.txt.gz
+#   routeviews prefix2as files          routeviews-rv{2,6}-YYYYMMDD.pfx2as.gz
+#   mmdb databases                      written by mmdb_writer.MMDBWriter
+#
+# Everything is derived from a seed, so the same arguments always produce the
+# same files.
+
+COUNTRIES = ["US", "IT", "DE", "BR", "IN", "CN", "RU", "FR", "GB", "JP", "ZZ"]
+REGISTRIES = ["ARIN", "RIPE", "APNIC", "LACNIC", "AFRINIC"]
+
+
+def _asn_for(rnd: random.Random, asn_count: int) -> int:
+    # Real ASNs are mostly 16 bit ones, with a long tail of 32 bit ones
+    if rnd.random() < 0.8:
+        return rnd.randint(1, min(asn_count, 64000))
+    return 131072 + rnd.randint(0, asn_count)
+
+
+def write_as_org_snapshot(
+    path: Path, day_str: str, asn_count: int, org_count: int, seed: int = 42
+):
+    rnd = random.Random(seed)
+    orgs = []
+    for idx in range(org_count):
+        orgs.append(
+            (
+                f"ORG-{idx}-{rnd.choice(REGISTRIES)}",
+                f"{rnd.randint(2000, 2023)}{rnd.randint(1, 12):02d}01",
+                f"Synthetic Organization {idx}",
+                rnd.choice(COUNTRIES),
+                rnd.choice(REGISTRIES),
+            )
+        )
+
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as out_file:
+        out_file.write("# name: AS Org\n# program: synthetic_fixtures.py\n")
+        out_file.write("# format:org_id|changed|org_name|country|source\n")
+        for org in orgs:
+            out_file.write("|".join(org) + "\n")
+
+        out_file.write("# format:aut|changed|aut_name|org_id|opaque_id|source\n")
+        seen = set()
+        for _ in range(asn_count):
+            asn = _asn_for(rnd, asn_count)
+            if asn in seen:
+                continue
+            seen.add(asn)
+            org_id = orgs[asn % org_count][0]
+            changed = f"{rnd.randint(2000, 2023)}{rnd.randint(1, 12):02d}01"
+            if rnd.random() < 0.05:
+                # Some records don't have a changed date
+                changed = ""
+            registries = [rnd.choice(REGISTRIES)]
+            if rnd.random() < 0.02:
+                # Transferred ASNs show up in more than one registry, with the
+                # same org but different changed dates
+                registries.append(rnd.choice(REGISTRIES))
+            for source in registries:
+                out_file.write(
+                    f"{asn}|{changed}|AS-SYNTH-{asn}|{org_id}|{rnd.getrandbits(32):08x}|{source}\n"
+                )
+                changed = f"{rnd.randint(2000, 2023)}{rnd.randint(1, 12):02d}01"
+
+
+def write_as_org_snapshots(
+    output_dir: Path,
+    snapshot_count: int,
+    asn_count: int,
+    org_count: int,
+    seed: int = 42,
+) -> List[Path]:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for idx in range(snapshot_count):
+        year, month = 2012 + idx // 12, idx % 12 + 1
+        path = output_dir / f"{year}{month:02d}01.as-org2info.txt.gz"
+        # Consecutive snapshots share most of their content, like the real ones
+        write_as_org_snapshot(
+            path,
+            path.name.split(".")[0],
+            asn_count=asn_count + idx * asn_count // 100,
+            org_count=org_count,
+            seed=seed + idx % 3,
+        )
+        paths.append(path)
+    return paths
+
+
+def random_networks(
+    rnd: random.Random, count: int, ip_version: int
+) -> List[Tuple[str, int]]:
+    networks = []
+    for _ in range(count):
+        if ip_version == 4:
+            prefix_len = rnd.choice([16, 18, 20, 22, 23, 24, 24, 24])
+            addr = rnd.randint(2**24, 224 * 2**24 - 1)
+            bits = 32
+        else:
+            prefix_len = rnd.choice([29, 32, 32, 36, 40, 44, 48, 48])
+            # 2000::/3, the global unicast space
+            addr = rnd.randint(2**125, 2**126 - 1)
+            bits = 128
+        addr &= ~((1 << (bits - prefix_len)) - 1)
+        networks.append((str(ipaddress.ip_address(addr)), prefix_len))
+    return networks
+
+
+# Writes a routeviews prefix2as file, with the multi origin and AS set entries
+# that the enricher has to cope with.
+def write_pfx2as(path: Path, ip_version: int, prefix_count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    with gzip.open(path, "wt", encoding="ascii", compresslevel=1) as out_file:
+        for addr, prefix_len in sorted(
+            set(random_networks(rnd, prefix_count, ip_version)),
+            key=lambda n: (ipaddress.ip_address(n[0]), n[1]),
+        ):
+            asn = str(_asn_for(rnd, 70000))
+            r = rnd.random()
+            if r < 0.01:
+                asn = f"{asn}_{_asn_for(rnd, 70000)}"
+            elif r < 0.015:
+                asn = f"{asn},{_asn_for(rnd, 70000)}"
+            out_file.write(f"{addr}\t{prefix_len}\t{asn}\n")
+
+
+def country_record(country: str) -> dict:
+    return {"country": {"iso_code": country, "names": {"en": f"Country {country}"}}}
+
+
+def ip2country_as_record(rnd: random.Random, country: str) -> dict:
+    asn = _asn_for(rnd, 70000)
+    record = country_record(country)
+    record.update(
+        {
+            "autonomous_system_number": asn,
+            "autonomous_system_organization": f"Synthetic Organization {asn % 5000}",
+            "autonomous_system_country": rnd.choice(COUNTRIES),
+            "autonomous_system_name": f"AS-SYNTH-{asn}",
+        }
+    )
+    return record
+
+
+# Writes a database with network_count networks of each address family, in
+# the shape of the country databases or, with_asn, of our outputs.
+def write_mmdb(
+    path: Path,
+    network_count: int,
+    seed: int = 42,
+    with_asn: bool = False,
+    networks: Iterable[Tuple[str, int]] = None,
+):
+    rnd = random.Random(seed)
+    writer = MMDBWriter(
+        ip_version=6,
+        database_type="GeoLite2-ASN" if with_asn else "GeoLite2-Country",
+        description={"en": "synthetic database"},
+    )
+    if networks is None:
+        networks = random_networks(rnd, network_count, 4) + random_networks(
+            rnd, network_count, 6
+        )
+    # Less specific networks first, so that more specific ones carve holes in
+    # them rather than being overwritten.
+    for addr, prefix_len in sorted(networks, key=lambda n: n[1]):
+        country = rnd.choice(COUNTRIES[:-1])
+        if with_asn:
+            record = ip2country_as_record(rnd, country)
+        else:
+            record = country_record(country)
+        writer.insert(f"{addr}/{prefix_len}", record)
+    writer.write(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes synthetic fixtures")
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--snapshots", type=int, default=12)
+    parser.add_argument("--asns", type=int, default=100_000)
+    parser.add_argument("--orgs", type=int, default=60_000)
+    parser.add_argument("--prefixes", type=int, default=200_000)
+    parser.add_argument("--networks", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir
+    print(f"[+] writing {args.snapshots} as-organizations snapshots")
+    write_as_org_snapshots(
+        output_dir / "as-organizations",
+        args.snapshots,
+        args.asns,
+        args.orgs,
+        seed=args.seed,
+    )
+    print("[+] writing prefix2as files")
+    pfx2as_dir = output_dir / "routeviews-prefix2as"
+    pfx2as_dir.mkdir(parents=True, exist_ok=True)
+    write_pfx2as(
+        pfx2as_dir / "routeviews-rv2-20200101.pfx2as.gz", 4, args.prefixes, args.seed
+    )
+    write_pfx2as(
+        pfx2as_dir / "routeviews-rv6-20200101.pfx2as.gz",
+        6,
+        args.prefixes // 10,
+        args.seed,
+    )
+    print("[+] writing mmdb databases")
+    write_mmdb(output_dir / "country.mmdb", args.networks, seed=args.seed)
+    write_mmdb(
+        output_dir / "20200101-ip2country_as.mmdb",
+        args.networks,
+        seed=args.seed,
+        with_asn=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
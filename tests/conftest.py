@@ -0,0 +1,86 @@
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import download_assets
+from digest_manifest import DigestManifest
+
+
+# A local stand-in for the servers we download from. Tests set handler to a
+# function that gets the BaseHTTPRequestHandler of every GET request and
+# answers it, every request is also recorded in requests.
+class LocalServer:
+    def __init__(self):
+        self.handler = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests.append((self.path, dict(self.headers)))
+                server.handler(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path: str, host: str = "127.0.0.1") -> str:
+        return f"http://{host}:{self.port}{path}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def send_body(request, body: bytes, status: int = 200, headers: dict = {}):
+    request.send_response(status)
+    request.send_header("Content-Length", str(len(body)))
+    for name, value in headers.items():
+        request.send_header(name, value)
+    request.end_headers()
+    request.wfile.write(body)
+
+
+# Sends the headers for the whole body but only part of it, then drops the
+# connection, like a transfer that breaks halfway through.
+def send_truncated(request, body: bytes, sent: int, status: int = 200, headers={}):
+    request.send_response(status)
+    request.send_header("Content-Length", str(len(body)))
+    for name, value in headers.items():
+        request.send_header(name, value)
+    request.end_headers()
+    request.wfile.write(body[:sent])
+    request.wfile.flush()
+    request.close_connection = True
+
+
+@pytest.fixture
+def local_server():
+    server = LocalServer()
+    yield server
+    server.close()
+
+
+# Downloads record their digests in a manifest of their own and retry without
+# waiting.
+@pytest.fixture
+def download_env(tmp_path, monkeypatch):
+    manifest = DigestManifest(tmp_path / "digest_manifest.json")
+    monkeypatch.setattr(download_assets, "default_manifest", lambda: manifest)
+    monkeypatch.setattr(download_assets.retry_strategy, "backoff_factor", 0)
+    return manifest
@@ -0,0 +1,87 @@
+import csv
+import random
+import ipaddress
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import bulk_lookup
+from bulk_lookup import bulk_lookup as lookup, iter_bulk_lookup
+from historical_geoip import HistoricalGeoIP, to_geoip_result
+from synthetic_fixtures import write_mmdb
+
+
+@pytest.fixture(scope="module")
+def outputs_dir(tmp_path_factory):
+    outputs_dir = tmp_path_factory.mktemp("outputs")
+    for seed, day in enumerate(["20200101", "20200201"]):
+        write_mmdb(outputs_dir / f"{day}-ip2country_as.mmdb", 500, seed, True)
+    return outputs_dir
+
+
+def random_rows(count: int):
+    rnd = random.Random(1)
+    return [
+        (
+            str(ipaddress.IPv4Address(rnd.getrandbits(32))),
+            rnd.choice(["20200115", "20200215", "2019-12-01"]),
+        )
+        for _ in range(count)
+    ]
+
+
+def expected(outputs_dir: Path, rows):
+    with HistoricalGeoIP(outputs_dir) as geoip:
+        return [to_geoip_result(geoip.lookup(ip, day)) for ip, day in rows]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_matches_lookups_across_batches(outputs_dir, monkeypatch, jobs):
+    monkeypatch.setattr(bulk_lookup, "BATCH_SIZE", 300)
+    monkeypatch.setattr(bulk_lookup, "CHUNK_SIZE", 40)
+    rows = random_rows(1000)
+    ips, days = zip(*rows)
+    assert lookup(ips, days, outputs_dir, jobs) == expected(outputs_dir, rows)
+
+
+def test_invalid_rows(outputs_dir):
+    rows = [("8.8.8.8", "20200115"), ("not-an-ip", "20200115"), ("1.1.1.1", "bad")]
+    results = list(iter_bulk_lookup(rows, outputs_dir))
+
+    assert [(r.ip, r.day) for r in results] == rows
+    assert results[0].error is None
+    assert results[0].result == expected(outputs_dir, rows[:1])[0]
+    assert results[1].error == "invalid ip 'not-an-ip'"
+    assert results[2].error == "invalid date 'bad'"
+    assert results[1].result is None and results[2].result is None
+
+
+def test_cli(outputs_dir, tmp_path):
+    input_csv, output_csv = tmp_path / "in.csv", tmp_path / "out.csv"
+    rows = random_rows(50) + [("bogus", "20200115")]
+    with input_csv.open("w", newline="") as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(["ip", "date"])
+        writer.writerows(rows)
+
+    subprocess.run(
+        [
+            sys.executable,
+            str(Path(bulk_lookup.__file__)),
+            str(input_csv),
+            str(output_csv),
+            "--outputs-dir",
+            str(outputs_dir),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    with output_csv.open(newline="") as in_file:
+        out_rows = list(csv.DictReader(in_file))
+    assert [(r["ip"], r["date"]) for r in out_rows] == rows
+    assert out_rows[-1]["error"] == "invalid ip 'bogus'"
+    for row, result in zip(out_rows, expected(outputs_dir, rows[:-1])):
+        assert row["error"] == ""
+        assert row["country"] == ((result and result.country) or "")
@@ -0,0 +1,23 @@
+import decompress
+from compress import compress_file
+from decompress import decompress_all, record_decompressed
+
+
+def test_recorded_outputs_are_not_inflated_again(tmp_path, download_env, monkeypatch):
+    monkeypatch.setattr(decompress, "default_manifest", lambda: download_env)
+    output = tmp_path / "20200101-ip2country_as.mmdb"
+    output.write_bytes(b"database" * 1000)
+    compressed = compress_file(output)
+    assert decompress_all([compressed.path]) == 1
+
+    # A rebuilt output, compressed from the .mmdb rather than inflated into it
+    output.write_bytes(b"rebuilt database" * 1000)
+    compressed = compress_file(output)
+    record_decompressed([(compressed.path, output)])
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("nothing to decompress")
+
+    monkeypatch.setattr(decompress, "ProcessPoolExecutor", no_pool)
+    assert decompress_all([compressed.path]) == 0
+    assert output.read_bytes() == b"rebuilt database" * 1000
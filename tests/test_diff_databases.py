@@ -0,0 +1,56 @@
+import maxminddb
+
+import mmdb_delta
+from diff_databases import iter_changed_leaves
+from digest_manifest import DigestManifest
+from mmdb_tree import MMDBTree
+from mmdb_writer import MMDBWriter
+from synthetic_fixtures import country_record
+
+IPV4_MAPPED = 0xFFFF << 32
+
+
+def write_db(path, networks, aliases):
+    writer = MMDBWriter(ip_version=6)
+    for network, country in networks:
+        writer.insert(network, country_record(country))
+    writer.ipv4_aliases = aliases
+    writer.write(path)
+
+
+# The old database maps ::ffff:0:0/96 to the IPv4 subtree, the new one has
+# networks of its own there.
+def write_alias_mismatch(tmp_path):
+    old_path = tmp_path / "20230101-ip2country_as.mmdb"
+    new_path = tmp_path / "20230201-ip2country_as.mmdb"
+    write_db(old_path, [("1.2.3.0/24", "US")], [(IPV4_MAPPED, 96)])
+    write_db(new_path, [("1.2.3.0/24", "US"), ("::ffff:1.2.3.0/120", "IT")], [])
+    return old_path, new_path
+
+
+def test_one_sided_ipv4_alias_is_compared(tmp_path):
+    old_path, new_path = write_alias_mismatch(tmp_path)
+    with MMDBTree(old_path) as old, MMDBTree(new_path) as new:
+        changed = list(iter_changed_leaves(old, new))
+
+    assert [(ip_acc, prefix_len) for ip_acc, prefix_len, _, _ in changed] == [
+        (IPV4_MAPPED | 0x01020300, 120)
+    ]
+    _, _, old_info, new_info = changed[0]
+    assert (old_info.country, new_info.country) == ("US", "IT")
+
+
+def test_delta_across_ipv4_alias_mismatch(tmp_path, monkeypatch):
+    manifest = DigestManifest(tmp_path / "digest_manifest.json")
+    monkeypatch.setattr(mmdb_delta, "default_manifest", lambda: manifest)
+    old_path, new_path = write_alias_mismatch(tmp_path)
+
+    delta = mmdb_delta.create_delta(old_path, new_path)
+    rebuilt_path = tmp_path / "rebuilt.mmdb"
+    mmdb_delta.apply_delta(old_path, delta, rebuilt_path)
+
+    with maxminddb.open_database(str(rebuilt_path)) as reader:
+        assert reader.get("::ffff:1.2.3.4")["country"]["iso_code"] == "IT"
+        assert reader.get("1.2.3.4")["country"]["iso_code"] == "US"
+    with mmdb_delta.DeltaOverlay(old_path, delta) as overlay:
+        assert overlay.get("::ffff:1.2.3.4")["country"]["iso_code"] == "IT"
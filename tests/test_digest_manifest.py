@@ -0,0 +1,69 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from digest_manifest import DigestManifest
+
+
+def write_files(directory, count, prefix="file"):
+    paths = []
+    for i in range(count):
+        path = directory / f"{prefix}-{i}"
+        path.write_bytes(f"{prefix} {i}".encode())
+        paths.append(path)
+    return paths
+
+
+def saved_keys(manifest_path):
+    with manifest_path.open() as in_file:
+        return set(json.load(in_file))
+
+
+def test_writes_in_batches(tmp_path):
+    manifest_path = tmp_path / "digest_manifest.json"
+    manifest = DigestManifest(manifest_path, flush_every=3)
+    paths = write_files(tmp_path, 4)
+
+    for path in paths[:2]:
+        manifest.digests(path)
+    assert not manifest_path.exists()
+    manifest.digests(paths[2])
+    assert saved_keys(manifest_path) == {str(p) for p in paths[:3]}
+
+    manifest.digests(paths[3])
+    manifest.flush()
+    assert saved_keys(manifest_path) == {str(p) for p in paths}
+    # Known digests are served from memory, without being written again
+    assert manifest.get(paths[3]) == manifest.digests(paths[3])
+    assert not manifest.updated
+
+
+def test_missing_files_are_dropped_on_flush(tmp_path):
+    manifest_path = tmp_path / "digest_manifest.json"
+    manifest = DigestManifest(manifest_path)
+    first, second = write_files(tmp_path, 2)
+    manifest.digests(first)
+    manifest.flush()
+
+    first.unlink()
+    manifest.digests(second)
+    manifest.flush()
+    assert saved_keys(manifest_path) == {str(second)}
+
+
+def record_all(manifest_path, paths):
+    manifest = DigestManifest(manifest_path, flush_every=5)
+    for path in paths:
+        manifest.digests(path)
+    manifest.flush()
+
+
+def test_processes_merge_their_entries(tmp_path):
+    manifest_path = tmp_path / "digest_manifest.json"
+    groups = [write_files(tmp_path, 20, f"worker{i}") for i in range(4)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        for future in [
+            executor.submit(record_all, manifest_path, paths) for paths in groups
+        ]:
+            future.result()
+
+    assert saved_keys(manifest_path) == {str(p) for paths in groups for p in paths}
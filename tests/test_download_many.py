@@ -0,0 +1,105 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import download_assets
+from conftest import send_body, send_truncated
+from download_assets import DownloadJob, download_many
+
+
+def test_per_host_limit(local_server, download_env, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_assets, "DOWNLOAD_WORKERS_PER_HOST", 2)
+    lock = threading.Lock()
+    in_flight = Counter()
+    peak = Counter()
+
+    def handler(request):
+        host = request.headers["Host"].split(":")[0]
+        with lock:
+            in_flight[host] += 1
+            in_flight["all"] += 1
+            peak[host] = max(peak[host], in_flight[host])
+            peak["all"] = max(peak["all"], in_flight["all"])
+        time.sleep(0.2)
+        with lock:
+            in_flight[host] -= 1
+            in_flight["all"] -= 1
+        send_body(request, request.path.encode())
+
+    local_server.handler = handler
+    jobs = [
+        DownloadJob(
+            url=local_server.url(f"/{host}-{i}", host),
+            dst_path=tmp_path / f"{host}-{i}",
+        )
+        for host in ("127.0.0.1", "localhost")
+        for i in range(6)
+    ]
+    download_many(jobs)
+
+    for job in jobs:
+        assert (
+            job.dst_path.read_bytes()
+            == job.url.split(str(local_server.port))[1].encode()
+        )
+    assert peak["127.0.0.1"] == 2
+    assert peak["localhost"] == 2
+    # Different hosts are downloaded from at the same time
+    assert peak["all"] > 2
+
+
+def test_retries_broken_transfers(local_server, download_env, tmp_path):
+    body = b"x" * 100_000
+    attempts = []
+
+    def handler(request):
+        attempts.append(request.path)
+        # Without Accept-Ranges every attempt starts over
+        if len(attempts) < 3:
+            send_truncated(request, body, 10_000)
+        else:
+            send_body(request, body)
+
+    local_server.handler = handler
+    job = DownloadJob(
+        url=local_server.url("/file.gz"),
+        dst_path=tmp_path / "file.gz",
+        sha1=hashlib.sha1(body).hexdigest(),
+    )
+    download_many([job])
+
+    assert len(attempts) == 3
+    assert job.dst_path.read_bytes() == body
+    assert download_env.digests(job.dst_path).sha1 == job.sha1
+
+
+def test_gives_up_after_retries(local_server, download_env, tmp_path):
+    attempts = []
+
+    def handler(request):
+        attempts.append(request.path)
+        send_truncated(request, b"x" * 100_000, 10_000)
+
+    local_server.handler = handler
+    job = DownloadJob(url=local_server.url("/file.gz"), dst_path=tmp_path / "file.gz")
+    with pytest.raises(AssertionError, match="failed to download 1 files"):
+        download_many([job])
+
+    assert len(attempts) == download_assets.retry_strategy.total + 1
+    assert not job.dst_path.exists()
+
+
+def test_sha1_mismatch(local_server, download_env, tmp_path):
+    local_server.handler = lambda request: send_body(request, b"corrupted")
+    job = DownloadJob(
+        url=local_server.url("/file.gz"),
+        dst_path=tmp_path / "file.gz",
+        sha1=hashlib.sha1(b"expected").hexdigest(),
+    )
+    with pytest.raises(AssertionError):
+        download_many([job])
+    assert not job.dst_path.exists()
+    assert not any(tmp_path.glob("file.gz.tmp*"))
@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+
+import requests
+
+from conftest import send_body
+from download_assets import is_final_month_listing
+from http_cache import cached_get, load_cache_meta
+
+MONTH_URL = (
+    "https://publicdata.caida.org/datasets/routing/routeviews-prefix2as/2019/05/"
+)
+
+
+def fetched(ts: str) -> dict:
+    return {
+        "fetched_at": datetime.fromisoformat(ts)
+        .replace(tzinfo=timezone.utc)
+        .isoformat()
+    }
+
+
+def test_final_month_listing():
+    assert not is_final_month_listing(MONTH_URL, fetched("2019-05-20T00:00:00"))
+    # The files for the last days of the month may not be published yet
+    assert not is_final_month_listing(MONTH_URL, fetched("2019-06-01T00:00:00"))
+    assert not is_final_month_listing(MONTH_URL, fetched("2019-06-03T12:00:00"))
+    assert is_final_month_listing(MONTH_URL, fetched("2019-06-08T00:00:00"))
+    assert is_final_month_listing(MONTH_URL, fetched("2020-01-01T00:00:00"))
+    december = MONTH_URL.replace("2019/05", "2019/12")
+    assert not is_final_month_listing(december, fetched("2020-01-02T00:00:00"))
+    assert is_final_month_listing(december, fetched("2020-01-08T00:00:00"))
+    assert not is_final_month_listing(
+        "https://publicdata.caida.org/datasets/as-organizations/",
+        fetched("2030-01-01T00:00:00"),
+    )
+
+
+def test_revalidates_with_304(local_server, tmp_path):
+    version = {"etag": '"v1"', "body": b"<html>v1</html>"}
+
+    def handler(request):
+        if request.headers.get("If-None-Match") == version["etag"]:
+            request.send_response(304)
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+        send_body(request, version["body"], headers={"ETag": version["etag"]})
+
+    local_server.handler = handler
+    url = local_server.url("/listing/")
+    session = requests.Session()
+
+    assert cached_get(session, url, tmp_path) == b"<html>v1</html>"
+    first_fetch = load_cache_meta(tmp_path, url)["fetched_at"]
+
+    assert cached_get(session, url, tmp_path) == b"<html>v1</html>"
+    assert local_server.requests[1][1]["If-None-Match"] == '"v1"'
+    assert load_cache_meta(tmp_path, url)["fetched_at"] > first_fetch
+
+    version.update(etag='"v2"', body=b"<html>v2</html>")
+    assert cached_get(session, url, tmp_path) == b"<html>v2</html>"
+    assert load_cache_meta(tmp_path, url)["etag"] == '"v2"'
+    assert len(local_server.requests) == 3
+
+
+def test_immutable_skips_request(local_server, tmp_path):
+    local_server.handler = lambda request: send_body(request, b"listing")
+    url = local_server.url("/listing/")
+    session = requests.Session()
+
+    assert cached_get(session, url, tmp_path, lambda meta: True) == b"listing"
+    assert cached_get(session, url, tmp_path, lambda meta: True) == b"listing"
+    assert len(local_server.requests) == 1
+    assert cached_get(session, url, tmp_path, lambda meta: False) == b"listing"
+    assert len(local_server.requests) == 2
@@ -0,0 +1,86 @@
+import gzip
+from pathlib import Path
+
+from as_org_timeline import write_as_org_timeline
+from build_databases import BuildJob, should_skip
+from input_fingerprints import (
+    as_org_slice_digests,
+    read_origin_asns,
+    write_fingerprint,
+)
+
+DAYS = ["20130101", "20160101", "20240101", "20240701"]
+
+
+def slices(tmp_path: Path, as_org_map: dict, routed: list) -> dict:
+    timeline_path = tmp_path / "all_as_org_map.bin"
+    write_as_org_timeline(as_org_map, timeline_path)
+    return as_org_slice_digests(timeline_path, DAYS, lambda _: routed)
+
+
+def as_org_map():
+    return {
+        1: [["Org 1", "US", "20120101", "AS-1", "ARIN"]],
+        2: [
+            ["Org 2", "IT", "20120101", "AS-2", "RIPE"],
+            ["Org 2 renamed", "IT", "20200101", "AS-2", "RIPE"],
+        ],
+    }
+
+
+def test_new_asn_only_changes_days_it_is_routed_on(tmp_path):
+    before = slices(tmp_path, as_org_map(), [1, 2])
+    with_new = as_org_map()
+    with_new[3] = [["Org 3", "DE", "20240601", "AS-3", "RIPE"]]
+
+    # Not routed on any day
+    assert slices(tmp_path, with_new, [1, 2]) == before
+
+    # Routed on every day: getASMeta uses its first record even before it
+    after = slices(tmp_path, with_new, [1, 2, 3])
+    assert all(after[day] != before[day] for day in DAYS)
+
+
+def test_changed_record_only_changes_later_days(tmp_path):
+    before = slices(tmp_path, as_org_map(), [1, 2])
+    changed = as_org_map()
+    changed[1].append(["Org 1 renamed", "US", "20240601", "AS-1", "ARIN"])
+    after = slices(tmp_path, changed, [1, 2])
+
+    assert [after[day] == before[day] for day in DAYS] == [True, True, True, False]
+
+
+def test_unrouted_and_unknown_asns(tmp_path):
+    assert slices(tmp_path, as_org_map(), [])["20130101"] == "0" * 16
+    # ASNs missing from the map are looked up as Unassigned
+    assert slices(tmp_path, as_org_map(), [1, 99]) == slices(
+        tmp_path, as_org_map(), [1]
+    )
+
+
+def test_read_origin_asns(tmp_path):
+    path = tmp_path / "routeviews-rv2-20200101.pfx2as.gz"
+    with gzip.open(path, "wt") as out_file:
+        out_file.write("1.0.0.0\t24\t13335\n")
+        out_file.write("1.0.4.0\t22\t38803_56203\n")
+        out_file.write("1.0.8.0\t21\t4134,4809\n")
+        out_file.write("1.0.16.0\t24\t13335\n")
+    assert read_origin_asns(path) == [4134, 13335, 38803]
+
+
+def test_should_skip(tmp_path):
+    output_path = tmp_path / "20200101-ip2country_as.mmdb"
+    job = BuildJob("20200101", tmp_path / "db.mmdb", output_path, {"a": 1})
+    assert not should_skip(job, "skip_unchanged")
+
+    output_path.write_bytes(b"")
+    assert should_skip(job, "skip_existing")
+    # Missing sidecar
+    assert not should_skip(job, "skip_unchanged")
+
+    write_fingerprint(output_path, {"a": 1})
+    assert should_skip(job, "skip_unchanged")
+    assert not should_skip(job._replace(fingerprint={"a": 2}), "skip_unchanged")
+    # No fingerprint for the job, eg. all_as_org_map.bin is missing
+    assert not should_skip(job._replace(fingerprint=None), "skip_unchanged")
+    assert not should_skip(job, "")
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+from lookup_service import LookupService
+from synthetic_fixtures import write_mmdb
+
+
+def test_reload(tmp_path):
+    write_mmdb(tmp_path / "20200101-ip2country_as.mmdb", 50, 1, True)
+
+    async def run():
+        service = LookupService(tmp_path)
+        first = await service.lookup("8.8.8.8", "20200301")
+        assert first["database"] == "20200101-ip2country_as.mmdb"
+        assert len(service.cache) == 1
+
+        write_mmdb(tmp_path / "20200201-ip2country_as.mmdb", 50, 2, True)
+        await service.reload()
+        assert service.counters["reloads"] == 1
+        assert len(service.cache) == 0
+        second = await service.lookup("8.8.8.8", "20200301")
+        assert second["database"] == "20200201-ip2country_as.mmdb"
+        service.geoip.close()
+
+    asyncio.run(run())
+
+
+def test_lookup_across_reload_is_not_cached(tmp_path, monkeypatch):
+    write_mmdb(tmp_path / "20200101-ip2country_as.mmdb", 50, 1, True)
+
+    async def run():
+        service = LookupService(tmp_path)
+        release = threading.Event()
+        lookup_in = service.geoip.lookup_in
+
+        def slow_lookup_in(db, ip):
+            release.wait()
+            return lookup_in(db, ip)
+
+        monkeypatch.setattr(service.geoip, "lookup_in", slow_lookup_in)
+        pending = asyncio.ensure_future(service.lookup("8.8.8.8", "20200301"))
+        await asyncio.sleep(0.05)
+        await service.reload()
+        release.set()
+        await pending
+        assert len(service.cache) == 0
+        service.geoip.close()
+
+    asyncio.run(run())
+
+
+async def get(port: int, target: str):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {target} HTTP/1.1\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, body = response.partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), body.decode()
+
+
+def test_removed_database_and_endpoint_labels(tmp_path):
+    write_mmdb(tmp_path / "20200101-ip2country_as.mmdb", 50, 1, True)
+
+    async def run():
+        service = LookupService(tmp_path)
+        server = await asyncio.start_server(service.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            # Removed before the service noticed
+            (tmp_path / "20200101-ip2country_as.mmdb").unlink()
+            status, _ = await get(port, "/lookup?ip=8.8.8.8&date=20200301")
+            assert status == 503
+            for i in range(3):
+                status, _ = await get(port, f"/random-{i}")
+                assert status == 404
+            status, metrics = await get(port, "/metrics")
+        service.geoip.close()
+        return metrics
+
+    metrics = asyncio.run(run())
+    endpoints = {
+        line.split('endpoint="')[1].split('"')[0]
+        for line in metrics.splitlines()
+        if 'endpoint="' in line
+    }
+    assert endpoints == {"lookup", "other"}
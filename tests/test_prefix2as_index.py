@@ -0,0 +1,52 @@
+import random
+import ipaddress
+
+import numpy as np
+import pytest
+
+from prefix2as_index import IntervalIndex, pack_ipv4, pack_ipv6, read_prefixes
+from synthetic_fixtures import write_pfx2as
+
+
+# The ASN of the most specific prefix that covers every address
+def brute_force(prefixes, addrs):
+    asns = []
+    for addr in addrs:
+        best = None
+        for start, end, asn, _ in prefixes:
+            if start <= addr <= end and (best is None or end - start <= best[0]):
+                best = (end - start, asn)
+        asns.append(best[1] if best else 0)
+    return asns
+
+
+@pytest.mark.parametrize("ip_version", [4, 6])
+def test_lookup_matches_brute_force(tmp_path, ip_version):
+    path = tmp_path / f"routeviews-rv{ip_version}.pfx2as.gz"
+    write_pfx2as(path, ip_version, 300, seed=ip_version)
+    prefixes = read_prefixes(path, ip_version)
+    index = IntervalIndex.from_prefix2as(path, ip_version)
+
+    rnd = random.Random(0)
+    bits = 32 if ip_version == 4 else 128
+    addrs = [rnd.getrandbits(bits) for _ in range(300)]
+    # Addresses at the edges of every prefix
+    for start, end, _, _ in rnd.sample(prefixes, 100):
+        addrs += [start, end, max(start - 1, 0), min(end + 1, 2**bits - 1)]
+    addrs += [0, 2**bits - 1]
+
+    if ip_version == 4:
+        packed = (np.array(addrs, dtype=np.uint32),)
+    else:
+        packed = pack_ipv6([str(ipaddress.IPv6Address(a)) for a in addrs])
+    assert index.lookup(*packed).tolist() == brute_force(prefixes, addrs)
+    # A handful of addresses is looked up the same way
+    assert index.lookup(*(p[:3] for p in packed)).tolist() == brute_force(
+        prefixes, addrs[:3]
+    )
+
+
+def test_pack():
+    assert pack_ipv4(["1.2.3.4"]).tolist() == [0x01020304]
+    hi, lo = pack_ipv6(["2001:db8::1"])
+    assert (hi.tolist(), lo.tolist()) == ([0x20010DB800000000], [1])
@@ -0,0 +1,189 @@
+import hashlib
+import json
+
+import pytest
+
+from conftest import send_body, send_truncated
+from download_assets import DownloadJob, download_many, partial_paths
+
+BODY = bytes(range(256)) * 1600
+# The bytes of the read that breaks are lost, so the cut falls on a chunk
+# boundary of download_file
+CUT = 3 * 2**16
+
+
+# Answers like a server that supports byte ranges, honoring Range only when
+# If-Range matches the current ETag.
+def send_range(request, body: bytes, etag: str):
+    headers = {"Accept-Ranges": "bytes", "ETag": etag}
+    range_header = request.headers.get("Range")
+    if range_header is None or request.headers.get("If-Range") != etag:
+        send_body(request, body, headers=headers)
+        return
+    first = int(range_header.split("=")[1].rstrip("-"))
+    if first >= len(body):
+        send_body(request, b"", 416, {"Content-Range": f"bytes */{len(body)}"})
+        return
+    headers["Content-Range"] = f"bytes {first}-{len(body) - 1}/{len(body)}"
+    send_body(request, body[first:], 206, headers)
+
+
+def ranges(local_server):
+    return [headers.get("Range") for _, headers in local_server.requests]
+
+
+def download(local_server, tmp_path, body=BODY):
+    job = DownloadJob(
+        url=local_server.url("/file.gz"),
+        dst_path=tmp_path / "file.gz",
+        sha1=hashlib.sha1(body).hexdigest(),
+    )
+    download_many([job])
+    assert job.dst_path.read_bytes() == body
+    assert not any(tmp_path.glob("file.gz.tmp*"))
+    return job
+
+
+def test_resumes_after_cut(local_server, download_env, tmp_path):
+    def handler(request):
+        if len(local_server.requests) == 1:
+            send_truncated(
+                request, BODY, CUT, headers={"Accept-Ranges": "bytes", "ETag": '"v1"'}
+            )
+        else:
+            send_range(request, BODY, '"v1"')
+
+    local_server.handler = handler
+    job = download(local_server, tmp_path)
+
+    assert ranges(local_server) == [None, f"bytes={CUT}-"]
+    assert local_server.requests[1][1]["If-Range"] == '"v1"'
+    # The digests cover the bytes of both responses
+    assert download_env.digests(job.dst_path).sha256 == hashlib.sha256(BODY).hexdigest()
+
+
+def test_if_range_mismatch_starts_over(local_server, download_env, tmp_path):
+    new_body = BODY[::-1]
+
+    def handler(request):
+        if len(local_server.requests) == 1:
+            send_truncated(
+                request, BODY, CUT, headers={"Accept-Ranges": "bytes", "ETag": '"v1"'}
+            )
+        else:
+            # The file changed on the server in the meantime
+            send_range(request, new_body, '"v2"')
+
+    local_server.handler = handler
+    download(local_server, tmp_path, new_body)
+
+    assert ranges(local_server) == [None, f"bytes={CUT}-"]
+
+
+def test_range_not_satisfiable_starts_over(local_server, download_env, tmp_path):
+    def handler(request):
+        if len(local_server.requests) == 1:
+            send_truncated(
+                request, BODY, CUT, headers={"Accept-Ranges": "bytes", "ETag": '"v1"'}
+            )
+        elif len(local_server.requests) == 2:
+            send_body(request, b"", 416, {"Content-Range": f"bytes */{CUT}"})
+        else:
+            send_range(request, BODY, '"v1"')
+
+    local_server.handler = handler
+    download(local_server, tmp_path)
+
+    assert ranges(local_server) == [None, f"bytes={CUT}-", None]
+
+
+def test_server_ignoring_range(local_server, download_env, tmp_path):
+    def handler(request):
+        headers = {"Accept-Ranges": "bytes", "ETag": '"v1"'}
+        if len(local_server.requests) == 1:
+            send_truncated(request, BODY, CUT, headers=headers)
+        else:
+            # Whole file back, which mustn't be appended to what we have
+            send_body(request, BODY, headers=headers)
+
+    local_server.handler = handler
+    download(local_server, tmp_path)
+
+    assert ranges(local_server) == [None, f"bytes={CUT}-"]
+
+
+def test_no_accept_ranges_starts_over(local_server, download_env, tmp_path):
+    def handler(request):
+        if len(local_server.requests) == 1:
+            send_truncated(request, BODY, CUT, headers={"ETag": '"v1"'})
+        else:
+            send_range(request, BODY, '"v1"')
+
+    local_server.handler = handler
+    download(local_server, tmp_path)
+
+    assert ranges(local_server) == [None, None]
+
+
+def test_resumes_in_next_run(local_server, download_env, tmp_path):
+    def failing(request):
+        if len(local_server.requests) == 1:
+            send_truncated(
+                request, BODY, CUT, headers={"Accept-Ranges": "bytes", "ETag": '"v1"'}
+            )
+        else:
+            send_body(request, b"unavailable", 503)
+
+    local_server.handler = failing
+    job = DownloadJob(url=local_server.url("/file.gz"), dst_path=tmp_path / "file.gz")
+    with pytest.raises(AssertionError, match="failed to download 1 files"):
+        download_many([job])
+
+    # What we got so far is kept for the next run
+    tmp_file, state_path = partial_paths(job.dst_path)
+    assert tmp_file.read_bytes() == BODY[:CUT]
+    state = json.loads(state_path.read_text())
+    assert (state["validator"], state["length"]) == ('"v1"', len(BODY))
+
+    local_server.requests.clear()
+    local_server.handler = lambda request: send_range(request, BODY, '"v1"')
+    download(local_server, tmp_path)
+
+    assert ranges(local_server) == [f"bytes={CUT}-"]
+
+
+# What a run that stopped before renaming the whole file leaves behind
+def leave_partial(local_server, tmp_path, data: bytes):
+    tmp_file, state_path = partial_paths(tmp_path / "file.gz")
+    tmp_file.write_bytes(data)
+    state = {
+        "version": 1,
+        "url": local_server.url("/file.gz"),
+        "validator": '"v1"',
+        "length": len(BODY),
+    }
+    state_path.write_text(json.dumps(state))
+    return tmp_file
+
+
+def test_finishes_complete_partial_file(local_server, download_env, tmp_path):
+    leave_partial(local_server, tmp_path, BODY)
+    local_server.handler = lambda request: send_range(request, BODY, '"v1"')
+    download(local_server, tmp_path)
+
+    # The 416 for the bytes after the end is enough, nothing is downloaded
+    assert ranges(local_server) == [f"bytes={len(BODY)}-"]
+
+
+def test_complete_partial_file_is_verified(local_server, download_env, tmp_path):
+    tmp_file = leave_partial(local_server, tmp_path, BODY[::-1])
+    local_server.handler = lambda request: send_range(request, BODY, '"v1"')
+    job = DownloadJob(
+        url=local_server.url("/file.gz"),
+        dst_path=tmp_path / "file.gz",
+        sha1=hashlib.sha1(BODY).hexdigest(),
+    )
+    with pytest.raises(AssertionError, match="failed to download 1 files"):
+        download_many([job])
+    assert not job.dst_path.exists()
+    assert not tmp_file.exists()
@@ -0,0 +1,239 @@
+import io
+import json
+import hashlib
+from collections import namedtuple
+
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+import mmdb_delta
+import upload_outputs
+from mmdb_tree import MMDBTree
+from mmdb_writer import MMDBWriter
+from synthetic_fixtures import country_record
+from upload_outputs import (
+    S3_MANIFEST_KEY,
+    S3_PREFIX,
+    generate_latest_yaml,
+    sync_s3,
+    upload_missing_ia,
+)
+
+
+def multipart_etag(body: bytes, part_size: int) -> str:
+    parts = [body[i : i + part_size] for i in range(0, len(body), part_size)]
+    digest = hashlib.md5(b"".join(hashlib.md5(p).digest() for p in parts))
+    return f"{digest.hexdigest()}-{len(parts)}"
+
+
+# In memory stand-in for the parts of the S3 client we use, with ETags that
+# behave like the real ones for single part and multipart uploads.
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.manifest_writes = 0
+
+    def put(self, name: str, body: bytes, etag: str = None, metadata: dict = {}):
+        if etag is None:
+            etag = hashlib.md5(body).hexdigest()
+        self.objects[S3_PREFIX + name] = (body, etag, dict(metadata))
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[Key][0])}
+
+    def head_object(self, Bucket, Key):
+        body, etag, metadata = self.objects[Key]
+        return {"ContentLength": len(body), "ETag": f'"{etag}"', "Metadata": metadata}
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {
+            "Contents": [
+                {"Key": key, "Size": len(body), "ETag": f'"{etag}"'}
+                for key, (body, etag, _) in sorted(self.objects.items())
+                if key.startswith(Prefix)
+            ]
+        }
+
+    def upload_file(self, filename, bucket, key, ExtraArgs, Config):
+        with open(filename, "rb") as in_file:
+            body = in_file.read()
+        etag = None
+        if len(body) >= Config.multipart_threshold:
+            etag = multipart_etag(body, Config.multipart_chunksize)
+        self.uploads.append(key.split("/")[-1])
+        self.put(key.split("/")[-1], body, etag, ExtraArgs["Metadata"])
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.manifest_writes += 1
+        self.objects[Key] = (Body, hashlib.md5(Body).hexdigest(), {})
+
+    def manifest(self) -> dict:
+        return json.loads(self.objects[S3_MANIFEST_KEY][0])
+
+
+@pytest.fixture
+def outputs_dir(tmp_path, download_env, monkeypatch):
+    monkeypatch.setattr(upload_outputs, "UPLOAD_BACKOFFS", [])
+    monkeypatch.setattr(
+        upload_outputs,
+        "S3_TRANSFER_CONFIG",
+        TransferConfig(multipart_threshold=1024, multipart_chunksize=1024),
+    )
+    outputs_dir = tmp_path / "outputs"
+    outputs_dir.mkdir()
+    (outputs_dir / "20200101-ip2country_as.mmdb.gz").write_bytes(b"a" * 100)
+    (outputs_dir / "20200201-ip2country_as.mmdb.gz").write_bytes(b"b" * 3000)
+    (outputs_dir / "all_as_org_map.json").write_bytes(b"{}")
+    return outputs_dir
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_uploads_missing_and_skips_current(outputs_dir):
+    s3 = FakeS3()
+    report = sync_s3(outputs_dir, s3, "bucket")
+    assert sorted(report.uploaded) == sorted(p.name for p in outputs_dir.iterdir())
+    assert s3.manifest()["20200201-ip2country_as.mmdb.gz"] == {
+        "sha256": sha256(b"b" * 3000),
+        "size": 3000,
+    }
+    assert s3.manifest_writes == 1
+
+    s3.uploads.clear()
+    report = sync_s3(outputs_dir, s3, "bucket")
+    assert report.uploaded == [] and report.skipped == 3
+    # Nothing changed, so the manifest isn't written again
+    assert s3.manifest_writes == 1
+
+    (outputs_dir / "20200101-ip2country_as.mmdb.gz").write_bytes(b"c" * 100)
+    report = sync_s3(outputs_dir, s3, "bucket")
+    assert s3.uploads == ["20200101-ip2country_as.mmdb.gz"]
+    assert s3.manifest_writes == 2
+
+
+def test_adopts_objects_with_md5_etags(outputs_dir):
+    s3 = FakeS3()
+    for fp in outputs_dir.iterdir():
+        s3.put(fp.name, fp.read_bytes())
+    s3.put("20200301-ip2country_as.mmdb.gz", b"not local")
+
+    report = sync_s3(outputs_dir, s3, "bucket")
+    assert report.uploaded == [] and report.skipped == 3
+    assert set(s3.manifest()) == {p.name for p in outputs_dir.iterdir()}
+
+    # A different object with the same name is uploaded again
+    s3 = FakeS3()
+    s3.put("all_as_org_map.json", b"[]")
+    sync_s3(outputs_dir, s3, "bucket")
+    assert "all_as_org_map.json" in s3.uploads
+
+
+def test_multipart_etags(outputs_dir):
+    name = "20200201-ip2country_as.mmdb.gz"
+    body = (outputs_dir / name).read_bytes()
+    etag = multipart_etag(body, 1024)
+
+    # The ETag isn't an md5, without the sha256 in the metadata we can't tell
+    s3 = FakeS3()
+    s3.put(name, body, etag)
+    sync_s3(outputs_dir, s3, "bucket")
+    assert name in s3.uploads
+    assert s3.objects[S3_PREFIX + name][1] == etag
+
+    s3 = FakeS3()
+    s3.put(name, body, etag, {"sha256": sha256(body)})
+    sync_s3(outputs_dir, s3, "bucket")
+    assert name not in s3.uploads
+    assert s3.manifest()[name]["sha256"] == sha256(body)
+
+
+def test_manifest_entries_for_missing_objects_are_dropped(outputs_dir):
+    s3 = FakeS3()
+    sync_s3(outputs_dir, s3, "bucket")
+    del s3.objects[S3_PREFIX + "all_as_org_map.json"]
+
+    report = sync_s3(outputs_dir, s3, "bucket")
+    assert report.uploaded == ["all_as_org_map.json"]
+
+
+IAItem = namedtuple("IAItem", ["identifier", "filename", "sha1"])
+
+
+def test_internet_archive(outputs_dir, monkeypatch):
+    uploaded = []
+    items = [
+        IAItem(
+            "ip2country-as",
+            "20200101-ip2country_as.mmdb.gz",
+            hashlib.sha1(b"a" * 100).hexdigest(),
+        ),
+        IAItem(
+            "ip2country-as", "all_as_org_map.json", hashlib.sha1(b"old").hexdigest()
+        ),
+    ]
+    monkeypatch.setattr(upload_outputs, "list_all_ia_items", lambda identifier: items)
+    monkeypatch.setattr(
+        upload_outputs,
+        "upload_to_ia",
+        lambda identifier, filepath, access_key, secret_key: uploaded.append(
+            filepath.name
+        ),
+    )
+
+    report = upload_missing_ia(outputs_dir, "secret", "access")
+    assert sorted(uploaded) == ["20200201-ip2country_as.mmdb.gz", "all_as_org_map.json"]
+    assert report.skipped == 1 and not report.failed
+
+
+def test_failed_uploads_are_reported(outputs_dir, monkeypatch):
+    def upload_to_ia(identifier, filepath, access_key, secret_key):
+        raise ConnectionError("archive.org is down")
+
+    monkeypatch.setattr(upload_outputs, "list_all_ia_items", lambda identifier: [])
+    monkeypatch.setattr(upload_outputs, "upload_to_ia", upload_to_ia)
+    report = upload_missing_ia(outputs_dir, "secret", "access")
+    assert len(report.failed) == 3 and not report.uploaded
+
+
+def write_output(path, country):
+    writer = MMDBWriter(ip_version=6)
+    writer.insert("1.2.3.0/24", country_record(country))
+    writer.write(path)
+    path.with_name(path.name + ".gz").write_bytes(path.read_bytes())
+
+
+def test_latest_yaml_leaves_out_stale_deltas(outputs_dir, download_env, monkeypatch):
+    monkeypatch.setattr(mmdb_delta, "default_manifest", lambda: download_env)
+    base = outputs_dir / "20200101-ip2country_as.mmdb"
+    new = outputs_dir / "20200201-ip2country_as.mmdb"
+    write_output(base, "US")
+    write_output(new, "IT")
+    mmdb_delta.write_delta(
+        mmdb_delta.create_delta(base, new), mmdb_delta.delta_path(new)
+    )
+
+    generate_latest_yaml(outputs_dir)
+    latest = mmdb_delta.read_latest_yaml(outputs_dir / "latest.yml")
+    assert latest["delta_filename"] == "20200201-ip2country_as.mmdb.delta.gz"
+    assert latest["delta_base"] == "20200101-ip2country_as.mmdb.gz"
+
+    # The database was rebuilt but its delta wasn't
+    write_output(new, "FR")
+    generate_latest_yaml(outputs_dir)
+    latest = mmdb_delta.read_latest_yaml(outputs_dir / "latest.yml")
+    assert not any(key.startswith("delta_") for key in latest)
+    with MMDBTree(new) as tree:
+        assert latest["content_sha256"] == mmdb_delta.content_digest(tree)
@@ -1,6 +1,11 @@
 #!/bin/bash
 set -ex
 
+# Every stage writes its timings, byte counts and peak memory to $METRICS_DIR,
+# a summary of the whole run is printed at the end even if a stage failed.
+python3 instrumentation.py reset
+trap 'python3 instrumentation.py summarize' EXIT
+
 echo "== UPLOADING DB-IP file if necessary"
 python3 sync_db_ip.py $@
 
@@ -12,14 +17,14 @@ python3 download_assets.py
 # and builds a JSON mapping between an ASN and it's metadata (Organization
 # name, last updated timestamp, AS name).
 echo "== BUILDING AS Organization map"
-python3 build_all_as_org_map.py
+python3 build_all_as_org_map.py --jobs "$(nproc)"
 
 
 # takes the prefix2as files and as to org
 #  JSON mapping and encriches every base country maxmind database with this
 #  metadata.
 echo "== BUILDING country ASN databases"
-./build_country_asn_databases.sh skip_existing
+./build_country_asn_databases.sh skip_unchanged
 
 echo "== UPLOADING outputs"
 python3 upload_outputs.py
@@ -1,18 +1,27 @@
 import os
 import sys
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from pathlib import Path
 from itertools import chain
+from typing import Callable, List, Optional
 
 import boto3
 import internetarchive as ia
+from boto3.s3.transfer import TransferConfig
 
+from compress import CODEC_SUFFIXES
 from download_assets import (
     list_all_ia_items,
     file_sha1_hexdigest,
     file_md5_hexdigest,
     file_sha256_hexdigest,
 )
+from instrumentation import add_bytes, run_stage, span
+from mmdb_delta import content_digest, current_delta_header, delta_path
+from mmdb_tree import MMDBTree
 
 
 def generate_latest_yaml(outputs_dir: Path):
@@ -30,45 +39,167 @@ def generate_latest_yaml(outputs_dir: Path):
     timestamp = latest_file.name.split("-")[0]
     sha256_hash = file_sha256_hexdigest(latest_file)
 
+    # Consumers that have the previous database can fetch the delta instead
+    # and check what they rebuild against content_sha256, see mmdb_delta.py.
+    # Deltas that weren't made from the current databases are left out.
+    delta = delta_path(latest_file.with_suffix(""))
+    header = current_delta_header(latest_file.with_suffix(""))
+    content_sha256 = None
+    if header is not None:
+        content_sha256 = header["new"]["content_sha256"]
+    elif latest_file.with_suffix("").exists():
+        with MMDBTree(latest_file.with_suffix("")) as tree:
+            content_sha256 = content_digest(tree)
+
     yaml_path = outputs_dir / "latest.yml"
     with open(yaml_path, "w") as f:
         f.write(f"filename: {latest_file.name}\n")
         f.write(f"timestamp: {timestamp}\n")
         f.write(f"sha256: {sha256_hash}\n")
+        if content_sha256 is not None:
+            f.write(f"content_sha256: {content_sha256}\n")
+        # Copies compressed with the optional codecs, the keys above always
+        # describe the .gz
+        for codec in ["xz", "zstd"]:
+            variant = latest_file.with_suffix(CODEC_SUFFIXES[codec])
+            if variant.exists():
+                f.write(f"{codec}_filename: {variant.name}\n")
+                f.write(f"{codec}_sha256: {file_sha256_hexdigest(variant)}\n")
+        if header is not None:
+            f.write(f"delta_filename: {delta.name}\n")
+            f.write(f"delta_sha256: {file_sha256_hexdigest(delta)}\n")
+            f.write(f"delta_base: {header['base']['filename']}.gz\n")
 
 
 def iter_outputs(outputs_dir: Path):
     for fp in chain(
-        outputs_dir.glob("*.mmdb.gz"), outputs_dir.glob("all_as_org_map.json")
+        outputs_dir.glob("*.mmdb.gz"),
+        outputs_dir.glob("*.mmdb.xz"),
+        outputs_dir.glob("*.mmdb.zst"),
+        outputs_dir.glob("*.mmdb.delta.gz"),
+        outputs_dir.glob("all_as_org_map.json"),
+        outputs_dir.glob("all_as_org_map.bin"),
     ):
         yield fp
 
 
-def upload_to_ia(identifier: str, filepath: Path, access_key: str, secret_key: str):
-    print(f"   uploading {filepath.name}")
-    files = {filepath.name: filepath.open("rb")}
-    for backoff in [0.3, 0.6, 1.2, 2.4]:
+# Uploads are done by a pool of workers, each one handling a whole file
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+UPLOAD_BACKOFFS = [0.3, 0.6, 1.2, 2.4]
+
+S3_PREFIX = "ip2country-as/"
+# The ETag of an object is only its md5 when it was uploaded in a single part,
+# so instead we keep the sha256 of every object we upload in a manifest next to
+# them, which lets us tell what changed with a single GET.
+S3_MANIFEST_KEY = f"{S3_PREFIX}manifest.json"
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 2**20,
+    multipart_chunksize=64 * 2**20,
+    max_concurrency=4,
+)
+
+
+@dataclass
+class SyncReport:
+    target: str
+    uploaded: List[str] = field(default_factory=list)
+    uploaded_bytes: int = 0
+    skipped: int = 0
+    skipped_bytes: int = 0
+    failed: List[str] = field(default_factory=list)
+
+    def print_summary(self, elapsed: float):
+        print(
+            f"[+] {self.target}: uploaded {len(self.uploaded)} files"
+            f" ({self.uploaded_bytes / 2**20:.1f} MiB), skipped {self.skipped}"
+            f" up to date files ({self.skipped_bytes / 2**20:.1f} MiB),"
+            f" {len(self.failed)} failed in {elapsed:.1f}s"
+        )
+        for name in self.failed:
+            print(f"    FAILED {name}")
+
+
+def with_retries(func: Callable, *args):
+    for backoff in UPLOAD_BACKOFFS:
         try:
-            ia.upload(
-                identifier, files=files, access_key=access_key, secret_key=secret_key
-            )
-            break
-        except:
+            return func(*args)
+        except Exception as exc:
+            print(f"    {exc!r}, retrying in {backoff}s")
             time.sleep(backoff)
+    return func(*args)
+
+
+# Uploads, in parallel, every path for which is_current returns False. Files
+# that fail to upload after all the retries end up in the report rather than
+# aborting the others.
+def sync_files(
+    target: str,
+    paths: List[Path],
+    is_current: Callable[[Path], bool],
+    upload: Callable[[Path], None],
+) -> SyncReport:
+    t0 = time.monotonic()
+    report = SyncReport(target=target)
+    pending = []
+    for fp in paths:
+        if is_current(fp):
+            report.skipped += 1
+            report.skipped_bytes += fp.stat().st_size
+        else:
+            pending.append(fp)
+
+    print(f"[+] {target}: uploading {len(pending)} of {len(paths)} files")
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+
+        def run(fp: Path):
+            with span("upload", target=target, file=fp.name):
+                with_retries(upload, fp)
+
+        futures = {executor.submit(run, fp): fp for fp in pending}
+        for future in as_completed(futures):
+            fp = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"    failed to upload {fp.name}: {exc!r}")
+                report.failed.append(fp.name)
+                continue
+            print(f"    uploaded {fp.name}")
+            report.uploaded.append(fp.name)
+            report.uploaded_bytes += fp.stat().st_size
+            add_bytes("uploaded", fp.stat().st_size)
+
+    report.print_summary(time.monotonic() - t0)
+    return report
+
+
+def upload_to_ia(identifier: str, filepath: Path, access_key: str, secret_key: str):
+    responses = ia.upload(
+        identifier,
+        files={filepath.name: str(filepath)},
+        access_key=access_key,
+        secret_key=secret_key,
+    )
+    for resp in responses:
+        resp.raise_for_status()
 
 
-def upload_missing_ia(outputs_dir: Path, secret_key: str, access_key: str):
+def upload_missing_ia(
+    outputs_dir: Path, secret_key: str, access_key: str
+) -> SyncReport:
     identifier = "ip2country-as"
     existing_items = {}
     for itm in list_all_ia_items(identifier=identifier):
         existing_items[itm.filename] = itm
 
-    for fp in iter_outputs(outputs_dir):
-        if (
+    # The archive computes the sha1 of every file itself, so we can rely on it
+    def is_current(fp: Path) -> bool:
+        return (
             fp.name in existing_items
             and file_sha1_hexdigest(fp) == existing_items[fp.name].sha1
-        ):
-            continue
+        )
+
+    def upload(fp: Path):
         upload_to_ia(
             identifier=identifier,
             filepath=fp,
@@ -76,38 +207,106 @@ def upload_missing_ia(outputs_dir: Path, secret_key: str, access_key: str):
             secret_key=secret_key,
         )
 
+    return sync_files(
+        "internet archive", list(iter_outputs(outputs_dir)), is_current, upload
+    )
+
+
+def load_s3_manifest(s3_client, bucket: str) -> dict:
+    try:
+        resp = s3_client.get_object(Bucket=bucket, Key=S3_MANIFEST_KEY)
+    except s3_client.exceptions.NoSuchKey:
+        return {}
+    return json.loads(resp["Body"].read())
+
 
-def upload_missing_s3(outputs_dir: Path, access_key: str, secret_key: str, bucket: str):
+def list_s3_objects(s3_client, bucket: str) -> dict:
+    objects = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=S3_PREFIX):
+        for obj in page.get("Contents", []):
+            if obj["Size"] == 0 or obj["Key"] == S3_MANIFEST_KEY:
+                # Skip directories
+                continue
+            objects[obj["Key"].split("/")[-1]] = obj
+    return objects
+
+
+def upload_missing_s3(
+    outputs_dir: Path, access_key: str, secret_key: str, bucket: str
+) -> SyncReport:
     session = boto3.Session(
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
     )
-    s3_client = session.client("s3")
-    s3 = session.resource("s3")
+    # Clients, unlike resources, can be shared between threads
+    return sync_s3(outputs_dir, session.client("s3"), bucket)
 
-    existing_items = {}
-    for obj in s3.Bucket(bucket).objects.filter(Prefix="ip2country-as/"):
-        if obj.size == 0:
-            # Skip directories
-            continue
-        filename = obj.key.split("/")[-1]
-        # Note: the etag is not actually always the md5sum. For example it
-        # never is for the .json files. Maybe we should switch to something
-        # different for uploads in s3
-        md5_sum = obj.e_tag.replace('"', "")
-        existing_items[filename] = md5_sum
-
-    for fp in iter_outputs(outputs_dir):
-        if (
-            fp.name in existing_items
-            and file_md5_hexdigest(fp) == existing_items[fp.name]
-        ):
-            continue
 
-        with fp.open("rb") as in_file:
-            s3_client.upload_fileobj(
-                in_file, bucket, f"ip2country-as/{fp.name}"
-            )
+def sync_s3(outputs_dir: Path, s3_client, bucket: str) -> SyncReport:
+    objects = list_s3_objects(s3_client, bucket)
+    stored_manifest = load_s3_manifest(s3_client, bucket)
+    # Entries for objects that went away are dropped, so the manifest never
+    # vouches for something that isn't there.
+    manifest = {
+        name: entry
+        for name, entry in stored_manifest.items()
+        if name in objects and objects[name]["Size"] == entry["size"]
+    }
+
+    # Objects missing from the manifest, eg. because they were uploaded before
+    # it existed, are checked against their ETag when it's known to be an md5,
+    # which it is not for multipart uploads (those have a -<part count>
+    # suffix). Otherwise we look at the sha256 we store in the metadata of
+    # every object we upload. Objects that match are added to the manifest.
+    def object_sha256(fp: Path) -> Optional[str]:
+        etag = objects[fp.name]["ETag"].replace('"', "")
+        if "-" not in etag:
+            if etag != file_md5_hexdigest(fp):
+                return None
+            return file_sha256_hexdigest(fp)
+        resp = s3_client.head_object(Bucket=bucket, Key=f"{S3_PREFIX}{fp.name}")
+        return resp.get("Metadata", {}).get("sha256")
+
+    def is_current(fp: Path) -> bool:
+        if fp.name not in objects:
+            return False
+        entry = manifest.get(fp.name)
+        if entry is not None:
+            return entry["sha256"] == file_sha256_hexdigest(fp)
+        if object_sha256(fp) != file_sha256_hexdigest(fp):
+            return False
+        manifest[fp.name] = {
+            "sha256": file_sha256_hexdigest(fp),
+            "size": fp.stat().st_size,
+        }
+        return True
+
+    def upload(fp: Path):
+        sha256 = file_sha256_hexdigest(fp)
+        s3_client.upload_file(
+            str(fp),
+            bucket,
+            f"{S3_PREFIX}{fp.name}",
+            ExtraArgs={"Metadata": {"sha256": sha256}},
+            Config=S3_TRANSFER_CONFIG,
+        )
+
+    report = sync_files("s3", list(iter_outputs(outputs_dir)), is_current, upload)
+    for name in report.uploaded:
+        fp = outputs_dir / name
+        manifest[name] = {
+            "sha256": file_sha256_hexdigest(fp),
+            "size": fp.stat().st_size,
+        }
+    if manifest != stored_manifest:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=S3_MANIFEST_KEY,
+            Body=json.dumps(manifest, sort_keys=True, indent=2).encode("utf-8"),
+            ContentType="application/json",
+        )
+    return report
 
 
 def main():
@@ -122,13 +321,18 @@ def main():
     s3_bucket = os.environ.get("S3_BUCKET_NAME", "")
 
     did_upload = False
+    reports = []
     if ia_access_key == "" or ia_secret_key == "":
         print(
             "WARNING IA_ACCESS_KEY or IA_SECRET_KEY are not set. Skipping internet archive upload"
         )
     else:
-        upload_missing_ia(
-            outputs_dir=outputs_dir, access_key=ia_access_key, secret_key=ia_secret_key
+        reports.append(
+            upload_missing_ia(
+                outputs_dir=outputs_dir,
+                access_key=ia_access_key,
+                secret_key=ia_secret_key,
+            )
         )
         did_upload = True
 
@@ -137,8 +341,13 @@ def main():
     else:
         if s3_bucket == "":
             s3_bucket = "ooni-geoip-eu-central-1-private-prod"
-        upload_missing_s3(
-            outputs_dir=outputs_dir, access_key=s3_access_key, secret_key=s3_secret_key, bucket=s3_bucket
+        reports.append(
+            upload_missing_s3(
+                outputs_dir=outputs_dir,
+                access_key=s3_access_key,
+                secret_key=s3_secret_key,
+                bucket=s3_bucket,
+            )
         )
         did_upload = True
 
@@ -146,6 +355,11 @@ def main():
         print("No upload performed!")
         sys.exit(1)
 
+    if any(report.failed for report in reports):
+        print("Some uploads failed!")
+        sys.exit(1)
+
 
 if __name__ == "__main__":
-    main()
+    with run_stage("upload_outputs"):
+        main()
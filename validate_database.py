@@ -1,8 +1,8 @@
 import sys
-import random
-import ipaddress
 import logging
-import maxminddb
+from dataclasses import dataclass, field
+
+from mmdb_tree import MMDBTree, is_ipv4
 
 log = logging.getLogger("validate_db")
 
@@ -15,39 +15,76 @@ extra_keys_int = [
     "autonomous_system_number",
 ]
 
+# Minimum number of networks with a country we expect to find for each
+# address family
+MIN_NETWORKS_WITH_COUNTRY = 100
 
-def lookup_random_ips(
-    reader,
-    min_ip: int,
-    max_ip: int,
-    lookup_count: int,
-    min_threshold: int,
-    ip_type: str,
-):
-    lookedup_ips = 0
-    for _ in range(lookup_count):
-        ip = ipaddress.ip_address(random.randint(min_ip, max_ip))
-        resp = reader.get(ip)
-        if not resp or "country" not in resp:
-            continue
 
-        lookedup_ips += 1
+@dataclass
+class FamilyStats:
+    total_addresses: int
+    networks: int = 0
+    addresses: int = 0
+    networks_with_country: int = 0
+    networks_with_asn: int = 0
+    records: set = field(default_factory=set)
+
+    def report(self, ip_type: str) -> str:
+        return (
+            f"    {ip_type}: {self.networks} networks covering"
+            f" {100 * self.addresses / self.total_addresses:.4f}% of the address space,"
+            f" {self.networks_with_country} with a country,"
+            f" {self.networks_with_asn} with an ASN,"
+            f" {len(self.records)} distinct records"
+        )
+
 
-        for k in extra_keys_str:
-            if k not in resp:
-                log.debug(f"{ip} {k} missing from {resp}")
-            else:
-                assert isinstance(resp[k], str), f"{k} is not a string"
-        for k in extra_keys_int:
-            if k not in resp:
-                log.debug(f"{ip} {k} missing from {resp}")
-            else:
-                assert isinstance(resp[k], int), f"{k} is not an int"
+def check_record(resp) -> bool:
+    for k in extra_keys_str:
+        if k not in resp:
+            log.debug(f"{k} missing from {resp}")
+        else:
+            assert isinstance(resp[k], str), f"{k} is not a string"
+    for k in extra_keys_int:
+        if k not in resp:
+            log.debug(f"{k} missing from {resp}")
+        else:
+            assert isinstance(resp[k], int), f"{k} is not an int"
+    return "country" in resp
 
-        if lookedup_ips > min_threshold:
-            break
 
-    assert lookedup_ips > min_threshold, f"didn't find enough {ip_type} addresses"
+# Walks the whole search tree of the database and checks every distinct data
+# record exactly once, so the runtime only depends on the size of the tree.
+def validate_tree(tree: MMDBTree):
+    stats = {
+        "ipv4": FamilyStats(total_addresses=2**32),
+        "ipv6": FamilyStats(total_addresses=2**128 - 2**32),
+    }
+    checked = {}
+    for ip_acc, prefix_len, record in tree.iter_leaves():
+        if record not in checked:
+            resp = tree.decode(record)
+            checked[record] = (check_record(resp), "autonomous_system_number" in resp)
+        has_country, has_asn = checked[record]
+
+        family = "ipv4" if is_ipv4(ip_acc, prefix_len, tree.bit_count) else "ipv6"
+        family_stats = stats[family]
+        family_stats.networks += 1
+        family_stats.addresses += 2 ** (tree.bit_count - prefix_len)
+        family_stats.networks_with_country += has_country
+        family_stats.networks_with_asn += has_asn
+        family_stats.records.add(record)
+
+    for ip_type, family_stats in stats.items():
+        print(family_stats.report(ip_type))
+
+    for ip_type, family_stats in stats.items():
+        if tree.ip_version == 4 and ip_type == "ipv6":
+            continue
+        assert (
+            family_stats.networks_with_country > MIN_NETWORKS_WITH_COUNTRY
+        ), f"didn't find enough {ip_type} addresses"
+    return stats
 
 
 def main():
@@ -57,9 +94,8 @@ def main():
 
     db_file = sys.argv[1]
     print(f"[+] validating {db_file}")
-    with maxminddb.open_database(db_file) as reader:
-        lookup_random_ips(reader, 2**24, 2**32, 10**5, 100, "ipv4")
-        lookup_random_ips(reader, 2**32, 2**128, 10**10, 100, "ipv6")
+    with MMDBTree(db_file) as tree:
+        validate_tree(tree)
 
 
 if __name__ == "__main__":